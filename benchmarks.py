@@ -0,0 +1,295 @@
+#coding=utf8
+__author__ = 'Sam Raker'
+
+import random
+import re
+import sys
+from time import time
+from types import BuiltinFunctionType, FunctionType, ModuleType
+
+import fastjson
+from parsed import flatten, ParsedTweet, scan_text
+from tools import Censor, unicheck, unifilter
+
+WORDS = ['the', 'a', 'lol', 'today', 'great', 'game', 'new', 'love', 'this', 'is', 'so', 'not', 'what', 'happened',
+         'breaking', 'news', 'music', 'video', 'check', 'out', 'my', 'tonight', 'happy', 'birthday', 'omg', "can't"]
+TAGS = ['tbt', 'nowplaying', 'worldcup', 'happybirthday', 'breakingnews', 'icantbreathe', 'throwbackthursday']
+NAMES = ['sam', 'nytimes', 'barackobama', 'ladygaga', 'espn', 'cnn', 'nasa', 'someone_else']
+DATE = 'Wed Jul 09 {h:02d}:{m:02d}:{s:02d} +0000 2014'
+
+
+def fake_url(rng):
+    short = 'http://t.co/{}'.format(''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in xrange(10)))
+    return {'url': short, 'expanded_url': 'http://bit.ly/{}'.format(short[-6:]), 'display_url': short[7:]}
+
+
+def fake_user(i, rng):
+    """
+    Makes up a user, shaped like the user data the Twitter API returns.
+    :param i: used for the user's id
+    :type i: int
+    :param rng: random number generator
+    :type rng: random.Random
+    :return: dict
+    """
+    return {'id_str': str(1000 + i), 'screen_name': '{}{}'.format(rng.choice(NAMES), i), 'name': 'User {}'.format(i),
+            'created_at': DATE.format(h=rng.randint(0, 23), m=rng.randint(0, 59), s=rng.randint(0, 59)),
+            'description': ' '.join(rng.sample(WORDS, 8)), 'followers_count': rng.randint(0, 100000),
+            'friends_count': rng.randint(0, 5000), 'statuses_count': rng.randint(1, 50000), 'lang': 'en',
+            'location': 'Brooklyn, NY', 'time_zone': 'Eastern Time (US & Canada)',
+            'utc_offset': rng.choice([None, -14400, 3600]), 'verified': rng.random() < 0.05,
+            'entities': {'url': {'urls': [fake_url(rng)]}, 'description': {'urls': []}}}
+
+
+def fake_tweet(i, rng=None):
+    """
+    Makes up a tweet, shaped like the tweets the Twitter API returns, with some words, hashtags, mentions and URLs.
+    :param i: used for the tweet's id
+    :type i: int
+    :param rng: random number generator
+    :type rng: random.Random
+    :return: dict
+    """
+    rng = rng or random.Random(i)
+    tags = rng.sample(TAGS, rng.randint(0, 3))
+    mentions = rng.sample(NAMES, rng.randint(0, 2))
+    urls = [fake_url(rng) for _ in xrange(rng.randint(0, 2))]
+    text = ' '.join(['@' + m for m in mentions] + [rng.choice(WORDS) for _ in xrange(rng.randint(4, 16))] +
+                    ['#' + t for t in tags] + [u['url'] for u in urls])
+    tweet = {'id_str': str(500000 + i), 'id': 500000 + i, 'text': text, 'lang': 'en', 'retweet_count': rng.randint(0, 9),
+             'created_at': DATE.format(h=rng.randint(0, 23), m=rng.randint(0, 59), s=rng.randint(0, 59)),
+             'entities': {'hashtags': [{'text': t, 'indices': [0, len(t)]} for t in tags], 'urls': urls,
+                          'user_mentions': [{'screen_name': m, 'id_str': str(len(m))} for m in mentions],
+                          'symbols': []},
+             'user': fake_user(i % 1000, rng), 'coordinates': None, 'place': None}
+    if rng.random() < 0.1:
+        tweet['coordinates'] = {'type': 'Point', 'coordinates': [rng.uniform(-180, 180), rng.uniform(-90, 90)]}
+    return tweet
+
+
+def fake_tweets(n, seed=0):
+    """
+    :param n: how many tweets to make up
+    :type n: int
+    :param seed: random seed, so runs are comparable
+    :type seed: int
+    :return: list of dicts
+    """
+    rng = random.Random(seed)
+    return [fake_tweet(i, rng) for i in xrange(n)]
+
+
+def timed(label, n, func, *args, **kwargs):
+    """
+    Runs func and prints how long it took per item.
+    :param label: what's being timed
+    :type label: str
+    :param n: how many items func processes
+    :type n: int
+    :param func: the function to time
+    :return: whatever func returns
+    """
+    start = time()
+    result = func(*args, **kwargs)
+    secs = time() - start
+    print "{label}: {secs:.3f}s ({us:.1f}us each)".format(label=label, secs=secs, us=secs * 1000000 / n)
+    return result
+
+
+def bench_parse(n=10000, parse_user=True):
+    """
+    Compares the cost of constructing ParsedTweets eagerly and lazily (and of using a couple of lazy attributes.)
+    URLs aren't unshortened, so nothing here touches the network.
+    :param n: how many tweets to parse
+    :type n: int
+    :param parse_user: whether to make ParsedUsers too
+    :type parse_user: bool
+    :return: None
+    """
+    tweets = fake_tweets(n)
+    timed('eager ParsedTweet', n, lambda: [ParsedTweet(t, parse_user=parse_user, unshorten=False) for t in tweets])
+    parsed = timed('lazy ParsedTweet', n,
+                   lambda: [ParsedTweet(t, parse_user=parse_user, unshorten=False, lazy=True) for t in tweets])
+    timed('lazy ParsedTweet .words and .hashtags', n, lambda: [(p.words, p.hashtags) for p in parsed])
+
+
+def regex_scan(text):
+    """
+    What ParsedTweet used to do with a tweet's text before parsed.scan_text, for comparison.
+    :param text: the text
+    :type text: string
+    :return: (list, list, list, list) tuple (tokens, words, hashtags, ats)
+    """
+    tokens = re.split(r'\s+', text)
+    words = [word for word in tokens if not re.match(r'(@|#|http)\S+', word) and any([char.isalnum() for char in word])]
+    hashtags = re.findall(r'#[\w_\d]+', text)
+    ats = [at.group(1) for at in re.finditer(r'@([\w\d]+)', text)]
+    return tokens, words, hashtags, ats
+
+
+def bench_scan(n=10000):
+    """
+    Compares parsed.scan_text with the separate regular expressions it replaced (and checks they agree.)
+    :param n: how many tweets to scan
+    :type n: int
+    :return: None
+    """
+    texts = [t['text'] for t in fake_tweets(n)]
+    old = timed('regex_scan', n, lambda: [regex_scan(text) for text in texts])
+    new = timed('scan_text', n, lambda: [scan_text(text) for text in texts])
+    assert old == [scan[:4] for scan in new]
+
+
+def bench_unifilter(n=10000):
+    """
+    Compares tools.unifilter with calling tools.unicheck on every byte, as it used to (tests/test_tools.py checks they
+    agree.) Half the tweets get a non-ASCII character somewhere in them.
+    :param n: how many tweets to filter
+    :type n: int
+    :return: None
+    """
+    rng = random.Random(0)
+    texts = [t['text'] for t in fake_tweets(n)]
+    extra = [u'\xe9', u'\u2026', u'\u20ac', u'\U0001f602', u'\ufffd']
+    for i in xrange(0, n, 2):
+        at = rng.randint(0, len(texts[i]))
+        texts[i] = u'{}{}{}'.format(texts[i][:at], rng.choice(extra), texts[i][at:])
+    timed('unicheck per byte', n, lambda: [all([unicheck(c) for c in text.encode('utf8')]) for text in texts])
+    timed('unifilter', n, lambda: [unifilter(text) for text in texts])
+
+
+def bench_censor(n=10000, terms=2000):
+    """
+    Compares a tools.Censor with checking each term against the lower-cased text in turn (and checks they agree.)
+    :param n: how many tweets to check
+    :type n: int
+    :param terms: how many made-up terms to look for, on top of some words that do turn up in the tweets
+    :type terms: int
+    :return: None
+    """
+    rng = random.Random(0)
+    blocklist = ['LOL', 'omg', 'game'] + [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in xrange(7))
+                                          for _ in xrange(terms)]
+    texts = [t['text'] for t in fake_tweets(n)]
+    old = timed('term by term', n, lambda: [not any(term.lower() in text.lower() for term in blocklist)
+                                            for text in texts])
+    censor = timed('building Censor', terms, Censor, blocklist)
+    new = timed('Censor', n, lambda: [censor(text) for text in texts])
+    assert old == new
+
+
+def recursive_flatten(js):
+    """
+    How Parsed used to flatten metadata before parsed.flatten, for comparison.
+    :param js: the JSON to flatten
+    :type js: dict
+    :return: dict
+    """
+    d = {}
+    for k in js.keys():
+        if k == "user":
+            d[k] = js[k]
+        elif isinstance(js[k], dict):
+            for k2 in js[k].keys():
+                d["{0}_{1}".format(k, k2)] = js[k][k2]
+            d.update(recursive_flatten(js[k]))
+        else:
+            d[k] = js[k]
+    return d
+
+
+def bench_flatten(n=10000):
+    """
+    Compares parsed.flatten (with and without a whitelist) with the recursive flattening it replaced (and checks they
+    agree.) Every other tweet is a retweet, so there's a retweeted_status to flatten too.
+    :param n: how many tweets to flatten
+    :type n: int
+    :return: None
+    """
+    tweets = fake_tweets(n)
+    for i in xrange(0, n - 1, 2):
+        tweets[i]['retweeted_status'] = tweets[i + 1]
+    old = timed('recursive_flatten', n, lambda: [recursive_flatten(t) for t in tweets])
+    new = timed('flatten', n, lambda: [flatten(t) for t in tweets])
+    assert old == new
+    timed('flatten (ParsedTweet.meta_fields only)', n, lambda: [flatten(t, ParsedTweet.meta_fields) for t in tweets])
+
+
+def deep_size(obj, seen=None):
+    """
+    Approximates the memory used by an object and everything it refers to (that isn't shared by every instance, like
+    classes, functions and modules.) Objects referred to more than once are only counted once.
+    :param obj: the object to measure
+    :param seen: ids of the objects already counted
+    :type seen: set or None
+    :return: int (bytes)
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen or isinstance(obj, (type, FunctionType, BuiltinFunctionType, ModuleType)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, '__self__'):  # bound methods
+        size += deep_size(obj.__self__, seen)
+    if hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    for name in getattr(type(obj), '__slots__', ()):
+        size += deep_size(getattr(obj, name, None), seen)
+    return size
+
+
+def bench_memory(n=1000):
+    """
+    Compares the memory used per tweet by ParsedTweets (with their ParsedUsers) and TweetRecords.
+    :param n: how many tweets to measure
+    :type n: int
+    :return: None
+    """
+    tweets = [ParsedTweet(t, unshorten=False) for t in fake_tweets(n)]
+    records = [t.to_record() for t in tweets]
+    for label, objs in (('ParsedTweet', tweets), ('TweetRecord', records)):
+        print "{label}: {size:.0f} bytes per tweet".format(label=label, size=float(deep_size(objs)) / n)
+
+
+def bench_json(n=10000):
+    """
+    Compares how fast each installed fastjson backend decodes and encodes tweets (and checks they agree.)
+    :param n: how many tweets to decode and encode
+    :type n: int
+    :return: None
+    """
+    tweets = fake_tweets(n)
+    lines = [fastjson.BACKENDS['json'][1](t) for t in tweets]
+    mb = sum(len(line) for line in lines) / 1048576.0
+    current = fastjson.backend
+    try:
+        for name in fastjson.PREFERENCE:
+            if name not in fastjson.BACKENDS:
+                print "{}: not installed".format(name)
+                continue
+            fastjson.set_backend(name)
+            start = time()
+            decoded = [fastjson.loads(line) for line in lines]
+            decode_secs = time() - start
+            start = time()
+            encoded = [fastjson.dumps(js) for js in decoded]
+            encode_secs = time() - start
+            assert decoded == tweets and [fastjson.loads(line) for line in encoded] == tweets
+            print "{name}: decodes {dec:.1f}MB/s, encodes {enc:.1f}MB/s".format(name=name, dec=mb / decode_secs,
+                                                                              enc=mb / encode_secs)
+    finally:
+        fastjson.set_backend(current)
+
+
+if __name__ == '__main__':
+    bench_json()
+    bench_parse()
+    bench_flatten()
+    bench_scan()
+    bench_unifilter()
+    bench_censor()
+    bench_memory()
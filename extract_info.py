@@ -3,28 +3,30 @@ __author__ = 'Sam Raker'
 
 from functools import partial
 from itertools import chain, imap
-from json import dumps, loads
 import re
-from urllib2 import HTTPError, URLError
 
-import requests
 from dateutil.parser import parse
 from nltk.tokenize import wordpunct_tokenize
 
+from fastjson import dumps
 from feature_extraction.freq_splitter import split_text
-from tools import eld
+from tools import eld, read_jsonl
+from unshorten import default_resolver
 
 
 class Extractor(object):
     """
     A class to extract relevant information from JSON representations of tweets.
     """
-    def __init__(self, fnames=None, folder=None):
+    def __init__(self, fnames=None, folder=None, resolver=None):
         """
         :param fnames: list of JSON files to process
         :type fnames: list of strings (file names)
         :param folder: path to a folder containing JSON files to process
         :type folder: string
+        :param resolver: the resolver to unshorten URLs with (defaults to unshorten.default_resolver(), which caches
+            resolved URLs)
+        :type resolver: unshorten.URLResolver or None
         """
         self.fnames = []
         if fnames:
@@ -35,6 +37,7 @@ class Extractor(object):
         self.clean_pat = re.compile(r'(@|#|http)\S+')
         self.parsed = []
         self.tweets = []
+        self.resolver = resolver or default_resolver()
 
     def parse_created(self, time):
         """
@@ -54,6 +57,26 @@ class Extractor(object):
             print e
             return -1, -1
 
+    def unshorten(self, urls):
+        """
+        Unshortens the URLs in a tweet's or user's entities. The expanded_url (or failing that, the t.co url) is what
+        gets resolved; an entity with neither falls back to its display_url, which is kept as it is, since it has no
+        scheme and may have been truncated for display.
+        :param urls: the URL entities
+        :type urls: list of dicts or None
+        :return: list of strings
+        """
+        urls = urls or []
+        resolved = iter(self.resolver.unshorten([url.get("expanded_url") or url["url"] for url in urls
+                                                 if url.get("expanded_url") or url.get("url")]))
+        unshortened = []
+        for url in urls:
+            if url.get("expanded_url") or url.get("url"):
+                unshortened.append(next(resolved))
+            elif url.get("display_url"):
+                unshortened.append(url["display_url"])
+        return unshortened
+
     def extract_tweet(self, tweet, splitter=None):
         """
         Extracts relevant tweet-related information from a tweet.
@@ -73,13 +96,7 @@ class Extractor(object):
         d["user"] = tweet.get("user", {}).get("id_str", "")
         d["mentions"] = [user.get("id_str", "") for user in entities.get("user_mentions", [])]
         d["split_hashtags"] = [split_text(hashtag)[1] for hashtag in d["hashtags"]]
-        urls = entities.get("urls")
-        for url in urls:
-            try:
-                r = requests.get(url)
-                d["urls"].append(r.url)
-            except (requests.RequestException, HTTPError, URLError, TypeError):
-                d["urls"].append(url.get("expanded_url", url.get("display_url", url.get("url", ""))))
+        d["urls"] = self.unshorten(entities.get("urls"))
         for url in d["urls"]:
             m = re.match(self.domain_pat, url)
             if m:
@@ -108,13 +125,7 @@ class Extractor(object):
             d["following"] = 1
         d["followers"] = user.get("followers_count", 0)
         d["follow_ratio"] = float(d["followers"]) / d["following"]
-        urls = user.get("entities", {}).get("urls", [])
-        for url in urls:
-            try:
-                r = requests.get(url)
-                d["urls"].append(r.url)
-            except (requests.RequestException, HTTPError, URLError):
-                d["urls"].append(url.get("expanded_url", url.get("display_url", url.get("url", ""))))
+        d["urls"] = self.unshorten(user.get("entities", {}).get("urls"))
         for url in d["urls"]:
             m = re.match(self.domain_pat, url)
             if m:
@@ -138,13 +149,11 @@ class Extractor(object):
 
     def open_wrapper(self, fil):
         """
-        Opens a file and returns its lines as a list
+        Lazily reads the JSON objects in a file (see tools.read_jsonl)
         :param fil: the file to open
-        :return: list of strings
+        :return: iterator of dicts
         """
-
-        with open(fil) as f:
-            return f
+        return (js for _, js in read_jsonl(fil))
 
     def parse(self, splitter=None):
         """
@@ -153,7 +162,7 @@ class Extractor(object):
         :return: None (appends to .parsed)
         """
         parse_partial = partial(self.extract, splitter=splitter)
-        for parsed in imap(parse_partial, imap(loads, chain.from_iterable(imap(self.open_wrapper, self.fnames)))):
+        for parsed in imap(parse_partial, chain.from_iterable(imap(self.open_wrapper, self.fnames))):
             self.parsed.append(parsed)
 
     def write_parse(self, dest, splitter=None):
@@ -165,7 +174,7 @@ class Extractor(object):
         :return: None (writes JSON strings to a file)
         """
         extract_partial = partial(self.extract, splitter=splitter)
-        it = imap(extract_partial, imap(loads, chain.from_iterable(imap(open, self.fnames))))
+        it = imap(extract_partial, chain.from_iterable(imap(self.open_wrapper, self.fnames)))
         tweet_counter = 0
         file_counter = 1
         if dest[-5:] == ".json":
@@ -0,0 +1,103 @@
+#coding=utf8
+"""
+One place for all the JSON decoding and encoding, so it can use a faster library than the standard library's json
+when one is installed. The first of PREFERENCE that's installed is used: ujson (with precise_float, which slows it
+down a little) and simplejson (with its C speedups) decode tweets about equally fast, and both well ahead of json (see
+benchmarks.bench_json, and run it to see which wins on your machine.) The backend can also be chosen explicitly with
+set_backend (or the JSON_BACKEND environment variable.) Encoding is always done by json, whose C encoder is as fast as
+any of them on tweets, and which, unlike ujson, writes floats without rounding them.
+"""
+__author__ = 'Sam Raker'
+
+from functools import partial
+import json
+from os import environ
+
+BACKENDS = {'json': (json.loads, json.dumps)}
+PREFERENCE = ('ujson', 'simplejson', 'json')  # the order to try the backends in (see above)
+
+try:
+    import simplejson
+    if simplejson._import_c_make_encoder() is not None:  # without its speedups it's no faster than json
+        BACKENDS['simplejson'] = (simplejson.loads, json.dumps)
+except (ImportError, AttributeError):
+    pass
+
+try:
+    import ujson
+    # without precise_float, ujson rounds floats as it reads them
+    BACKENDS['ujson'] = (partial(ujson.loads, precise_float=True), json.dumps)
+except ImportError:
+    pass
+
+backend = None
+_loads = None
+_dumps = None
+
+
+def set_backend(name=None):
+    """
+    Chooses the library to decode and encode JSON with.
+    :param name: the library's name ('ujson', 'simplejson' or 'json'), or None for the first one in PREFERENCE
+        that's installed
+    :type name: str or None
+    :return: str (the name of the library now in use)
+    """
+    global backend, _loads, _dumps
+    if name is None:
+        name = next(b for b in PREFERENCE if b in BACKENDS)
+    elif name not in BACKENDS:
+        raise ValueError("JSON backend {} isn't available (try one of {})".format(name, ', '.join(sorted(BACKENDS))))
+    backend = name
+    _loads, _dumps = BACKENDS[name]
+    return name
+
+
+def loads(s, fields=None):
+    """
+    Decodes JSON.
+    :param s: the JSON to decode
+    :type s: str
+    :param fields: if the JSON is an object, only keep these keys (so the values the caller doesn't use are thrown
+        away straight away, rather than being carried around, flattened, etc.)
+    :type fields: collection of strs or None
+    :return: the decoded JSON
+    """
+    js = _loads(s)
+    if fields is not None and isinstance(js, dict):
+        return {k: js[k] for k in fields if k in js}
+    return js
+
+
+def dumps(obj):
+    """
+    Encodes JSON.
+    :param obj: the object to encode
+    :return: str
+    """
+    return _dumps(obj)
+
+
+def load(f, fields=None):
+    """
+    Decodes JSON from a file.
+    :param f: the file
+    :type f: file
+    :param fields: see loads
+    :return: the decoded JSON
+    """
+    return loads(f.read(), fields)
+
+
+def dump(obj, f):
+    """
+    Encodes JSON to a file.
+    :param obj: the object to encode
+    :param f: the file
+    :type f: file
+    :return: None
+    """
+    f.write(dumps(obj))
+
+
+set_backend(environ.get('JSON_BACKEND'))
@@ -2,7 +2,6 @@
 __author__ = 'Sam Raker'
 
 from contextlib import closing
-import json
 import os
 import re
 import socket
@@ -10,7 +9,9 @@ import socket
 import requests
 from requests import exceptions
 
-from tools import eld, SafeRedis
+import fastjson
+from tools import eld, read_lines_reversed, SafeRedis
+from unshorten import URLCache
 
 ROUTER_IP = '24.186.113.22'
 REDIS_HOST = '24.186.113.22'
@@ -30,11 +31,12 @@ OUT_DIR = os.path.join(home_dir, "fixed")
 
 
 CONN = SafeRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+CACHE = URLCache(redis=CONN)
 
 
 def resolve_redirects(url):
     print "Resolving {}".format(url)
-    cached = CONN.get(url)
+    cached = CACHE.get(url)
     if cached:
         return cached
     session = requests.session()
@@ -44,27 +46,28 @@ def resolve_redirects(url):
     except (exceptions.RequestException, socket.error) as e:
         try:
             requests.head('http://{}'.format(ROUTER_IP)).close()
-            CONN.set(url, url)
+            CACHE.put_failed([url])
             return url  # original url is invalid
         except (exceptions.RequestException, socket.error):
             raise e
     if not r.headers.get('location'):  # not a redirect
-        CONN.set(url, url)
+        CACHE.put(url, url)
         return url
     tmp_url = url
     try:
         redir = r
         for redir in session.resolve_redirects(r, r.request, timeout=300):
             if redir.status_code == 200 and not (('domainnotfound' in redir.url) or ('http' not in redir.url)):
+                CACHE.put(url, redir.url)
                 return redir.url  # return a valid end
             else:
                 tmp_url = redir.url
         else:
-            CONN.set(url, tmp_url)
+            CACHE.put(url, tmp_url)
             return tmp_url  # if no url in the redirect chain meets our criteria, just return the last url in
                             # the chain
     except requests.exceptions.TooManyRedirects:
-        CONN.set(url, tmp_url)
+        CACHE.put(url, tmp_url)
         return tmp_url
     except (exceptions.RequestException, socket.error) as e:
         # requests can't distinguish failing to connect to an invalid site from having no connectivity whatsoever.
@@ -75,7 +78,7 @@ def resolve_redirects(url):
                 # shout-out to Martijn Peters for suggesting this as a better solution on StackOverflow
                 # (https://stackoverflow.com/questions/24619150/python-requests-full-url-from-error-message/24619242#24619242)
                 end_url = redir.headers.get('location', tmp_url)
-                CONN.set(url, end_url)
+                CACHE.put(url, end_url)
                 return end_url
             except (exceptions.RequestException, socket.error):
                 raise e
@@ -91,7 +94,7 @@ def fix_url(url):
 
 
 def fix_urls(entry):
-    js = json.loads(entry)
+    js = fastjson.loads(entry)
     urls = js[1][0].get('urls')
     if not urls:  # no urls => nothing to do
         return entry.rstrip()
@@ -103,21 +106,16 @@ def fix_urls(entry):
         domains.append(domain)
     js[1][0]['urls'] = expanded_urls
     js[1][0]['domains'] = domains
-    return json.dumps(js)
+    return fastjson.dumps(js)
 
 
 def fix_js(js_file):
     i = 0
-    with open(js_file) as f:
-        l = f.readlines()
     with open(os.path.join(OUT_DIR, os.path.split(js_file)[-1]), 'a') as f:
-        while True:
-            try:
-                f.write(fix_urls(l.pop()) + "\n")
-                i += 1
-                print "fixed line {}".format(i)
-            except IndexError:
-                break
+        for _, line in read_lines_reversed(js_file):
+            f.write(fix_urls(line) + "\n")
+            i += 1
+            print "fixed line {}".format(i)
     print "fixed {}".format(js_file)
 
 
@@ -132,6 +130,7 @@ def fix_all(directory):
     for idx, fil in enumerate(fils):
         print "fixing {} ({} of {})".format(fil, idx, num_fils)
         fix_js(fil)
+    CACHE.report()
 
 if __name__ == '__main__':
     fix_all(IN_DIR)
@@ -2,8 +2,8 @@
 __author__ = 'Sam Raker'
 
 import gzip
-import json
 
+import fastjson
 from tools import eld
 
 
@@ -12,7 +12,7 @@ def get_hashtags():
     tag_lists = []
     for vector_list in master_vectors:
         with gzip.open(vector_list) as f:
-            js = json.load(f)
+            js = fastjson.load(f)
             hashtags = js.get('hashtags')
             if len(hashtags) > 2:
                 tag_lists.append(set(hashtags))
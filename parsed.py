@@ -1,46 +1,286 @@
 #coding=utf-8
 __author__ = 'Sam Raker'
 
-import json
+from collections import Mapping, namedtuple, OrderedDict
+from itertools import chain, islice
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import ThreadPool
 import re
 from pprint import pformat
+from threading import Lock, local
+from time import time
 
 import requests
 
+import fastjson
 from auth import _AUTH
 from feature_extraction.freq_splitter import split_text
+from ratelimit import default_limiter
+from unshorten import default_resolver
+
+TIMELINE_URL = "https://api.twitter.com/1.1/statuses/user_timeline.json"
+
+SPLIT_PAT = re.compile(r'\s+')
+TOKEN_PAT = re.compile(r'\S+')
+HASHTAG_PAT = re.compile(r'#[\w_\d]+')
+AT_PAT = re.compile(r'@([\w\d]+)')
+NOT_WORD_PAT = re.compile(r'(@|#|http)\S+')
+ALNUM_PAT = re.compile(r'[^\W_]', re.UNICODE)  # the same characters unicode.isalnum accepts
+MUNGE_PAT = re.compile(r'(@|http://(www\.)?)[\w\d\.\-\?/]+')
+DOMAIN_PAT = re.compile(r'https?://([\w\d\.\-]+\.\w{2,3})')
+UTC_PAT = re.compile(r'\d{2}:\d{2}:\d{2} ((\+|-)\d{4}) \d{4}')
+
+Scan = namedtuple('Scan', ['tokens', 'words', 'hashtags', 'ats', 'url_spans'])
+
+
+def is_word(token):
+    """
+    Whether a token counts as a word: it isn't a mention, hashtag or URL, and has at least one letter or number in it.
+    :param token: the token
+    :type token: string
+    :return: bool
+    """
+    if NOT_WORD_PAT.match(token):
+        return False
+    if isinstance(token, unicode):
+        return ALNUM_PAT.search(token) is not None
+    return any(char.isalnum() for char in token)
+
+
+def scan_text(text):
+    """
+    Tokenizes a tweet's text and finds the words, hashtags, mentions and URLs in it, in one pass over the text.
+    The results are the same as from the separate regular expressions ParsedTweet used to run: the tokens are exactly
+    what re.split(r'\s+', text) returns (including the empty strings it returns for leading/trailing whitespace), and
+    the hashtags and mentions are what re.findall finds in the whole text (neither can span whitespace.)
+    :param text: the text to scan
+    :type text: string
+    :return: Scan (tokens, words, hashtags, ats (mentioned screen names, without the @), url_spans ((start, end) tuples
+        of the tokens that are URLs))
+    """
+    tokens = []
+    words = []
+    hashtags = []
+    ats = []
+    url_spans = []
+    if SPLIT_PAT.match(text):
+        tokens.append(text[:0])
+    for m in TOKEN_PAT.finditer(text):
+        token = m.group()
+        tokens.append(token)
+        if '#' in token:
+            hashtags.extend(HASHTAG_PAT.findall(token))
+        if '@' in token:
+            ats.extend(AT_PAT.findall(token))
+        # tokens have no whitespace in them, so this is NOT_WORD_PAT.match(token) without the regex
+        if token.startswith('http') and len(token) > 4:
+            url_spans.append(m.span())
+        elif token[0] in '@#' and len(token) > 1:
+            pass
+        elif ALNUM_PAT.search(token) if isinstance(token, unicode) else any(char.isalnum() for char in token):
+            words.append(token)
+    if not tokens or SPLIT_PAT.match(text, len(text) - 1):
+        tokens.append(text[:0])
+    return Scan(tokens, words, hashtags, ats, url_spans)
+
+
+_FLAT_KEYS = {}  # parent key: {child key: flattened key}
+MAX_FLAT_KEYS = 10000
+
+
+def flatten(js, keys=None):
+    """
+    The metadata dictionary returned by the Twitter API is heavily nested. This function flattens it: every
+    key/value pair is copied up to the top level, and the children of each nested dictionary are also stored under
+    '<key>_<child key>' (only one level deep.) Nested 'user' dictionaries are kept whole, and where the same key turns
+    up more than once (e.g. 'text' in a tweet and in its retweeted_status), the last one found wins.
+    The flattening is done iteratively, and the '<key>_<child key>' strings are cached and interned, so the same keys
+    aren't rebuilt for every tweet.
+    :param js: the JSON to flatten
+    :type js: dict
+    :param keys: if given, only these (flattened) keys are kept
+    :type keys: set, frozenset or None
+    :return: dict
+    """
+    d = {}
+    stack = [js.iteritems()]
+    while stack:
+        for k, v in stack[-1]:
+            if k != "user" and isinstance(v, dict):  # keep user data in one place to pass to ParsedUser
+                flat_keys = _FLAT_KEYS.get(k)
+                if flat_keys is None:
+                    if len(_FLAT_KEYS) >= MAX_FLAT_KEYS:
+                        _FLAT_KEYS.clear()
+                    flat_keys = _FLAT_KEYS[k] = {}
+                for k2, v2 in v.iteritems():
+                    key = flat_keys.get(k2)
+                    if key is None:
+                        key = "{0}_{1}".format(k, k2)
+                        if isinstance(key, str):
+                            key = intern(key)
+                        flat_keys[k2] = key
+                    if keys is None or key in keys:
+                        d[key] = v2
+                stack.append(v.iteritems())
+                break
+            elif keys is None or k in keys:
+                d[k] = v
+        else:
+            stack.pop()
+    return d
+
+
+class FlatView(Mapping):
+    """
+    A read-only view of flattened JSON (see flatten, above) that isn't flattened until it's first used.
+    """
+
+    def __init__(self, js, keys=None):
+        """
+        :param js: the JSON to flatten
+        :type js: dict
+        :param keys: see flatten
+        :type keys: set, frozenset or None
+        """
+        self.js = js
+        self.fields = keys
+        self.flat = None
+
+    def materialize(self):
+        """
+        :return: dict (the flattened JSON)
+        """
+        if self.flat is None:
+            self.flat = flatten(self.js, self.fields)
+            self.js = None
+        return self.flat
+
+    def __getitem__(self, key):
+        return self.materialize()[key]
+
+    def __contains__(self, key):
+        return key in self.materialize()
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def __repr__(self):
+        return repr(self.materialize())
+
+
+class lazy_attribute(object):
+    """
+    Decorator for attributes that are computed by a method the first time they're accessed. The result is stored on the
+    instance under the same name, so later accesses are ordinary attribute lookups, and the attribute can still be set
+    directly.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        val = obj.__dict__[self.__name__] = self.func(obj)
+        return val
+
+
+class meta_attribute(lazy_attribute):
+    """
+    A lazy_attribute that's just one of the values in the object's metadata (see Parsed.get_meta.)
+    """
+
+    def __init__(self, name, key=None):
+        """
+        :param name: the attribute's name
+        :type name: str
+        :param key: the metadata key (defaults to name)
+        :type key: str or None
+        """
+        key = key or name
+        super(meta_attribute, self).__init__(lambda obj: obj.get_meta(key))
+        self.__name__ = name
+        self.__doc__ = "The '{}' metadata value".format(key)
 
 
 class Parsed(object):
     """
     Base class for ParsedTweet and ParsedUser classes.
+    The attributes derived from the metadata are lazy_attributes. By default, subclasses compute all of them when
+    they're created (see .evaluate); with lazy=True, each one is only computed if and when it's first used. Those named
+    in always_lazy are never computed before they're used.
+    meta_fields are the metadata keys the class itself reads.
     """
+    always_lazy = ('meta_keys',)
+    meta_fields = frozenset(['entities_urls', 'id_str'])
 
-    def __init__(self, js, unshorten=True):
+    def __init__(self, js, unshorten=True, resolver=None, lazy=False, fields=None):
         """
         :param js: JSON dict as returned by Twitter API
         :type js: dict
+        :param unshorten: whether to unshorten the URLs (see also Parsed.unshorten_batch, below)
+        :type unshorten: bool
+        :param resolver: the resolver to unshorten URLs with (defaults to unshorten.default_resolver())
+        :type resolver: unshorten.URLResolver or None
+        :param lazy: whether to put off flattening the metadata (see FlatView) until it's first used
+        :type lazy: bool
+        :param fields: which metadata keys to keep: all of them (None), only the ones the class reads (True, see
+        meta_fields), or those plus the ones given
+        :type fields: None, bool or iterable of strings
         """
-        self.metadata = self.__get_meta_keys__(js)
-        self.meta_keys = self.metadata.keys()
-        self.urls = []
-        urls = self.get_meta('entities_urls')
-        if urls:
-            for url in urls:
-                expanded = url.get('expanded_url')
-                if expanded:
-                    self.urls.append(expanded)
-                else:
-                    tco = url.get('url')
-                    if tco:
-                        self.urls.append(tco)
-        if unshorten:
-            self.unshortened_urls = self.get_unshortened_urls()
-            self.url_domains = self.get_url_domains()
-        else:
+        if fields is True:
+            fields = self.meta_fields
+        elif fields is not None:
+            fields = self.meta_fields.union(fields)
+        self.fields = fields
+        self.metadata = FlatView(js, fields) if lazy else self.__get_meta_keys__(js)
+        self.unshorten = unshorten
+        self.resolver = resolver
+        if not unshorten:
             self.unshortened_urls = []
             self.url_domains = []
-        self.id = self.get_meta("id_str")
+
+    id = meta_attribute('id', 'id_str')
+
+    @lazy_attribute
+    def meta_keys(self):
+        return self.metadata.keys()
+
+    @lazy_attribute
+    def urls(self):
+        urls = []
+        for url in self.get_meta('entities_urls') or []:
+            expanded = url.get('expanded_url')
+            if expanded:
+                urls.append(expanded)
+            else:
+                tco = url.get('url')
+                if tco:
+                    urls.append(tco)
+        return urls
+
+    @lazy_attribute
+    def unshortened_urls(self):
+        return self.get_unshortened_urls(self.resolver)
+
+    @lazy_attribute
+    def url_domains(self):
+        return self.get_url_domains()
+
+    def evaluate(self):
+        """
+        Computes all of the object's lazy attributes that haven't been computed yet.
+        :return: None
+        """
+        for cls in reversed(type(self).__mro__):
+            for name, attr in vars(cls).iteritems():
+                if isinstance(attr, lazy_attribute) and name not in self.always_lazy:
+                    getattr(self, name)
 
     def __eq__(self, other):
         if self.id == other.id:
@@ -61,22 +301,12 @@ class Parsed(object):
         """
         The metadata dictionary returned by the Twitter API is heavily nested. This function
         flattens that dictionary and makes it easier to retrieve various parts of the metadata
-        (see also .get_meta, below.)
+        (see flatten, above, and .get_meta, below.)
         :param js: the twitter metadata.
         :type js: dictionary.
         :return: dictionary.
         """
-        d = {}
-        for k in js.keys():
-            if k == "user": # keep user data in one place to pass to ParsedUser
-                d[k] = js[k]
-            elif isinstance(js[k], dict):
-                for k2 in js[k].keys():
-                    d["{0}_{1}".format(k, k2)] = js[k][k2]
-                d.update(self.__get_meta_keys__(js[k]))
-            else:
-                d[k] = js[k]
-        return d
+        return flatten(js, self.fields)
 
     def get_meta(self, value=None, verbose=False):
         """
@@ -88,7 +318,7 @@ class Parsed(object):
         :type verbose: boolean.
         :return: string, list, or dictionary, depending on the metadata in question.
         """
-        if self.get('meta_keys', None):
+        if self.metadata:
             if value:
                 try:
                     return self.metadata[value]
@@ -118,30 +348,47 @@ class Parsed(object):
             else:
                 return default
 
-    def get_unshortened_urls(self):
+    @staticmethod
+    def unshorten_batch(parsed, resolver=None):
+        """
+        Unshortens the URLs of a batch of Parsed objects (and the ParsedUsers of any ParsedTweets among them) in one
+        pass, so they're all resolved concurrently rather than one object at a time.
+        :param parsed: the objects whose URLs are to be unshortened
+        :type parsed: list of Parsed objects
+        :param resolver: the resolver to unshorten URLs with (defaults to unshorten.default_resolver())
+        :type resolver: unshorten.URLResolver or None
+        :return: parsed
+        """
+        objs = []
+        for obj in parsed:
+            objs.append(obj)
+            if isinstance(vars(obj).get('user'), Parsed):  # don't force a lazy user
+                objs.append(obj.user)
+        resolved = (resolver or default_resolver()).resolve_all(url for obj in objs for url in obj.urls)
+        for obj in objs:
+            obj.unshortened_urls = [resolved[url] for url in obj.urls]
+            obj.url_domains = obj.get_url_domains()
+        return parsed
+
+    def get_unshortened_urls(self, resolver=None):
         """
-        Uses requests to get the full URLs from a shortened (bit.ly, t.co, etc.) versions
+        Gets the full URLs from their shortened (bit.ly, t.co, etc.) versions (see unshorten.URLResolver.)
+        :param resolver: the resolver to unshorten URLs with (defaults to unshorten.default_resolver())
+        :type resolver: unshorten.URLResolver or None
         :return: list of strings
         """
-        unshortened = []
-        for url in self.urls:
-            try:
-                r = requests.get(url)
-                unshortened.append(r.url)
-            except Exception as e:
-                print e
-                unshortened.append(url)
-        return unshortened
+        return (resolver or default_resolver()).unshorten(self.urls)
 
-    def get_url_domains(self):
+    def get_url_domains(self, urls=None):
         """
         Extracts the domains from URLs
-        :return: list of strings
+        :param urls: the URLs (defaults to .unshortened_urls)
+        :type urls: list of strings or None
+        :return: list of strings (None for URLs without a recognizable domain)
         """
         domains = []
-        p = re.compile(r'https?://([\w\d\.\-]+\.\w{2,3})')
-        for url in self.unshortened_urls:
-            m = re.match(p, url)
+        for url in self.unshortened_urls if urls is None else urls:
+            m = DOMAIN_PAT.match(url)
             if m:
                 domains.append(m.group(1))
             else:
@@ -160,7 +407,7 @@ class Parsed(object):
         """
         if verbose:
             print "serializing {}".format(self.__repr__())
-        return json.dumps(self.metadata)
+        return fastjson.dumps(dict(self.metadata))
 
 
 class ParsedTweet(Parsed):
@@ -172,8 +419,12 @@ class ParsedTweet(Parsed):
     NB: Twitter metadata is frequently in unicode. You have been warned.
     NB: See .to_json, below, for information on serialization.
     """
+    munge_p = MUNGE_PAT
+    meta_fields = Parsed.meta_fields | frozenset(['text', 'entities_hashtags', 'user', 'user_id_str', 'created_at',
+                                                  'entities_user_mentions', 'coordinates'])
 
-    def __init__(self, js, tokenize=None, parse_user=True, unshorten=True):
+    def __init__(self, js, tokenize=None, parse_user=True, unshorten=True, resolver=None, lazy=False, timeline=None,
+                 fields=None):
         """
         :param js: the JSON representation of the tweet, as returned by the Twitter API
         :type js: dict
@@ -183,35 +434,140 @@ class ParsedTweet(Parsed):
         :param parse_user: whether to turn the user data included in the tweet JSON into a ParsedUser
         instance (see parsed.ParsedUser for more information)
         :type parse_user: bool
+        :param unshorten: whether to unshorten the URLs in the tweet (and its user's profile)
+        :type unshorten: bool
+        :param resolver: see Parsed
+        :type resolver: unshorten.URLResolver or None
+        :param lazy: whether to put off flattening the metadata, and computing the attributes derived from it
+        (text, hashtags, tokenized_text, munged_text, split_hashes, user, mentions, words, coordinates, unshortened_urls,
+        url_domains, etc.), until they're first used
+        :type lazy: bool
+        :param timeline: see ParsedUser
+        :type timeline: TimelineFetcher, bool or None
+        :param fields: see Parsed (if given, the ParsedUser only keeps the metadata it reads)
+        :type fields: None, bool or iterable of strings
         """
-        super(ParsedTweet, self).__init__(js, unshorten)
+        super(ParsedTweet, self).__init__(js, unshorten, resolver, lazy, fields)
         self.tokenize = tokenize or self.__split__
-        self.text = self.metadata.get('text', '')
-        self.text = self.text.encode('utf8', 'replace').decode('ascii', 'replace')
-        self.tokenized_text = self.tokenize(self.text)
-        self.munge_p = re.compile(r'(@|http://(www\.)?)[\w\d\.\-\?/]+')
-        self.munged_text = re.sub(self.munge_p, '\g<1>xxxxxxxx', self.text)
-        self.hashtags = None
+        self.parse_user = parse_user
+        self.lazy = lazy
+        self.timeline_fetcher = timeline
+        if not lazy:
+            self.evaluate()
+
+    created_at = meta_attribute('created_at')
+
+    @lazy_attribute
+    def text(self):
+        text = self.metadata.get('text', '')
+        return text.encode('utf8', 'replace').decode('ascii', 'replace')
+
+    @lazy_attribute
+    def hashtags(self):
+        hashtags = None
         try:
             hts = self.get_meta("entities_hashtags")
             if hts:
-                self.hashtags = [ht['text'] for ht in hts]
+                hashtags = [ht['text'] for ht in hts]
         except KeyError:
-            self.hashtags = None
-        self.hashtags = self.hashtags or re.findall(r'#[\w_\d]+', self.text)
-        self.split_hashes = self._split_hashes()
-        if parse_user:
-            self.user = ParsedUser(self.get_meta("user"))
+            hashtags = None
+        return hashtags or self.scan.hashtags
+
+    @lazy_attribute
+    def scan(self):
+        return scan_text(self.text)
+
+    @lazy_attribute
+    def tokenized_text(self):
+        if self.tokenize == self.__split__:
+            return self.scan.tokens
+        return self.tokenize(self.text)
+
+    @lazy_attribute
+    def munged_text(self):
+        return self.munge_p.sub('\g<1>xxxxxxxx', self.text)
+
+    @lazy_attribute
+    def split_hashes(self):
+        return self._split_hashes()
+
+    @lazy_attribute
+    def user(self):
+        if self.parse_user:
+            return ParsedUser(self.get_meta("user"), self.unshorten, self.resolver, self.lazy, self.timeline_fetcher,
+                              None if self.fields is None else True)
         else:
-            self.user = self.get_meta("user_id_str")
-        self.created_at = self.get_meta("created_at")
-        self.mentions = self._mentions() + self._ats()
-        self.words = [word for word in self.tokenized_text if not re.match(r'(@|#|http)\S+', word) and any([char.isalnum() for char in word])]
-        self.coordinates = self._coordinates()
+            return self.get_meta("user_id_str")
+
+    @lazy_attribute
+    def mentions(self):
+        return self._mentions() + self._ats()
+
+    @lazy_attribute
+    def words(self):
+        if self.tokenize == self.__split__:
+            return self.scan.words
+        return [word for word in self.tokenized_text if is_word(word)]
+
+    @lazy_attribute
+    def coordinates(self):
+        return self._coordinates()
 
     def __str__(self):
         return "<ParsedTweet: {0}: {1}>".format(self.user.screen_name, self.text)
 
+    @classmethod
+    def batch(cls, jss, tokenize=None, parse_user=True, resolver=None, lazy=False, fields=None):
+        """
+        Parses a batch of tweets, unshortening all their URLs in one pass (see Parsed.unshorten_batch.)
+        :param jss: the JSON representations of the tweets
+        :type jss: iterable of dicts
+        :param tokenize: see __init__
+        :param parse_user: see __init__
+        :param resolver: see Parsed
+        :param lazy: see __init__ (the URLs are unshortened either way)
+        :param fields: see __init__
+        :return: list of ParsedTweet objects
+        """
+        tweets = [cls(js, tokenize, parse_user, unshorten=False, lazy=lazy, fields=fields) for js in jss]
+        return cls.unshorten_batch(tweets, resolver)
+
+    @classmethod
+    def from_lines(cls, lines, filters=None, tokenize=None, parse_user=True, unshorten=False, processes=None,
+                   chunk_size=500, ordered=True, min_parallel=5000):
+        """
+        Parses a stream of tweets (one JSON-encoded tweet per line) into TweetRecords, decoding, filtering and parsing
+        them in a pool of worker processes. Lines are sent to the workers in chunks of chunk_size, and the records come
+        back as each chunk is finished. If there are fewer than min_parallel lines (or processes is 1), everything's
+        done in this process instead, since starting the pool would take longer than the parsing.
+        Lines that aren't valid JSON, or are empty, or fail any of the filters, are skipped.
+        :param lines: the lines to parse
+        :type lines: iterable of strings
+        :param filters: tests the decoded tweets have to pass (see twitterizer.Twitterizer)
+        :type filters: list of functions or None
+        :param tokenize: see __init__
+        :param parse_user: see __init__
+        :param unshorten: whether to unshorten the tweets' URLs (a chunk at a time, see .batch)
+        :type unshorten: bool
+        :param processes: the number of worker processes. Defaults to the number of CPUs.
+        :type processes: int or None
+        :param chunk_size: the number of lines to send to a worker at a time
+        :type chunk_size: int
+        :param ordered: whether the records have to come back in the same order as the lines (if not, chunks are
+        returned as soon as they're done)
+        :type ordered: bool
+        :param min_parallel: the number of lines it takes to make starting a pool worthwhile
+        :type min_parallel: int
+        :return: iterator of TweetRecords
+        """
+        lines = iter(lines)
+        head = list(islice(lines, min_parallel))
+        options = (filters, tokenize, parse_user, unshorten)
+        processes = processes or cpu_count()
+        if len(head) < min_parallel or processes == 1:
+            return chain.from_iterable(parse_chunk(chunk, *options) for chunk in chunks(chain(head, lines), chunk_size))
+        return _parse_in_pool(chain(head, lines), options, processes, chunk_size, ordered)
+
     def __split__(self, s):
         """
         The default tokenization function. Splits a string by whitespace.
@@ -219,7 +575,7 @@ class ParsedTweet(Parsed):
         :type s: string.
         :return: list of strings.
         """
-        return re.split(r'\s+', s)
+        return SPLIT_PAT.split(s)
 
     def _split_hashes(self):
         """
@@ -238,11 +594,7 @@ class ParsedTweet(Parsed):
         on the presence of usernames in the tweet text. This method addresses that.
         :return: list of strings
         """
-        ats = []
-        at_iter = re.finditer(r'@([\w\d]+)', self.text)
-        for at in at_iter:
-            ats.append(at.group(1))
-        return ats
+        return list(self.scan.ats)
 
     def _mentions(self):
         """
@@ -271,37 +623,215 @@ class ParsedTweet(Parsed):
             else:
                 return coordinates
 
+    def to_record(self):
+        """
+        A compact copy of the parts of the tweet that are used downstream (see TweetRecord, below.)
+        :return: TweetRecord
+        """
+        return TweetRecord.from_parsed(self)
+
+
+_parse_options = None  # each ParsedTweet.from_lines worker process's filters, tokenizer, etc.
+
+
+def chunks(iterable, size):
+    """
+    Splits an iterable into lists of (at most) size items.
+    :param iterable: the iterable to split
+    :param size: the chunk size
+    :type size: int
+    :return: iterator of lists
+    """
+    iterable = iter(iterable)
+    while True:
+        chunk = list(islice(iterable, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _init_parse_worker(filters, tokenize, parse_user, unshorten):
+    """
+    Pool initializer for ParsedTweet.from_lines.
+    """
+    global _parse_options
+    _parse_options = (filters, tokenize, parse_user, unshorten)
+
+
+def _parse_chunk(lines):
+    """
+    parse_chunk, with the options the worker process was started with.
+    """
+    return parse_chunk(lines, *_parse_options)
+
+
+def parse_chunk(lines, filters, tokenize, parse_user, unshorten):
+    """
+    Decodes, filters and parses a chunk of lines for ParsedTweet.from_lines (q.v. for the parameters.)
+    :param lines: the lines
+    :type lines: list of strings
+    :return: list of TweetRecords
+    """
+    jss = []
+    for line in lines:
+        try:
+            js = fastjson.loads(line)
+        except ValueError:
+            continue
+        if js and all(test(js) for test in filters or ()):
+            jss.append(js)
+    if unshorten:
+        tweets = ParsedTweet.batch(jss, tokenize, parse_user, lazy=True, fields=True)
+    else:
+        tweets = [ParsedTweet(js, tokenize, parse_user, unshorten=False, lazy=True, fields=True) for js in jss]
+    return [tweet.to_record() for tweet in tweets]
+
+
+def _parse_in_pool(lines, options, processes, chunk_size, ordered):
+    """
+    The multiprocess half of ParsedTweet.from_lines.
+    """
+    pool = Pool(processes, _init_parse_worker, options)
+    try:
+        results = (pool.imap if ordered else pool.imap_unordered)(_parse_chunk, chunks(lines, chunk_size))
+        for records in results:
+            for record in records:
+                yield record
+        pool.close()
+    finally:
+        pool.terminate()  # a no-op if everything's been parsed; otherwise the caller stopped early or something broke
+        pool.join()
+
+
+class TweetRecord(object):
+    """
+    A compact, read-mostly representation of a parsed tweet, for when a lot of them need to be kept in memory at once.
+    Unlike ParsedTweet, it keeps only the extracted fields (in __slots__, so there's no per-instance dict), not the
+    metadata they came from, and its lists are stored as tuples. The user is reduced to a few fields of its own.
+    """
+    __slots__ = ('id', 'created_at', 'text', 'words', 'hashtags', 'split_hashes', 'mentions', 'urls', 'url_domains',
+                 'coordinates', 'user_id', 'screen_name', 'followers_count', 'following_count', 'utc_offset')
+
+    def __init__(self, id, created_at=None, text=u'', words=(), hashtags=(), split_hashes=(), mentions=(), urls=(),
+                 url_domains=(), coordinates=None, user_id=None, screen_name=None, followers_count=None,
+                 following_count=None, utc_offset=None):
+        """
+        :param urls: the tweet's URLs, unshortened if they were unshortened
+        :type urls: tuple of strings
+        The rest are as in ParsedTweet and ParsedUser.
+        """
+        self.id = id
+        self.created_at = created_at
+        self.text = text
+        self.words = tuple(words)
+        self.hashtags = tuple(hashtags)
+        self.split_hashes = tuple(split_hashes)
+        self.mentions = tuple(mentions)
+        self.urls = tuple(urls)
+        self.url_domains = tuple(url_domains)
+        self.coordinates = tuple(coordinates) if coordinates else None
+        self.user_id = user_id
+        self.screen_name = screen_name
+        self.followers_count = followers_count
+        self.following_count = following_count
+        self.utc_offset = utc_offset
+
+    @classmethod
+    def from_parsed(cls, tweet):
+        """
+        :param tweet: the tweet to copy
+        :type tweet: ParsedTweet
+        :return: TweetRecord
+        """
+        user = tweet.user
+        if isinstance(user, Parsed):
+            user_fields = (user.id, user.screen_name, user.followers_count, user.following_count, user.utc_offset)
+        else:
+            user_fields = (user, None, None, None, None)
+        urls = tweet.unshortened_urls or tweet.urls  # the tweet's own URLs if it wasn't unshortened
+        return cls(tweet.id, tweet.created_at, tweet.text, tweet.words, tweet.hashtags, tweet.split_hashes,
+                   tweet.mentions, urls, tweet.get_url_domains(urls), tweet.coordinates, *user_fields)
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, val in zip(self.__slots__, state):
+            setattr(self, name, val)
+
+    def __eq__(self, other):
+        return self.id == other.id
+
+    def __ne__(self, other):
+        return self.id != other.id
+
+    def __repr__(self):
+        return "<TweetRecord: {0}: {1}>".format(self.id, self.text)
+
+    def as_dict(self):
+        """
+        :return: dict ({field: value})
+        """
+        return {name: getattr(self, name) for name in self.__slots__}
+
 
 class ParsedUser(Parsed):
     """
     User equivalent of ParsedTweet class, above. Like ParsedTweet, turns some salient parts of the
     user data returned by Twitter's REST API into attributes, and leaves the rest available in
-    .metadata. Additional functionality includes retrieving the user's most recent tweets and
-    an attempt to get the user's UTC offset and timezone.
+    .metadata. Additional functionality includes retrieving the user's most recent tweets (on request,
+    see TimelineFetcher, below) and an attempt to get the user's UTC offset and timezone.
     """
+    always_lazy = Parsed.always_lazy + ('timeline',)
+    meta_fields = Parsed.meta_fields | frozenset(['created_at', 'description', 'followers_count', 'friends_count',
+                                                  'lang', 'location', 'name', 'screen_name', 'statuses_count',
+                                                  'time_zone', 'utc_offset', 'verified'])
 
-    def __init__(self, js, unshorten=True):
+    def __init__(self, js, unshorten=True, resolver=None, lazy=False, timeline=None, fields=None):
         """
         :param js: JSON representation of the user, as returned by Twitter's API
         :type js: dict
         :param unshorten: whether to unshorten the URLs contained in the user's profile
         :type unshorten: bool
+        :param resolver: see Parsed
+        :type resolver: unshorten.URLResolver or None
+        :param lazy: whether to put off flattening the metadata, and computing the attributes derived from it, until
+        they're first used
+        :type lazy: bool
+        :param timeline: the fetcher to get the user's timeline from the first time .timeline is used, or True to use
+            the shared one (see default_timeline_fetcher.) By default, .timeline is empty and no requests are made.
+        :type timeline: TimelineFetcher, bool or None
+        :param fields: see Parsed
+        :type fields: None, bool or iterable of strings
         """
-        super(ParsedUser, self).__init__(js, unshorten)
-        self.created_at = self.get_meta("created_at")
-        self.description = self.get_meta("description")
-        self.followers_count = self.get_meta("followers_count")
-        self.following_count = self.get_meta("friends_count")
-        self.lang = self.get_meta("lang")
-        self.location = self.get_meta("location")
-        self.name = self.get_meta("name")
-        self.screen_name = self.get_meta("screen_name")
-        self.statuses_count = self.get_meta("statuses_count")
-        self.tz = self.get_meta("time_zone")
-        self.utc_offset = self._utc_offset()
-        self.utc_tz = self._utc_tz()
-        self.verified = self.get_meta("verified")
-        self.timeline = self._timeline()
+        super(ParsedUser, self).__init__(js, unshorten, resolver, lazy, fields)
+        self.timeline_fetcher = default_timeline_fetcher() if timeline is True else timeline or None
+        if not lazy:
+            self.evaluate()
+
+    created_at = meta_attribute('created_at')
+    description = meta_attribute('description')
+    followers_count = meta_attribute('followers_count')
+    following_count = meta_attribute('following_count', 'friends_count')
+    lang = meta_attribute('lang')
+    location = meta_attribute('location')
+    name = meta_attribute('name')
+    screen_name = meta_attribute('screen_name')
+    statuses_count = meta_attribute('statuses_count')
+    tz = meta_attribute('tz', 'time_zone')
+    verified = meta_attribute('verified')
+
+    @lazy_attribute
+    def utc_offset(self):
+        return self._utc_offset()
+
+    @lazy_attribute
+    def utc_tz(self):
+        return self._utc_tz()
+
+    @lazy_attribute
+    def timeline(self):
+        return self._timeline()
 
     def __str__(self):
         return "<ParsedUser: {0}>".format(self.screen_name)
@@ -316,7 +846,7 @@ class ParsedUser(Parsed):
         if offset:
             return int(offset)
         else:
-            m = re.search(r'\d{2}:\d{2}:\d{2} ((\+|-)\d{4}) \d{4}', self.created_at)
+            m = UTC_PAT.search(self.created_at)
             if m:
                 offset = int(m.group(1))
         return offset
@@ -333,21 +863,202 @@ class ParsedUser(Parsed):
 
     def _timeline(self):
         """
-        Retrieve the user's most recent tweets.
-        NB: This method will retrieve AT MOST the user's 200 most recent tweets (as per the
-            count parameter in the Twitter.statuses.user_timeline call.) See the information
-            on the 'count' parameter at https://dev.twitter.com/docs/api/1.1/get/statuses/user_timeline
-            for more information. See also https://dev.twitter.com/docs/working-with-timelines
-            if you'd like to refactor this method to retrieve more tweets.
+        Retrieve the user's most recent tweets, if the user was given a TimelineFetcher (q.v.)
         :return: list of ParsedTweet objects or empty list
         """
+        if self.timeline_fetcher is None:
+            return []
+        return self.timeline_fetcher.fetch(self.id)
+
+
+class TimelineFetcher(object):
+    """
+    Retrieves users' most recent tweets. Timelines are kept in a bounded cache for ttl seconds, and can be fetched
+    in batches (see .prefetch), several at a time, with all the batch's URLs unshortened in one pass. Requests go
+    through a RateLimiter (see ratelimit.RateLimiter; by default the shared one, so that they count against the same
+    limits as everything else that uses the API.) Each fetching thread has its own requests.Session, since sessions
+    aren't safe to share between threads.
+    NB: This will retrieve AT MOST each user's 200 most recent tweets (as per the count parameter in the
+        Twitter.statuses.user_timeline call.) See the information on the 'count' parameter at
+        https://dev.twitter.com/docs/api/1.1/get/statuses/user_timeline for more information. See also
+        https://dev.twitter.com/docs/working-with-timelines if you'd like to refactor this to retrieve more tweets.
+    """
+
+    def __init__(self, url=TIMELINE_URL, auth=None, limiter=None, ttl=3600, max_cached=10000, workers=4, count=200,
+                 unshorten=True, resolver=None, lazy=False):
+        """
+        :param url: the user_timeline endpoint
+        :type url: str
+        :param auth: the credentials to use (defaults to auth._AUTH)
+        :type auth: requests_oauthlib.OAuth1 or None
+        :param limiter: the rate limiter to make requests through (see ratelimit.default_limiter if None)
+        :type limiter: ratelimit.RateLimiter or None
+        :param ttl: how long to keep timelines for, in seconds
+        :type ttl: int
+        :param max_cached: the maximum number of timelines to keep
+        :type max_cached: int
+        :param workers: the maximum number of timelines to fetch at once (the limiter may allow fewer; see
+            ratelimit.RateLimiter's max_concurrent)
+        :type workers: int
+        :param count: the number of tweets to ask for per timeline
+        :type count: int
+        :param unshorten: whether to unshorten the URLs in the timelines' tweets
+        :type unshorten: bool
+        :param resolver: see Parsed
+        :type resolver: unshorten.URLResolver or None
+        :param lazy: see ParsedTweet
+        :type lazy: bool
+        """
+        self.url = url
+        self.auth = auth
+        self.limiter = limiter or default_limiter()
+        self.ttl = ttl
+        self.max_cached = max_cached
+        self.workers = workers
+        self.count = count
+        self.unshorten = unshorten
+        self.resolver = resolver
+        self.lazy = lazy
+        self.local = local()
+        self.cache = OrderedDict()  # user id: (expiry time, timeline)
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def cached(self, user_id):
+        """
+        The user's cached timeline, if there is one.
+        :param user_id: the user's id
+        :type user_id: str
+        :return: list of ParsedTweet objects or None
+        """
+        with self.lock:
+            entry = self.cache.pop(user_id, None)
+            if entry is None or entry[0] <= time():
+                self.misses += 1
+                return None
+            self.cache[user_id] = entry
+            self.hits += 1
+            return entry[1]
+
+    def remember(self, user_id, timeline):
+        with self.lock:
+            self.cache.pop(user_id, None)
+            self.cache[user_id] = (time() + self.ttl, timeline)
+            if len(self.cache) > self.max_cached:
+                self.cache.popitem(last=False)
+
+    def session(self):
+        """
+        The calling thread's session.
+        :return: requests.Session
+        """
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    def request(self, user_id):
+        """
+        Asks the API for a user's timeline.
+        :param user_id: the user's id
+        :type user_id: str
+        :return: list of dicts (JSON representations of tweets) or None if the request failed
+        """
+        payload = {"user_id": user_id, "count": self.count, "trim_user": True, "exclude_replies": True,
+                   "include_rts": False}
         try:
-            payload = {"user_id": self.id, "count": 200, "trim_user": True, "exclude_replies": True,
-                       "include_rts": False}
-            req = requests.get(url="https://api.twitter.com/1.1/statuses/user_timeline.json", auth=_AUTH, params=payload)
+            req = self.limiter.get(self.url, session=self.session(), auth=self.auth or _AUTH, params=payload)
+            if req.status_code in (401, 404):  # protected or deleted accounts won't have a timeline next time either
+                return []
             req.raise_for_status()
-            timeline = req.json()
-            return [ParsedTweet(t, parse_user=False) for t in timeline]
-        except requests.HTTPError as e:
+            return req.json()
+        except (requests.RequestException, ValueError) as e:
             print e
-            return []
+            return None
+
+    def prefetch(self, user_ids):
+        """
+        Fetches the timelines of a batch of users that aren't already cached.
+        :param user_ids: the users' ids
+        :type user_ids: iterable of strs
+        :return: dict ({user id: list of ParsedTweet objects})
+        """
+        timelines = {}
+        missing = []
+        for user_id in set(user_ids):
+            timeline = self.cached(user_id)
+            if timeline is None:
+                missing.append(user_id)
+            else:
+                timelines[user_id] = timeline
+        if not missing:
+            return timelines
+        if len(missing) == 1:
+            responses = [self.request(missing[0])]
+        else:
+            pool = ThreadPool(min(self.workers, len(missing)))
+            try:
+                responses = pool.map(self.request, missing)
+            finally:
+                pool.close()
+        fetched = [(user_id, js) for user_id, js in zip(missing, responses) if js is not None]
+        jss = [t for _, js in fetched for t in js]
+        if self.unshorten:
+            tweets = ParsedTweet.batch(jss, parse_user=False, resolver=self.resolver, lazy=self.lazy)
+        else:
+            tweets = [ParsedTweet(t, parse_user=False, unshorten=False, lazy=self.lazy) for t in jss]
+        i = 0
+        for user_id, js in fetched:
+            timelines[user_id] = tweets[i:i + len(js)]
+            i += len(js)
+            self.remember(user_id, timelines[user_id])
+        for user_id in missing:
+            timelines.setdefault(user_id, [])  # failed requests aren't cached, so they'll be tried again next time
+        return timelines
+
+    def fetch(self, user_id):
+        """
+        A user's timeline.
+        :param user_id: the user's id
+        :type user_id: str
+        :return: list of ParsedTweet objects
+        """
+        return self.prefetch([user_id])[user_id]
+
+    def fetch_users(self, users):
+        """
+        Fetches the timelines of a batch of ParsedUsers and sets their .timeline attributes.
+        :param users: the users
+        :type users: iterable of ParsedUser objects
+        :return: None
+        """
+        users = list(users)
+        timelines = self.prefetch(user.id for user in users)
+        for user in users:
+            user.timeline = timelines[user.id]
+
+    def report(self):
+        """
+        Print the cache's hit rate.
+        :return: None
+        """
+        total = self.hits + self.misses
+        print "Timeline cache: {hits} hits, {misses} misses ({rate:.1f}% hit rate)".format(
+            hits=self.hits, misses=self.misses, rate=100.0 * self.hits / total if total else 0)
+
+
+_TIMELINE_FETCHER = None
+_TIMELINE_FETCHER_LOCK = Lock()
+
+
+def default_timeline_fetcher():
+    """
+    The TimelineFetcher shared by ParsedUsers created with timeline=True.
+    :return: TimelineFetcher
+    """
+    global _TIMELINE_FETCHER
+    with _TIMELINE_FETCHER_LOCK:
+        if _TIMELINE_FETCHER is None:
+            _TIMELINE_FETCHER = TimelineFetcher()
+    return _TIMELINE_FETCHER
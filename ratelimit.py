@@ -0,0 +1,174 @@
+#coding=utf8
+__author__ = 'Sam Raker'
+
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Condition, Lock
+from time import time
+from urlparse import urlparse
+
+import requests
+
+
+class RateLimiter(object):
+    """
+    Keeps calls to the Twitter API within its rate limits, and can be shared between threads. Each endpoint's remaining
+    calls and reset time are taken from the x-rate-limit-* headers of its responses; until an endpoint's first response
+    comes back, it's assumed to allow default_limit calls per window. Calls to an endpoint that has run out wait until
+    its window resets, and no more than max_concurrent calls to any one endpoint are in flight at once. If paced, calls
+    are spread out evenly over what's left of the window instead, so the budget lasts exactly until the reset rather
+    than being used up in a burst and then waited out.
+    See https://dev.twitter.com/docs/rate-limiting/1.1 for more information.
+    """
+
+    def __init__(self, default_limit=180, window=900, max_concurrent=4, paced=False, verbose=True):
+        """
+        :param default_limit: the number of calls per window to assume for endpoints we haven't heard from yet
+        :type default_limit: int
+        :param window: the length of a rate limit window, in seconds
+        :type window: int
+        :param max_concurrent: the maximum number of concurrent calls to any one endpoint
+        :type max_concurrent: int
+        :param paced: whether to spread calls out over each window
+        :type paced: bool
+        :param verbose: whether to print a notice when waiting for a window to reset
+        :type verbose: bool
+        """
+        self.default_limit = default_limit
+        self.window = window
+        self.max_concurrent = max_concurrent
+        self.paced = paced
+        self.verbose = verbose
+        self.cond = Condition()
+        self.limits = {}  # endpoint: [remaining calls, reset time]
+        self.next_call = {}  # endpoint: earliest time for the next call, if paced
+        self.slots = {}  # endpoint: semaphore
+        self.waited = 0.0
+
+    @staticmethod
+    def endpoint(url):
+        """
+        The endpoint a URL belongs to.
+        :param url: the URL
+        :type url: str
+        :return: str
+        """
+        return urlparse(url).path
+
+    def get_limit(self, endpoint):
+        limit = self.limits.get(endpoint)
+        if limit is None or limit[1] <= time():
+            limit = self.limits[endpoint] = [self.default_limit, time() + self.window]
+        return limit
+
+    def wait(self, endpoint):
+        """
+        Blocks until a call to endpoint is allowed, and counts it against the endpoint's remaining calls.
+        :param endpoint: the endpoint
+        :type endpoint: str
+        :return: None
+        """
+        with self.cond:
+            while True:
+                limit = self.get_limit(endpoint)
+                if limit[0] > 0:
+                    now = time()
+                    if self.paced:
+                        next_call = self.next_call.get(endpoint, now)
+                        if next_call > now:
+                            self.cond.wait(next_call - now)
+                            self.waited += time() - now
+                            continue
+                        self.next_call[endpoint] = now + max(limit[1] - now, 0) / limit[0]
+                    limit[0] -= 1
+                    return
+                secs = limit[1] - time()
+                if self.verbose:
+                    print "Rate limit reached for {}, waiting {:.0f}s".format(endpoint, secs)
+                start = time()
+                self.cond.wait(max(secs, 0))
+                self.waited += time() - start
+
+    @contextmanager
+    def slot(self, endpoint):
+        """
+        Context manager to make a call to endpoint in.
+        :param endpoint: the endpoint
+        :type endpoint: str
+        """
+        with self.cond:
+            sem = self.slots.get(endpoint)
+            if sem is None:
+                sem = self.slots[endpoint] = BoundedSemaphore(self.max_concurrent)
+        with sem:
+            self.wait(endpoint)
+            yield
+
+    def update(self, endpoint, response):
+        """
+        Updates an endpoint's limits from a response.
+        :param endpoint: the endpoint
+        :type endpoint: str
+        :param response: the response
+        :type response: requests.Response
+        :return: None
+        """
+        remaining = response.headers.get('x-rate-limit-remaining')
+        reset = response.headers.get('x-rate-limit-reset')
+        with self.cond:
+            limit = self.get_limit(endpoint)
+            if reset is not None:
+                limit[1] = float(reset)
+            if remaining is not None:
+                limit[0] = int(remaining)
+            if response.status_code == 429:
+                limit[0] = 0
+            self.cond.notify_all()
+
+    def get(self, url, session=None, **kwargs):
+        """
+        Makes a rate-limited GET request, waiting out the window and trying again if the limit was exceeded anyway.
+        :param url: the URL
+        :type url: str
+        :param session: the session to make the request with
+        :type session: requests.Session or None
+        :param kwargs: passed on to requests.get
+        :return: requests.Response
+        """
+        endpoint = self.endpoint(url)
+        get = session.get if session is not None else requests.get
+        while True:
+            with self.slot(endpoint):
+                r = get(url, **kwargs)
+                self.update(endpoint, r)
+            if r.status_code != 429:
+                return r
+            r.close()
+
+    def report(self):
+        """
+        Print the known limits and the time spent waiting for them.
+        :return: None
+        """
+        with self.cond:
+            for endpoint, (remaining, reset) in sorted(self.limits.iteritems()):
+                print "{endpoint}: {remaining} calls left, resets in {secs:.0f}s".format(endpoint=endpoint,
+                                                                                       remaining=remaining,
+                                                                                       secs=max(reset - time(), 0))
+            print "Waited {:.1f}s for rate limits".format(self.waited)
+
+
+_LIMITER = None
+_LIMITER_LOCK = Lock()
+
+
+def default_limiter():
+    """
+    A (paced) RateLimiter shared by everything that doesn't bring its own, so that it all counts against the same
+    limits.
+    :return: RateLimiter
+    """
+    global _LIMITER
+    with _LIMITER_LOCK:
+        if _LIMITER is None:
+            _LIMITER = RateLimiter(paced=True)
+    return _LIMITER
@@ -1,8 +1,10 @@
 #coding=utf8
 __author__ = 'Sam Raker'
 
-import json
+from itertools import islice
+
 from parsed import ParsedTweet, ParsedUser
+from tools import read_jsonl, read_lines
 
 
 def tweets_from_json(fname):
@@ -14,13 +16,11 @@ def tweets_from_json(fname):
     :return: list of ParsedTweet objects
     """
     parsed_tweets = []
-    with open(fname) as f:
-        for x in f.readlines():
-            js = json.loads(x)
-            if len(js) == 2:
-                parsed_tweets.append(ParsedTweet(js[0],js[1]))
-            else:
-                parsed_tweets.append(ParsedTweet(js=js))
+    for _, js in read_jsonl(fname):
+        if len(js) == 2:
+            parsed_tweets.append(ParsedTweet(js[0],js[1]))
+        else:
+            parsed_tweets.append(ParsedTweet(js=js))
     return parsed_tweets
 
 
@@ -32,28 +32,36 @@ def users_from_json(fname):
     :type fname: string
     :return: list of ParsedUser objects
     """
-    with open(fname) as f:
-        return [ParsedUser(json.loads(x)) for x in f.readlines()]
+    return [ParsedUser(js) for _, js in read_jsonl(fname)]
 
 
-def tweet_gen_from_json(fname, tokenize=None, parse_user=True, unshorten=True):
+def tweet_gen_from_json(fname, tokenize=None, parse_user=True, unshorten=True, batch_size=None, resolver=None):
     """
     Reads a JSON file containing 1 tweet (as JSON) or serialized ParsedTweet per line and returns
     a generator that converts the files contents into ParsedTweet objects.
     :param fname: path to the JSON file to read
     :type fname: string
+    :param batch_size: if unshortening, parse this many tweets at a time and unshorten all their URLs in one pass
+        (see ParsedTweet.batch)
+    :type batch_size: int or None
+    :param resolver: see parsed.Parsed
+    :type resolver: unshorten.URLResolver or None
     :return: generator function
     """
     def tweet_gen(fname):
-        i = 0
-        with open(fname) as f:
-            unparsed = f.readlines()
-        while i < len(unparsed):
-            try:
-                yield ParsedTweet(json.loads(unparsed[i]), tokenize, parse_user, unshorten)
-                i += 1
-            except ValueError:
-                continue
+        for _, js in read_jsonl(fname, skip_errors=True):
+            yield ParsedTweet(js, tokenize, parse_user, unshorten, resolver)
+
+    def batch_gen(fname):
+        jss = (js for _, js in read_jsonl(fname, skip_errors=True))
+        while True:
+            batch = list(islice(jss, batch_size))
+            if not batch:
+                break
+            for tweet in ParsedTweet.batch(batch, tokenize, parse_user, resolver):
+                yield tweet
+    if unshorten and batch_size:
+        return batch_gen(fname)
     return tweet_gen(fname)
 
 
@@ -66,13 +74,19 @@ def user_gen_from_json(fname, unshorten=True):
     :return: generator function
     """
     def user_gen(fname):
-        i = 0
-        with open(fname) as f:
-            unparsed = f.readlines()
-        while i < len(unparsed):
-            try:
-                yield ParsedTweet(json.loads(unparsed[i]), unshorten)
-                i += 1
-            except ValueError:
-                continue
+        for _, js in read_jsonl(fname, skip_errors=True):
+            yield ParsedUser(js, unshorten)
     return user_gen(fname)
+
+
+def records_from_json(fname, filters=None, tokenize=None, parse_user=True, unshorten=False, processes=None,
+                      ordered=True):
+    """
+    Reads a JSON file containing 1 tweet (as JSON) per line and parses it into TweetRecords using a pool of worker
+    processes (see ParsedTweet.from_lines for more information.)
+    :param fname: path to the JSON file to read
+    :type fname: string
+    :return: iterator of TweetRecords
+    """
+    return ParsedTweet.from_lines((line for _, line in read_lines(fname)), filters, tokenize, parse_user, unshorten,
+                                  processes, ordered=ordered)
@@ -0,0 +1,2 @@
+#coding=utf8
+__author__ = 'Sam Raker'
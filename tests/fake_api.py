@@ -0,0 +1,85 @@
+#coding=utf8
+__author__ = 'Sam Raker'
+
+import BaseHTTPServer
+import socket
+import SocketServer
+import sys
+from threading import Lock, Thread
+from time import time
+from urlparse import parse_qsl, urlparse
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], socket.error):  # i.e. the client didn't just hang up
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class FakeAPIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        api = self.server.api
+        parsed = urlparse(self.path)
+        params = dict(parse_qsl(parsed.query))
+        with api.lock:
+            api.requests.append((time(), parsed.path, params))
+            api.in_flight += 1
+            api.max_in_flight = max(api.max_in_flight, api.in_flight)
+        try:
+            status, headers, body = api.respond(parsed.path, params)
+            self.send_response(status)
+            for header, val in headers.iteritems():
+                self.send_header(header, str(val))
+            self.end_headers()
+            for chunk in [body] if isinstance(body, basestring) else body:
+                self.wfile.write(chunk)
+                self.wfile.flush()
+        except socket.error:  # the client hung up
+            pass
+        finally:
+            with api.lock:
+                api.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeAPI(object):
+    """
+    A local stand-in for the Twitter API (or anything else spoken to over HTTP), for the tests.
+    Serves GET requests on localhost with a function of the request's path and query parameters, returning a status
+    code, a dict of headers and a body. The body can be a string, or an iterable of strings, which are written (and
+    flushed) one at a time, e.g. to fake a streaming endpoint. The requests made are kept in .requests.
+    """
+
+    def __init__(self, respond):
+        """
+        :param respond: makes the response to a request
+        :type respond: function (str, dict) -> (int, dict, str or iterable of strs)
+        """
+        self.respond = respond
+        self.requests = []  # (time, path, params) tuples
+        self.lock = Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeAPIHandler)
+        self.server.api = self
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{port}{path}'.format(port=self.server.server_address[1], path=path)
+
+    def params(self, key):
+        """
+        The values of a query parameter across all the requests so far, in order.
+        """
+        with self.lock:
+            return [params.get(key) for _, _, params in self.requests]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
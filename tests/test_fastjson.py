@@ -0,0 +1,38 @@
+#coding=utf8
+__author__ = 'Sam Raker'
+
+import json
+import unittest
+
+import fastjson
+
+TWEET = {'id_str': '123', 'text': u'caf\xe9 \U0001f600', 'coordinates': [-73.98765432109876, 40.1234567890123],
+         'retweet_count': 2 ** 40, 'entities': {'urls': [], 'hashtags': [{'text': 'x'}]}, 'geo': None}
+
+
+class FastJSONTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = fastjson.backend
+
+    def tearDown(self):
+        fastjson.set_backend(self.backend)
+
+    def test_backends_agree(self):
+        line = json.dumps(TWEET)
+        for name in fastjson.BACKENDS:
+            self.assertEqual(fastjson.set_backend(name), name)
+            self.assertEqual(fastjson.loads(line), TWEET)  # floats included
+            self.assertEqual(json.loads(fastjson.dumps(TWEET)), TWEET)
+
+    def test_fields(self):
+        line = json.dumps(TWEET)
+        self.assertEqual(fastjson.loads(line, ('id_str', 'geo', 'missing')), {'id_str': '123', 'geo': None})
+        self.assertEqual(fastjson.loads('[1, 2]', ('id_str',)), [1, 2])
+
+    def test_default_backend(self):
+        self.assertEqual(fastjson.set_backend(), next(name for name in fastjson.PREFERENCE if name in fastjson.BACKENDS))
+        self.assertRaises(ValueError, fastjson.set_backend, 'yaml')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#coding=utf8
+__author__ = 'Sam Raker'
+
+import json
+from threading import Lock
+from time import sleep, time
+import unittest
+
+from parsed import ParsedTweet, TimelineFetcher, TweetRecord
+from ratelimit import RateLimiter, default_limiter
+from tests.fake_api import FakeAPI
+
+TIMELINE_PATH = '/1.1/statuses/user_timeline.json'
+
+
+def status(tweet_id, text):
+    return {'id_str': tweet_id, 'text': text, 'created_at': 'Mon Oct 10 10:00:00 +0000 2016',
+            'entities': {'urls': [], 'hashtags': [], 'user_mentions': []}}
+
+
+class TweetRecordTest(unittest.TestCase):
+    def test_urls_and_domains_line_up(self):
+        js = status('5', u'see http://t.co/a and http://t.co/b')
+        js['entities']['urls'] = [{'url': 'http://t.co/a', 'expanded_url': 'http://example.com/a'},
+                                  {'url': 'http://t.co/b', 'expanded_url': None}]
+        record = TweetRecord.from_parsed(ParsedTweet(js, parse_user=False, unshorten=False))
+        self.assertEqual(record.urls, ('http://example.com/a', 'http://t.co/b'))
+        self.assertEqual(record.url_domains, ('example.com', 't.co'))
+
+
+class TimelineFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.timelines = {'1': [status('11', u'one'), status('12', u'two')], '2': [status('21', u'three')]}
+        self.statuses = {'404': [404], 'flaky': [500, 200], 'limited': [429, 200]}  # user id: statuses, in turn
+        self.limit = [180, time() + 900]  # remaining calls, reset time
+        self.delay = 0
+        self.lock = Lock()
+        self.api = FakeAPI(self.respond)
+
+    def tearDown(self):
+        self.api.close()
+
+    def respond(self, path, params):
+        self.assertEqual(path, TIMELINE_PATH)
+        sleep(self.delay)
+        user_id = params['user_id']
+        with self.lock:
+            statuses = self.statuses.get(user_id)
+            code = statuses.pop(0) if statuses else 200
+            if code == 429:
+                self.limit[0] = 0
+            elif self.limit[0] > 0:
+                self.limit[0] -= 1
+            headers = {'x-rate-limit-remaining': self.limit[0], 'x-rate-limit-reset': self.limit[1]}
+        body = json.dumps(self.timelines.get(user_id, [status('99', user_id)]) if code == 200 else {'errors': []})
+        return code, headers, body
+
+    def fetcher(self, **kwargs):
+        kwargs.setdefault('limiter', RateLimiter(verbose=False))
+        return TimelineFetcher(url=self.api.url(TIMELINE_PATH), auth=lambda r: r, unshorten=False, **kwargs)
+
+    def ids(self, timeline):
+        return [tweet.id for tweet in timeline]
+
+    def test_prefetch(self):
+        fetcher = self.fetcher()
+        timelines = fetcher.prefetch(['1', '2', '1'])
+        self.assertEqual(self.ids(timelines['1']), ['11', '12'])
+        self.assertEqual(self.ids(timelines['2']), ['21'])
+        self.assertEqual(sorted(self.api.params('user_id')), ['1', '2'])
+        self.assertEqual(self.api.params('count'), ['200', '200'])
+
+    def test_cache(self):
+        fetcher = self.fetcher()
+        fetcher.prefetch(['1', '2'])
+        self.assertEqual(self.ids(fetcher.fetch('1')), ['11', '12'])
+        self.assertEqual(len(self.api.requests), 2)
+        self.assertEqual(fetcher.hits, 1)
+        expired = self.fetcher(ttl=0)
+        expired.fetch('1')
+        expired.fetch('1')
+        self.assertEqual(len(self.api.requests), 4)
+
+    def test_bounded_cache(self):
+        fetcher = self.fetcher(max_cached=2)
+        for user_id in ('1', '2', '3'):
+            fetcher.fetch(user_id)
+        self.assertEqual(fetcher.cache.keys(), ['2', '3'])
+
+    def test_failures(self):
+        fetcher = self.fetcher()
+        self.assertEqual(fetcher.fetch('404'), [])
+        self.assertEqual(fetcher.fetch('404'), [])  # gone accounts are cached...
+        self.assertEqual(fetcher.fetch('flaky'), [])
+        self.assertEqual(self.ids(fetcher.fetch('flaky')), ['99'])  # ...but failed requests are tried again
+        self.assertEqual(self.api.params('user_id'), ['404', 'flaky', 'flaky'])
+
+    def test_rate_limited(self):
+        self.limit[1] = time() + 0.5
+        fetcher = self.fetcher()
+        start = time()
+        self.assertEqual(self.ids(fetcher.fetch('limited')), ['99'])  # waits for the reset and tries again
+        self.assertGreaterEqual(time() - start, 0.4)
+        self.assertEqual(self.api.params('user_id'), ['limited', 'limited'])
+
+    def test_exhausted(self):
+        self.limit[:] = [1, time() + 0.5]
+        fetcher = self.fetcher()
+        fetcher.fetch('1')
+        fetcher.fetch('2')  # no calls left, so this one has to wait for the reset
+        self.assertGreaterEqual(self.api.requests[1][0], self.limit[1] - 0.01)
+        self.assertGreater(fetcher.limiter.waited, 0.3)
+
+    def test_concurrency(self):
+        self.delay = 0.1
+        fetcher = self.fetcher(workers=4, limiter=RateLimiter(max_concurrent=2, verbose=False))
+        timelines = fetcher.prefetch(str(i) for i in xrange(3, 9))
+        self.assertEqual(len(timelines), 6)
+        self.assertEqual(self.api.max_in_flight, 2)
+
+    def test_shared_limiter(self):
+        fetchers = [TimelineFetcher(url=self.api.url(TIMELINE_PATH), workers=workers) for workers in (2, 8)]
+        self.assertIs(fetchers[0].limiter, default_limiter())
+        self.assertIs(fetchers[1].limiter, default_limiter())
+
+
+if __name__ == '__main__':
+    unittest.main()
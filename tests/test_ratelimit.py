@@ -0,0 +1,89 @@
+#coding=utf8
+__author__ = 'Sam Raker'
+
+from threading import Lock, Thread
+from time import sleep, time
+import unittest
+
+from ratelimit import RateLimiter
+from tests.fake_api import FakeAPI
+
+PATH = '/1.1/search/tweets.json'
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.limit = None  # [remaining calls, reset time], or None to send no x-rate-limit-* headers
+        self.statuses = []  # to respond with, in turn, before 200s
+        self.delay = 0
+        self.lock = Lock()
+        self.api = FakeAPI(self.respond)
+
+    def tearDown(self):
+        self.api.close()
+
+    def respond(self, path, params):
+        sleep(self.delay)
+        with self.lock:
+            status = self.statuses.pop(0) if self.statuses else 200
+            if self.limit is None:
+                return status, {}, ''
+            if status == 429:
+                self.limit[0] = 0
+            elif self.limit[0] > 0:
+                self.limit[0] -= 1
+            return status, {'x-rate-limit-remaining': self.limit[0], 'x-rate-limit-reset': self.limit[1]}, ''
+
+    def times(self, limiter, calls, threads=1):
+        """
+        The times the fake API got each call, relative to the first, after making them from some threads at once.
+        """
+        def call():
+            for _ in xrange(calls // threads):
+                self.assertEqual(limiter.get(self.api.url(PATH)).status_code, 200)
+
+        workers = [Thread(target=call) for _ in xrange(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        times = sorted(t for t, _, _ in self.api.requests)
+        return [t - times[0] for t in times]
+
+    def test_unpaced_bursts(self):
+        times = self.times(RateLimiter(default_limit=5, window=1, verbose=False), 5)
+        self.assertLess(times[-1], 0.15)
+
+    def test_paced(self):
+        self.limit = [5, time() + 1]
+        limiter = RateLimiter(default_limit=5, window=1, paced=True, verbose=False)
+        times = self.times(limiter, 5, threads=5)
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        self.assertTrue(all(gap > 0.15 for gap in gaps), gaps)
+        self.assertLess(times[-1], 1)
+        self.assertEqual(limiter.limits[PATH][0], 0)
+
+    def test_waits_for_reset(self):
+        self.limit = [2, time() + 0.5]
+        limiter = RateLimiter(default_limit=5, window=1, verbose=False)
+        times = self.times(limiter, 3)
+        self.assertLess(times[1], 0.15)
+        self.assertGreater(times[2], 0.35)
+        self.assertGreater(limiter.waited, 0.3)
+
+    def test_retries_after_429(self):
+        self.limit = [5, time() + 0.5]
+        self.statuses = [429]
+        limiter = RateLimiter(default_limit=5, window=1, verbose=False)
+        times = self.times(limiter, 1)
+        self.assertEqual(len(times), 2)
+        self.assertGreater(times[1], 0.35)
+
+    def test_max_concurrent(self):
+        self.delay = 0.1
+        self.times(RateLimiter(max_concurrent=2, verbose=False), 8, threads=8)
+        self.assertEqual(self.api.max_in_flight, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
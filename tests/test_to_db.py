@@ -0,0 +1,229 @@
+#coding=utf8
+__author__ = 'Sam Raker'
+
+from os.path import join
+import re
+from shutil import rmtree
+import sqlite3
+from tempfile import mkdtemp
+import unittest
+
+from to_db import ParentTracker, PKAllocator, TSVWriter, TSV_TABLES, munge_word, process_fil, read_checkpoint
+
+
+class FakeRedis(object):
+    """
+    In-memory stand-in for the bits of SafeRedis a PKAllocator uses.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def incrby(self, name, amount=1):
+        self.data[name] = int(self.data.get(name, 0)) + amount
+        return self.data[name]
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def setnx_many(self, pairs):
+        claimed = []
+        for key, val in pairs:
+            claimed.append(key not in self.data)
+            self.data.setdefault(key, str(val))
+        return claimed
+
+
+TSV_ESCAPES = {'\\': '\\', 't': '\t', 'n': '\n', 'r': '\r', '0': '\0'}
+
+
+def read_field(field):
+    """
+    Undoes to_db.tsv_field, the way LOAD DATA INFILE does.
+    """
+    if field == '\\N':
+        return None
+    return re.sub(r'\\(.)', lambda m: TSV_ESCAPES[m.group(1)], field).decode('utf8')
+
+
+def load_sqlite(outdir):
+    """
+    Loads a TSVWriter's files into an in-memory SQLite db, skipping rows whose keys already exist, like load_tsv.
+    """
+    db = sqlite3.connect(':memory:')
+    for table, columns in TSV_TABLES:
+        key = columns[:1] if len(columns) != 2 or table in ('hashtag', 'tag_word', 'word') else columns
+        db.execute('CREATE TABLE {table} ({columns}, PRIMARY KEY ({key}))'.format(
+            table=table, columns=', '.join(columns), key=', '.join(key)))
+        with open(join(outdir, '{table}.tsv'.format(table=table))) as f:
+            for line in f:
+                row = [read_field(field) for field in line.rstrip('\n').split('\t')]
+                db.execute('INSERT OR IGNORE INTO {table} VALUES ({marks})'.format(
+                    table=table, marks=', '.join('?' * len(columns))), row)
+    return db
+
+
+def tweet(tweet_id, user_id, words, hashtags=(), urls=(), user_urls=(), followers=10, offset=-18000):
+    """
+    A tweet in the [tweet id, [tweet data, user data]] form that process_json takes.
+    """
+    tweet_data = {'user': user_id, 'hour': 13, 'day': '-1', 'is_weekday': 1, 'words': list(words),
+                  'hashtags': list(hashtags), 'split_hashtags': [h.split('_') for h in hashtags],
+                  'urls': [url for url, _ in urls], 'domains': [domain for _, domain in urls]}
+    user_data = {'followers': followers, 'following': 5, 'follow_ratio': 0.5, 'offset': offset,
+                 'urls': [url for url, _ in user_urls], 'domains': [domain for _, domain in user_urls]}
+    return [tweet_id, [tweet_data, user_data]]
+
+
+class PKAllocatorTest(unittest.TestCase):
+    def test_resolve(self):
+        pks = PKAllocator(FakeRedis(), block_size=2, max_cached=2)
+        resolved = pks.resolve([('word', u'a'), ('word', u'b'), ('hashtag', u'a'), ('word', u'a'), ('word', u'c')])
+        self.assertEqual(resolved, {('word', u'a'): 1, ('word', u'b'): 2, ('hashtag', u'a'): 1, ('word', u'c'): 3})
+        self.assertEqual(pks.resolve([('word', u'c'), ('word', u'a')]), {('word', u'c'): 3, ('word', u'a'): 1})
+        self.assertEqual((pks.hits, pks.misses), (1, 5))
+        self.assertEqual(pks.get('word', u'd'), 4)  # the rest of the block 'c' came from
+        self.assertRaises(ValueError, pks.get, 'word', u'e', get_only=True)
+
+    def test_shared_prefix(self):
+        pks = PKAllocator(FakeRedis())
+        long_a, long_b = u'x' * 355 + u'a', u'x' * 355 + u'b'
+        resolved = pks.resolve([('word', long_a), ('word', long_b), ('word', u'y')])
+        self.assertEqual(resolved, {('word', long_a): 1, ('word', long_b): 1, ('word', u'y'): 2})
+        self.assertEqual(PKAllocator(pks.cache).get('word', long_b), 1)
+
+    def test_lost_race(self):
+        cache = FakeRedis()
+        first, second = PKAllocator(cache, block_size=10), PKAllocator(cache, block_size=10)
+        second.next_pk('word')  # reserve 1-10, so first gets 11-20
+        cache.setnx_many([(PKAllocator.key('word', u'a'), 7)])
+        self.assertEqual(first.resolve([('word', u'a'), ('word', u'b')]), {('word', u'a'): 7, ('word', u'b'): 11})
+
+
+class ParentTrackerTest(unittest.TestCase):
+    def test_window(self):
+        parents = ParentTracker(max_recent=2)
+        parents.mark('tweet', '1')
+        self.assertEqual([parents.ensure('tweet_id', key) for key in ('1', '2', '2')], [False, True, False])
+        parents.rollback()
+        self.assertEqual([parents.ensure('tweet_id', key) for key in ('1', '2', '3')], [True, True, True])
+        parents.commit()
+        self.assertEqual(parents.pending, set())
+        self.assertEqual(len(parents.recent), 2)
+        self.assertEqual([parents.ensure('tweet_id', key) for key in ('1', '2', '3')], [True, False, False])
+        self.assertEqual((parents.sent['tweet_id'], parents.saved['tweet_id']), (5, 4))
+
+
+class FakeInserter(object):
+    """
+    Stand-in for the bits of Inserter process_fil uses, committing every commit_every tweets.
+    """
+
+    def __init__(self, commit_every):
+        self.commit_every = commit_every
+        self.uncommitted = []
+        self.committed = []
+
+    def process_json(self, js):
+        self.uncommitted.append(js)
+
+    def maybe_commit(self):
+        if len(self.uncommitted) < self.commit_every:
+            return False
+        self.committed += self.uncommitted
+        self.uncommitted = []
+        return True
+
+
+class ProcessFilTest(unittest.TestCase):
+    def setUp(self):
+        self.outdir = mkdtemp()
+        self.fil = join(self.outdir, 'tweets.json')
+        self.checkpoint = join(self.outdir, 'checkpoint')
+        with open(self.fil, 'w') as f:
+            f.write('1\n2\n\n3\n4\n5\n')
+
+    def tearDown(self):
+        rmtree(self.outdir)
+
+    def test_checkpoints_at_commits(self):
+        inserter = FakeInserter(2)
+        process_fil(self.fil, inserter, checkpoint=self.checkpoint)
+        self.assertEqual((inserter.committed, inserter.uncommitted), ([1, 2, 3, 4], [5]))
+        with open(self.checkpoint) as f:
+            offsets = [int(line.split('\t')[1]) for line in f]
+        with open(self.fil) as f:
+            data = f.read()
+        self.assertEqual([data[offset:].split('\n', 1)[0] for offset in offsets], ['3', '5'])
+        # resuming from the checkpoint only redoes what wasn't committed
+        resumed = FakeInserter(2)
+        process_fil(self.fil, resumed, start=read_checkpoint(self.checkpoint)[self.fil])
+        self.assertEqual(resumed.uncommitted, [5])
+
+
+class TSVWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.outdir = mkdtemp()
+        self.pks = PKAllocator(FakeRedis(), block_size=10)
+
+    def tearDown(self):
+        rmtree(self.outdir)
+
+    def write(self, tweets, **kwargs):
+        writer = TSVWriter(self.outdir, self.pks, **kwargs)
+        for js in tweets:
+            writer.process_json(js)
+        writer.close()
+        return writer, load_sqlite(self.outdir)
+
+    def pk(self, table, val):
+        return unicode(self.pks.get(table, val, get_only=True))  # everything comes back from the TSV files as text
+
+    def test_round_trip(self):
+        words = [u'plain', u'tab\there', u'new\nline', u'back\\slash', u"it's", u'caf\xe9', u'\U0001f600']
+        tweets = [tweet('100', '1', words, hashtags=[u'big_data'], urls=[(u'http://a.com/x', u'a.com')],
+                        user_urls=[(u'http://me.org', u'me.org')])]
+        _, db = self.write(tweets)
+        self.assertEqual(db.execute('SELECT tweet_id, hour, day, is_weekday FROM tweet').fetchall(),
+                         [(u'100', u'13', None, u'1')])
+        self.assertEqual(sorted(db.execute('SELECT id, str FROM word').fetchall()),
+                         sorted((self.pk('word', w), munge_word(w)) for w in words))
+        self.assertEqual(sorted(db.execute('SELECT word_id, tweet_id FROM word_to_tweet').fetchall()),
+                         sorted((self.pk('word', w), u'100') for w in words))
+        hashtag_pk = self.pk('hashtag', u'big_data')
+        self.assertEqual(db.execute('SELECT id, str FROM hashtag').fetchall(), [(hashtag_pk, u'big_data')])
+        self.assertEqual(sorted(db.execute('SELECT tag_word_id, hashtag_id FROM tag_word_to_hashtag').fetchall()),
+                         sorted((self.pk('tag_word', w), hashtag_pk) for w in (u'big', u'data')))
+        self.assertEqual(sorted(db.execute('SELECT id, str, domain FROM url').fetchall()),
+                         sorted([(self.pk('url', u'http://a.com/x'), u'http://a.com/x', u'a.com'),
+                                 (self.pk('url', u'http://me.org'), u'http://me.org', u'me.org')]))
+        self.assertEqual(db.execute('SELECT * FROM url_to_tweet').fetchall(),
+                         [(u'100', self.pk('url', u'http://a.com/x'))])
+        self.assertEqual(db.execute('SELECT * FROM user_to_url').fetchall(), [(u'1', self.pk('url', u'http://me.org'))])
+        self.assertEqual(db.execute('SELECT * FROM user_to_tweet').fetchall(), [(u'1', u'100', u'0')])
+        self.assertEqual(db.execute('SELECT * FROM twitter_user').fetchall(), [(u'1', u'0.5', u'10', u'5', u'-18000')])
+
+    def test_duplicates(self):
+        tweets = [tweet('100', '1', [u'a', u'b']),
+                  tweet('101', '1', [u'b', u'c']),
+                  tweet('100', '1', [u'a', u'b'], followers=-1, offset=None)]
+        writer, db = self.write(tweets)
+        self.assertEqual(writer.counts['tweet'], 2)
+        self.assertEqual(writer.counts['word'], 3)
+        self.assertEqual(writer.counts['word_to_tweet'], 4)
+        # the last version of a user wins
+        self.assertEqual(db.execute('SELECT * FROM twitter_user').fetchall(), [(u'1', None, None, u'5', None)])
+
+    def test_bounded_seen(self):
+        words = [u'w{0}'.format(i) for i in xrange(20)]
+        tweets = [tweet(str(100 + i), '1', words) for i in xrange(10)]
+        writer, db = self.write(tweets, max_seen=8)
+        self.assertTrue(all(len(seen.current) <= 4 and len(seen.previous) <= 4 for seen in writer.seen.itervalues()))
+        # forgotten words are written again, but load to the same rows
+        self.assertGreater(writer.counts['word'], len(words))
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM word').fetchone(), (len(words),))
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM word_to_tweet').fetchone(), (len(words) * len(tweets),))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+#coding=utf8
+__author__ = 'Sam Raker'
+
+import gzip
+from os import close, listdir, remove
+from os.path import join
+from shutil import rmtree
+from sys import maxunicode
+from tempfile import mkdtemp, mkstemp
+import unittest
+
+from tools import (AppendWriter, Censor, CharFilter, RecentSet, RotatingWriter, UNICHECK_RANGES, UNIFILTER,
+                   read_jsonl, read_lines, read_lines_reversed, unicheck, unifilter)
+
+
+class ReadLinesTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.fname = mkstemp()
+        close(fd)
+
+    def tearDown(self):
+        remove(self.fname)
+
+    def write(self, data, gzipped=False):
+        f = gzip.open(self.fname, 'wb') if gzipped else open(self.fname, 'wb')
+        with f:
+            f.write(data)
+
+    def test_reversed(self):
+        for data in ('', 'a\n', 'a', 'a\nbb\n\nccc\n', 'a\nbb\nccc', '\n\n', 'x' * 100 + '\n' + 'y' * 7):
+            for block_size in (1, 2, 3, 64):
+                self.write(data)
+                self.assertEqual(list(read_lines_reversed(self.fname, block_size)), list(read_lines(self.fname))[::-1])
+
+    def test_reversed_gzipped(self):
+        self.write('a\nbb\nccc\n', gzipped=True)
+        self.assertEqual(list(read_lines_reversed(self.fname)), [(5, 'ccc\n'), (2, 'bb\n'), (0, 'a\n')])
+
+    def test_jsonl(self):
+        self.write('{"a": 1}\n\nnot json\n[2]\n')
+        with self.assertRaises(ValueError):
+            list(read_jsonl(self.fname))
+        self.assertEqual(list(read_jsonl(self.fname, verbose=False, skip_errors=True)), [(0, {'a': 1}), (19, [2])])
+        self.assertEqual(list(read_jsonl(self.fname, 19)), [(19, [2])])
+
+
+class CharFilterTest(unittest.TestCase):
+    def test_every_codepoint(self):
+        self.assertEqual([val for val in xrange(maxunicode + 1) if UNIFILTER(unichr(val)) != unicheck(unichr(val))], [])
+
+    def test_every_byte(self):
+        self.assertEqual([val for val in xrange(256) if UNIFILTER(chr(val)) != unicheck(chr(val))], [])
+        self.assertEqual([val for val in xrange(256) if UNIFILTER.allowed(chr(val)) != unicheck(chr(val))], [])
+
+    def test_unifilter(self):
+        # the same as checking every byte of the UTF-8 encoding with unicheck, as unifilter used to
+        byte_ok = [unicheck(chr(val)) for val in xrange(256)]
+        self.assertEqual([val for val in xrange(maxunicode + 1)
+                          if unifilter(unichr(val)) != all([byte_ok[b] for b in bytearray(unichr(val).encode('utf8'))])],
+                         [])
+
+    def test_strings(self):
+        self.assertTrue(UNIFILTER(u''))
+        self.assertTrue(UNIFILTER(u'plain text \u2026 \u20ac \U0001f602'))
+        self.assertFalse(UNIFILTER(u'caf\xe9'))
+        self.assertTrue(unifilter(u'plain text'))
+        self.assertFalse(unifilter(u'plain text \u2026'))  # its UTF-8 bytes are outside the ranges
+
+    def test_merged_ranges(self):
+        f = CharFilter([(10, 20), (0, 5), (6, 9), (30, 30), (15, 25)])
+        self.assertEqual(f.ranges, [[0, 25], [30, 30]])
+        self.assertEqual([val for val in xrange(40) if f(unichr(val))], range(26) + [30])
+        self.assertEqual(CharFilter(UNICHECK_RANGES).ranges, UNIFILTER.ranges)
+
+
+class CensorTest(unittest.TestCase):
+    TERMS = [u'damn', u'dam', u'Shit', u'ass', u'a.s', u'', u'caf\xe9']
+
+    def test_matches_naive_search(self):
+        censor = Censor(self.TERMS)
+        self.assertEqual(censor.terms, (u'a.s', u'ass', u'caf\xe9', u'dam', u'damn', u'shit'))
+        for s in [u'', u'clean', u'DAMNED', u'a dam', u'bass', u'axs', u'a.s.', u'SHIT', u'CAF\xc9', u'cafe']:
+            expected = [term for term in censor.terms if term in s.lower()]
+            self.assertEqual(censor(s), not expected, s)
+            self.assertIn(censor.find(s), expected or [None], s)
+
+    def test_empty(self):
+        censor = Censor([])
+        self.assertTrue(censor(u'anything'))
+        self.assertIsNone(censor.find(u'anything'))
+
+    def test_add(self):
+        censor = Censor([u'damn'])
+        self.assertTrue(censor(u'heck'))
+        censor.add(u'HECK', u'damn', u'')
+        self.assertEqual(censor.terms, (u'damn', u'heck'))
+        self.assertFalse(censor(u'what the heck'))
+        self.assertEqual(censor.find(u'damn'), u'damn')
+
+
+class RecentSetTest(unittest.TestCase):
+    def test_forgets_oldest_generation(self):
+        seen = RecentSet(4)
+        for i in xrange(5):
+            seen.add(i)
+            seen.add(i)
+        self.assertEqual([i in seen for i in xrange(6)], [False, False, True, True, True, False])
+        self.assertEqual(len(seen), 3)
+        seen.add(3)
+        seen.add(5)
+        self.assertEqual([i in seen for i in xrange(6)], [False, False, True, True, True, True])
+        self.assertEqual(len(seen), 4)
+        for i in xrange(1000):
+            seen.add(i)
+        self.assertLessEqual(len(seen), 4)
+
+
+class WriterTest(unittest.TestCase):
+    def setUp(self):
+        self.outdir = mkdtemp()
+        self.prefix = join(self.outdir, 'tweets')
+
+    def tearDown(self):
+        rmtree(self.outdir)
+
+    def read(self, fname):
+        with (gzip.open if fname.endswith('.gz') else open)(fname, 'rb') as f:
+            return f.read()
+
+    def test_rotates_by_size(self):
+        with RotatingWriter(self.prefix, max_bytes=10) as writer:
+            for line in ['a' * 4, 'b' * 4, 'c' * 4, 'd' * 20, 'e']:
+                writer.write(line)
+        self.assertEqual(writer.files, [self.prefix + '_0.json', self.prefix + '_1.json', self.prefix + '_2.json'])
+        self.assertEqual([self.read(fname) for fname in writer.files], ['aaaa\nbbbb\n', 'cccc\n' + 'd' * 20 + '\n', 'e\n'])
+        self.assertEqual(writer.lines, 5)
+
+    def test_rotates_by_time(self):
+        with RotatingWriter(self.prefix, max_secs=60) as writer:
+            writer.write('a')
+            writer.opened -= 60
+            writer.write('b')
+            writer.write('c')
+        self.assertEqual([self.read(fname) for fname in writer.files], ['a\n', 'b\nc\n'])
+
+    def test_never_overwrites(self):
+        with RotatingWriter(self.prefix) as writer:
+            writer.write('a')
+        with RotatingWriter(self.prefix, compress=True) as writer:
+            writer.write('b')
+        with RotatingWriter(self.prefix, max_bytes=1) as writer:
+            writer.write('c')
+            writer.write('d')
+        self.assertEqual(sorted(listdir(self.outdir)), ['tweets_0.json', 'tweets_0.json.gz', 'tweets_1.json',
+                                                        'tweets_2.json'])
+        self.assertEqual([self.read(join(self.outdir, fname)) for fname in sorted(listdir(self.outdir))],
+                         ['a\n', 'b\n', 'c\n', 'd\n'])
+
+    def test_append(self):
+        fname = self.prefix + '.json'
+        with AppendWriter(fname) as writer:
+            writer.write('a')
+        with AppendWriter(fname) as writer:
+            writer.write('b')
+        with AppendWriter(fname):
+            pass
+        self.assertEqual(listdir(self.outdir), ['tweets.json'])
+        self.assertEqual(self.read(fname), 'a\nb\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
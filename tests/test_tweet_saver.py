@@ -0,0 +1,218 @@
+#coding=utf8
+__author__ = 'Sam Raker'
+
+import json
+from os import listdir
+from os.path import join
+from shutil import rmtree
+from StringIO import StringIO
+import sys
+from tempfile import mkdtemp
+import time
+import unittest
+
+import requests
+
+from tests.fake_api import FakeAPI
+from tools import AppendWriter
+import tweet_saver
+from tweet_saver import StreamPipeline, StreamReader, StreamSaver
+from twitterizer import Scrape
+
+STREAM_PATH = '/1.1/statuses/sample.json'
+
+
+def tweet(tweet_id):
+    return json.dumps({'id_str': str(tweet_id), 'text': 'hi #x {}'.format(tweet_id),
+                       'entities': {'hashtags': [{'text': 'x'}], 'urls': []}})
+
+
+class StreamTestCase(unittest.TestCase):
+    """
+    Runs a fake stream, which gives each connection the next of .responses, and then, once they've run out, nothing
+    but keep-alive newlines. Waits to reconnect are recorded in .waits rather than waited out.
+    """
+
+    def setUp(self):
+        self.responses = []  # (status, body), one per connection
+        self.api = FakeAPI(self.respond)
+        self.scrape = Scrape(lambda r: r, url=self.api.url(STREAM_PATH))
+        self.waits = []
+        self.pause, StreamReader.pause = StreamReader.pause, lambda reader, secs: self.waits.append(secs)
+        self.outdir = mkdtemp()
+        self.outfile = join(self.outdir, 'tweets.json')
+
+    def tearDown(self):
+        StreamReader.pause = self.pause
+        self.api.close()
+        rmtree(self.outdir)
+
+    def respond(self, path, params):
+        self.assertEqual(path, STREAM_PATH)
+        status, body = self.responses.pop(0) if self.responses else (200, self.idle())
+        return status, {}, body
+
+    def idle(self):
+        for _ in xrange(100):
+            yield '\r\n'
+            time.sleep(0.1)
+
+    def saved(self, fname=None):
+        with open(fname or self.outfile) as f:
+            return [json.loads(line)['id_str'] for line in f]
+
+
+class StreamSaverTest(StreamTestCase):
+    def stalled(self):
+        yield '\r\n'
+        time.sleep(2)
+        yield tweet(99) + '\r\n'
+
+    def test_reconnects_with_backoff(self):
+        self.responses = [
+            (503, ''),
+            (200, [tweet(1) + '\r\n', '\r\n', '{"limit": {"track": 7}}\r\n', 'not json\r\n', tweet(2) + '\r\n']),
+            (420, ''),
+            (200, self.stalled()),
+            (200, ''.join(tweet(i) + '\r\n' for i in xrange(3, 10))),
+        ]
+        with AppendWriter(self.outfile) as writer:
+            saver = StreamSaver(writer, self.scrape, suite=False, stall_timeout=0.5, verbose=False)
+            self.assertEqual(saver.run(5), 5)
+        self.assertEqual(self.saved(), ['1', '2', '3', '4', '5'])
+        # HTTP error, dropped connection, rate limited, stalled (the counts are reset by the tweets in between)
+        self.assertEqual(self.waits, [5, 0.25, 60, 0.5])
+        self.assertEqual(saver.connections, 3)
+        self.assertEqual((saver.missed, saver.undecodable), (7, 1))
+
+    def test_http_backoff_grows(self):
+        self.responses = [(500, '')] * 3 + [(429, '')] * 2 + [(200, tweet(1) + '\r\n')]
+        with AppendWriter(self.outfile) as writer:
+            StreamSaver(writer, self.scrape, suite=False, verbose=False).run(1)
+        self.assertEqual(self.waits, [5, 10, 20, 60, 120])
+
+    def test_fatal_status_raises(self):
+        self.responses = [(401, '')]
+        with AppendWriter(self.outfile) as writer:
+            saver = StreamSaver(writer, self.scrape, suite=False, verbose=False)
+            self.assertRaises(requests.exceptions.HTTPError, saver.run, 1)
+        self.assertEqual(self.waits, [])
+
+    def test_nothing_to_save(self):
+        with AppendWriter(self.outfile) as writer:
+            self.assertEqual(StreamSaver(writer, self.scrape, verbose=False).run(0), 0)
+        self.assertEqual(self.api.requests, [])
+        self.assertEqual(listdir(self.outdir), [])
+
+    def test_tweet_saver(self):
+        self.responses = [(200, ''.join(tweet(i) + '\r\n' for i in xrange(1, 10)))] * 2
+        with open(self.outfile, 'w') as f:
+            f.write(tweet(0) + '\n')
+        scrape, tweet_saver.s = tweet_saver.s, self.scrape
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            tweet_saver.tweet_saver(self.outfile, 5, 7)
+            tweet_saver.tweet_saver(self.outfile, 7, 7)
+            tweet_saver.tweet_saver(self.outfile, 0, 1, rotate=True)
+        finally:
+            tweet_saver.s = scrape
+            sys.stdout = stdout
+        self.assertEqual(self.saved(), ['0', '1', '2'])
+        self.assertEqual(self.saved(join(self.outdir, 'tweets_0.json')), ['1'])
+        self.assertEqual(sorted(listdir(self.outdir)), ['tweets.json', 'tweets_0.json'])
+        self.assertEqual(len(self.api.requests), 2)
+
+
+class StreamPipelineTest(StreamTestCase):
+    def setUp(self):
+        super(StreamPipelineTest, self).setUp()
+        self.responses = [(200, ''.join(tweet(i) + '\r\n' for i in xrange(200)))]
+        self.found = []
+
+    def pipeline(self, **kwargs):
+        kwargs.setdefault('suite', False)
+        return StreamPipeline(kwargs.pop('sink', self.found.append), self.scrape, verbose=False, **kwargs)
+
+    def held(self, pipeline, lines):
+        """
+        A parse function that holds the workers up until the reader has read a number of lines, so the queue fills up.
+        """
+        def parse(js):
+            deadline = time.time() + 5
+            while pipeline.read < lines and time.time() < deadline:
+                time.sleep(0.01)
+            return js
+        return parse
+
+    def ids(self):
+        return [int(js['id_str']) for js in self.found]
+
+    def test_block(self):
+        pipeline = self.pipeline(queue_size=2, workers=1)
+        self.assertEqual(pipeline.run(150), 150)
+        self.assertEqual(self.ids(), range(150))
+        self.assertEqual((pipeline.dropped, pipeline.spilled), (0, 0))
+        self.assertLessEqual(pipeline.peaks['lines'], 2)
+
+    def test_total(self):
+        self.assertEqual(self.pipeline().run(0), 0)
+        self.assertEqual(self.api.requests, [])
+        for total in (1, 7, 150):
+            del self.found[:]
+            self.responses = [(200, ''.join(tweet(i) + '\r\n' for i in xrange(200)))]
+            pipeline = self.pipeline(workers=4)
+            start = time.time()
+            self.assertEqual(pipeline.run(total), total)
+            self.assertEqual(len(self.found), total)
+            self.assertLess(time.time() - start, 2)  # the reader was cut off, not left waiting for data
+
+    def test_drop(self):
+        pipeline = self.pipeline(policy='drop', queue_size=1, workers=1)
+        pipeline.parse = self.held(pipeline, 100)
+        self.assertEqual(pipeline.run(1), 1)
+        self.assertGreater(pipeline.dropped, 90)
+        self.assertEqual(pipeline.spilled, 0)
+
+    def test_spill(self):
+        spill = AppendWriter(self.outfile)
+        pipeline = self.pipeline(policy='spill', spill=spill, queue_size=1, workers=1)
+        pipeline.parse = self.held(pipeline, 100)
+        self.assertEqual(pipeline.run(1), 1)
+        self.assertIsNone(spill.f)  # closed (and so flushed) by the time run returns
+        self.assertGreater(pipeline.spilled, 90)
+        self.assertEqual(len(self.saved()), pipeline.spilled)
+        self.assertFalse(set(self.ids()) & set(int(tweet_id) for tweet_id in self.saved()))
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, self.pipeline, policy='shrug')
+        self.assertRaises(ValueError, self.pipeline, policy='spill')
+
+    def test_sink_error(self):
+        def sink(js):
+            if len(self.found) == 2:
+                raise KeyError('sink')
+            self.found.append(js)
+
+        pipeline = self.pipeline(sink=sink)
+        start = time.time()
+        self.assertRaises(KeyError, pipeline.run)
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(len(self.found), 2)
+
+    def test_reader_error(self):
+        self.responses = [(401, '')]
+        self.assertRaises(requests.exceptions.HTTPError, self.pipeline().run)
+        self.assertEqual(self.found, [])
+
+    def test_filter_and_parse(self):
+        self.responses = [(200, ''.join([tweet(1) + '\r\n', 'not json\r\n', '{"limit": {"track": 3}}\r\n',
+                                         '{"delete": {}}\r\n', tweet(2) + '\r\n']))]
+        pipeline = self.pipeline(suite=True, parse=lambda js: js['id_str'])
+        self.assertEqual(pipeline.run(2), 2)
+        self.assertEqual(sorted(self.found), ['1', '2'])
+        self.assertEqual([sum(counts) for counts in zip(*pipeline.worker_stats)], [1, 1, 2])
+        self.assertEqual(pipeline.missed, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#coding=utf8
+__author__ = 'Sam Raker'
+
+import json
+from threading import Thread
+import unittest
+
+from ratelimit import RateLimiter
+from tests.fake_api import FakeAPI
+from tools import RecentSet
+from twitterizer import Search
+
+SEARCH_PATH = '/1.1/search/tweets.json'
+
+
+def status(tweet_id, text):
+    return {'id_str': str(tweet_id), 'text': text, 'entities': {'urls': [], 'hashtags': [], 'user_mentions': []}}
+
+
+class SearchTest(unittest.TestCase):
+    def setUp(self):
+        self.statuses = [status(i, u'cats #{} @cats'.format(i)) for i in xrange(10, 0, -1)]  # newest first
+        self.api = FakeAPI(self.respond)
+
+    def tearDown(self):
+        self.api.close()
+
+    def respond(self, path, params):
+        self.assertEqual(path, SEARCH_PATH)
+        max_id = int(params.get('max_id', 1 << 62))
+        since_id = int(params.get('since_id', 0))
+        found = [tweet for tweet in self.statuses if since_id < int(tweet['id_str']) <= max_id]
+        return 200, {}, json.dumps({'statuses': found[:int(params['count'])]})
+
+    def search(self, **kwargs):
+        kwargs.setdefault('limiter', RateLimiter(verbose=False))
+        return Search(_auth=lambda r: r, url=self.api.url(SEARCH_PATH), **kwargs)
+
+    def test_pages_follow_max_id(self):
+        pages = list(self.search().pages('cats', count=3))
+        self.assertEqual([[tweet['id_str'] for tweet in page] for page in pages],
+                         [['10', '9', '8'], ['7', '6', '5'], ['4', '3', '2'], ['1']])
+        self.assertEqual(self.api.params('max_id'), [None, '7', '4', '1'])
+        self.assertEqual(self.api.params('count'), ['3'] * 4)
+
+    def test_minim(self):
+        found = list(self.search().results('cats', suite=False, minim=4, count=3))
+        self.assertEqual(len(found), 6)
+        self.assertEqual(len(self.api.requests), 2)
+
+    def test_incremental(self):
+        search = self.search()
+        self.assertEqual(len(list(search.results('cats', suite=False))), 10)
+        self.assertEqual(search.saved_search_meta['cats']['since_id'], 10)
+        self.statuses[:0] = [status(12, u'cats'), status(11, u'cats')]
+        found = list(search.results('cats', suite=False, incremental=True))
+        self.assertEqual([tweet['id_str'] for tweet in found], ['12', '11'])
+        self.assertEqual(self.api.params('since_id')[-2:], ['10', '10'])
+        self.assertEqual(search.saved_search_meta['cats']['since_id'], 12)
+
+    def test_session_per_thread(self):
+        search = self.search()
+        sessions = []
+        threads = [Thread(target=lambda: sessions.append((search.session(), search.session()))) for _ in xrange(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        (a, a2), (b, b2) = sessions
+        self.assertIs(a, a2)
+        self.assertIs(b, b2)
+        self.assertIsNot(a, b)
+
+    def test_search_all(self):
+        self.statuses.insert(0, status(11, u'dogs'))
+        found = list(self.search().search_all(['cats', 'dogs', 'fish'], workers=3, suite=False))
+        self.assertEqual(sorted((q, int(tweet['id_str'])) for q, tweet in found),
+                         [('cats', i) for i in xrange(1, 11)] + [('dogs', 11)])
+
+    def test_search_batch_dedups(self):
+        search = self.search()
+        found = []
+        self.statuses.insert(0, status(11, u'cats and dogs'))
+        self.assertEqual(search.search_batch(['cats', 'dogs'], found.append, suite=False, verbose=False), 11)
+        self.assertEqual(sorted(int(tweet['id_str']) for tweet in found), range(1, 12))
+        meta = search.saved_search_meta
+        self.assertEqual((meta['cats']['found'], meta['dogs']['found']), (11, 1))
+        self.assertEqual(meta['cats']['new'] + meta['dogs']['new'], 11)
+        self.statuses.insert(0, status(12, u'cats'))
+        self.assertEqual(search.search_batch(['cats'], found.append, suite=False, verbose=False), 1)
+        self.assertEqual(found[-1]['id_str'], '12')
+
+    def test_search_batch_forgets(self):
+        search = self.search()
+        search.tweets = RecentSet(4)
+        found = []
+        self.assertEqual(search.search_batch(['cats'], found.append, suite=False, verbose=False), 10)
+        self.assertEqual(len(search.tweets), 4)  # 4, 3, 2 and 1
+        # re-finding 10 to 5 pushes 4 to 1 out before they come round again
+        self.assertEqual(search.search_batch(['cats'], found.append, suite=False, verbose=False), 10)
+
+    def test_unames_pipeline_is_reused(self):
+        search = self.search()
+        self.assertEqual(len(list(search.results('cats', suite=False))), 10)
+        pipelines = dict(search.pipelines)
+        self.assertEqual(len(pipelines), 1)
+        pipeline = pipelines.values()[0]
+        self.assertEqual(len(list(search.results('cats', suite=False))), 10)
+        self.assertEqual(search.pipelines, pipelines)
+        self.assertEqual(pipeline.stats[search.unames_test('cats')][:2], [20, 20])
+        list(search.results('dogs', suite=False))
+        self.assertEqual(len(search.pipelines), 2)
+
+    def test_unames_test(self):
+        search = self.search()
+        self.assertTrue(search._unames_test(status(1, u'cats'), 'cats'))
+        self.assertFalse(search._unames_test(status(1, u'@cats'), 'cats'))
+        self.assertFalse(search._unames_test({'delete': {}}, 'cats'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#coding=utf8
+__author__ = 'Sam Raker'
+
+import BaseHTTPServer
+import os
+from select import select
+import signal
+from threading import Thread
+from time import time
+import unittest
+
+from unshorten import URLCache, URLResolver
+
+
+class FakeRedis(object):
+    """
+    In-memory stand-in for the bits of Redis a URLCache uses.
+    """
+
+    def __init__(self, entries=None):
+        self.data = dict(entries or {})  # key: (value, ttl or None)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append(lambda: self.redis.data.get(key, (None, None))[0])
+
+    def ttl(self, key):
+        self.calls.append(lambda: self.redis.data[key][1] if key in self.redis.data else -2)
+
+    def set(self, key, val, ex=None):
+        self.calls.append(lambda: self.redis.data.__setitem__(key, (val, ex)))
+
+    def execute(self):
+        return [call() for call in self.calls]
+
+
+class RedirectHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    /short/<x> redirects to /long/<x>, which exists.
+    """
+
+    def do_HEAD(self):
+        if self.path.startswith('/short/'):
+            self.send_response(301)
+            self.send_header('Location', self.path.replace('/short/', '/long/'))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class URLCacheTest(unittest.TestCase):
+    def test_tiers(self):
+        redis = FakeRedis({'http://a': ('http://long/a', 1000), 'http://b': ('http://long/b', -1)})
+        cache = URLCache(path=None, redis=redis, ttl=5000, negative_ttl=10)
+        now = time()
+        self.assertEqual(cache.get_many(['http://a', 'http://b', 'http://c']),
+                         {'http://a': 'http://long/a', 'http://b': 'http://long/b'})
+        self.assertEqual(cache.hits['redis'], 2)
+        self.assertEqual(cache.misses, 1)
+        # Redis hits are kept for as long as Redis would keep them (or the full ttl if it has none), not negative_ttl
+        self.assertAlmostEqual(cache.recent[u'http://a'][1], now + 1000, delta=5)
+        self.assertAlmostEqual(cache.recent[u'http://b'][1], now + 5000, delta=5)
+        self.assertEqual(cache.get('http://a'), 'http://long/a')
+        self.assertEqual(cache.hits['memory'], 1)
+        cache.put('http://c', 'http://long/c')
+        self.assertEqual(redis.data['http://c'], ('http://long/c', 5000))
+        cache.put_failed(['http://d'])
+        self.assertEqual(redis.data['http://d'], ('http://d', 10))
+
+
+class URLResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RedirectHandler)
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        self.resolver = URLResolver(workers=2, verbose=False)
+
+    def tearDown(self):
+        self.resolver.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_resolve(self):
+        self.assertEqual(self.resolver.unshorten([self.base + '/short/a', self.base + '/long/b']),
+                         [self.base + '/long/a', self.base + '/long/b'])
+
+    def test_after_fork(self):
+        self.resolver.resolve(self.base + '/short/a')  # start the pool in the parent
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_end)
+                os.write(write_end, self.resolver.resolve(self.base + '/short/b'))
+                self.resolver.close()
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        with os.fdopen(read_end) as f:
+            # the child would hang forever if it used the parent's thread pool, whose threads it doesn't have
+            if not select([f], [], [], 10)[0]:
+                os.kill(pid, signal.SIGKILL)
+            resolved = f.read()
+        os.waitpid(pid, 0)
+        self.assertEqual(resolved, self.base + '/long/b')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,668 @@
 # coding=utf8
 __author__ = 'Sam Raker'
 
-from json import loads
-from os import environ
+from collections import OrderedDict
+from itertools import chain
+from contextlib import contextmanager
+from multiprocessing import Pool
+from os import environ, getpid
+from os.path import exists, join
 import re
+from threading import Lock
+from time import sleep, time
 
 import MySQLdb
 
-from tools import SafeRedis, eld
+from tools import RecentSet, SafeRedis, eld, read_jsonl
+
+
+# (name, table, statement) triples for every write the Inserter makes, in the order they have to be flushed so that
+# parent rows are in place before the rows that refer to them. Full rows come before the 'placeholder' inserts for the
+# same table so that a placeholder never shadows the real data. The link rows are idempotent (a tweet that's loaded
+# twice links to the same words, urls, etc.), so they're written with IGNORE: otherwise one duplicate would make the
+# whole multi-row insert it's batched into fail.
+STATEMENTS = (
+    ('twitter_user', 'twitter_user',
+     """INSERT INTO `twitter_user` (user_id, follow_ratio, followers, following, offset) VALUES (%s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE follow_ratio=VALUES(follow_ratio), followers=VALUES(followers),
+        following=VALUES(following), offset=VALUES(offset)"""),
+    ('twitter_user_id', 'twitter_user', """INSERT IGNORE INTO `twitter_user` (user_id) VALUES (%s)"""),
+    ('tweet', 'tweet',
+     """INSERT INTO `tweet` (tweet_id, hour, day, is_weekday) VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE hour=VALUES(hour), day=VALUES(day), is_weekday=VALUES(is_weekday)"""),
+    ('tweet_id', 'tweet', """INSERT IGNORE INTO `tweet` (tweet_id) VALUES (%s)"""),
+    ('hashtag', 'hashtag', """INSERT IGNORE INTO `hashtag` (id, str) VALUES (%s, %s)"""),
+    ('hashtag_id', 'hashtag', """INSERT IGNORE INTO `hashtag` (id) VALUES (%s)"""),
+    ('tag_word', 'tag_word', """INSERT IGNORE INTO `tag_word` (id, str) VALUES (%s, %s)"""),
+    ('url', 'url', """INSERT IGNORE INTO `url` (id, str, domain) VALUES (%s, %s, %s)"""),
+    ('word', 'word', """INSERT IGNORE INTO `word` (id, str) VALUES (%s, %s)"""),
+    ('hashtag_to_tweet', 'hashtag_to_tweet',
+     """INSERT IGNORE INTO `hashtag_to_tweet` (hashtag_id, tweet_id) VALUES (%s, %s)"""),
+    ('tag_word_to_hashtag', 'tag_word_to_hashtag',
+     """INSERT IGNORE INTO `tag_word_to_hashtag` (tag_word_id, hashtag_id) VALUES (%s, %s)"""),
+    ('url_to_tweet', 'url_to_tweet', """INSERT IGNORE INTO `url_to_tweet` (tweet_id, url_id) VALUES (%s, %s)"""),
+    ('user_to_url', 'user_to_url', """INSERT IGNORE INTO `user_to_url` (user_id, url_id) VALUES (%s, %s)"""),
+    ('word_to_tweet', 'word_to_tweet', """INSERT IGNORE INTO `word_to_tweet` (word_id, tweet_id) VALUES (%s, %s)"""),
+    ('user_to_tweet', 'user_to_tweet',
+     """INSERT IGNORE INTO `user_to_tweet` (user_id, tweet_id, is_mention) VALUES (%s, %s, %s)"""),
+)
+STATEMENT_NAMES = tuple(name for name, _, _ in STATEMENTS)
+STATEMENT_TABLES = {name: table for name, table, _ in STATEMENTS}
+STATEMENT_SQL = {name: sql for name, _, sql in STATEMENTS}
+STATEMENT_KINDS = {name: 'upsert' if 'ON DUPLICATE KEY' in sql else 'insert ignore' if 'INSERT IGNORE' in sql
+                   else 'insert' for name, _, sql in STATEMENTS}
+# statement name: (dependent statement name, index of the column that refers to the row) for rows that can't be written
+# without the row they refer to (see BatchBuffer.flush and Inserter.insert_word)
+STATEMENT_DEPENDENTS = {'word': ('word_to_tweet', 0)}
+# errors that only affect the row that caused them, as opposed to the connection or the transaction
+ROW_ERRORS = (MySQLdb.IntegrityError, MySQLdb.ProgrammingError, MySQLdb.DataError)
+
+
+# every table, parents before the tables that refer to them
+TABLES = ('twitter_user', 'tweet', 'cluster', 'hashtag', 'tag_word', 'url', 'word', 'hashtag_to_cluster',
+          'hashtag_to_tweet', 'tag_word_to_hashtag', 'url_to_tweet', 'user_to_tweet', 'user_to_url', 'word_to_tweet')
+# the tables whose pks are handed out via Redis (see PKAllocator)
+PK_TABLES = ('cluster', 'hashtag', 'tag_word', 'url', 'word')
+# the many-to-many tables, which get the most rows and so benefit most from dropping their indexes during bulk loads
+LINK_TABLES = ('hashtag_to_cluster', 'hashtag_to_tweet', 'tag_word_to_hashtag', 'url_to_tweet', 'user_to_tweet',
+               'user_to_url', 'word_to_tweet')
+
+# Deletes the '<table>_<value>' keys for the tables passed as ARGV and resets their 'pk_<table>' counters, in one call.
+# KEYS is used rather than SCAN because scripts can't write after calling SCAN; DEL is chunked to stay under Lua's
+# unpack() limit.
+RESET_PKS_SCRIPT = """
+local deleted = 0
+for _, tbl in ipairs(ARGV) do
+    local keys = redis.call('KEYS', tbl .. '_*')
+    for i = 1, #keys, 5000 do
+        deleted = deleted + redis.call('DEL', unpack(keys, i, math.min(i + 4999, #keys)))
+    end
+    redis.call('SET', 'pk_' .. tbl, 0)
+end
+return deleted
+"""
+
+
+def get_settings(use_testdb=False):
+    """
+    The MySQL and Redis connection settings for the main or test db.
+    :param use_testdb: whether to use the test db/Redis settings
+    :type use_testdb: bool
+    :return: (dict, dict) tuple (MySQLdb.connect kwargs, SafeRedis kwargs)
+    """
+    if use_testdb:
+        db_settings = {'host': 'localhost',
+                       'db': 'tweets_test',
+                       'user': 'samuelraker',
+                       'passwd': environ.get('TWEETS_TESTDB_PASSWORD')}
+        redis_settings = {'host': 'localhost',
+                          'db': '0'}
+    else:
+        db_settings = {'host': 'localhost',
+                       'db': 'twitter',
+                       'user': 'samuelraker',
+                       'passwd': environ.get('TWEETS_DB_PASSWORD')}
+        redis_settings = {'host': 'localhost',
+                          'db': '2'}
+    return db_settings, redis_settings
+
+
+def pk_pairs(tweet_data, user_data):
+    """
+    All the (table, value) pairs a tweet needs primary keys for (see PKAllocator.resolve)
+    :param tweet_data: the data extracted from the tweet
+    :type tweet_data: dict
+    :param user_data: the data extracted from the user profile
+    :type user_data: dict
+    :return: iterator of (string, string) tuples
+    """
+    return chain((('hashtag', hashtag) for hashtag in tweet_data.get('hashtags') or []),
+                 (('tag_word', tag_word) for tag_word in chain.from_iterable(tweet_data.get('split_hashtags') or [])),
+                 (('url', url) for url in tweet_data['urls'] or []),
+                 (('url', url) for url in user_data['urls'] or []),
+                 (('word', word) for word in tweet_data['words']))
+
+
+def munge_word(word_str):
+    """
+    Replaces quotation marks in a word with [Q] (single quotes) and [QQ] (double quotes), which is how words are stored
+    in the `word` table.
+    :param word_str: the word
+    :type word_str: str
+    :return: str
+    """
+    return word_str.replace("'", "[Q]").replace('"', "[QQ]")
+
+
+def row_size(row):
+    """
+    Rough estimate of the number of bytes a row will take up in an INSERT statement.
+    :param row: the row
+    :type row: tuple
+    :return: int
+    """
+    return sum(len(val) if isinstance(val, basestring) else 8 for val in row)
+
+
+class BatchBuffer(object):
+    """
+    Buffers rows per statement (see STATEMENTS, above) and writes them out with one multi-row executemany per
+    statement once max_rows rows or max_bytes bytes are pending. All the buffers are flushed together, in dependency
+    order, so a link row is never written before the rows it refers to. If a bulk write fails because of a bad row (see
+    ROW_ERRORS), that statement's rows are written one at a time instead, so only the bad rows (and the rows that
+    depend on them, see STATEMENT_DEPENDENTS) are lost. Keeps running totals of the rows written to each table and the
+    time spent writing them.
+    """
+
+    def __init__(self, execute, max_rows=1000, max_bytes=1048576, skip=None):
+        """
+        :param execute: function that writes a list of rows with one of the statements (e.g. Inserter.execute)
+        :type execute: function (string, list of tuples) -> None
+        :param max_rows: number of pending rows (across all tables) that triggers a flush
+        :type max_rows: int
+        :param max_bytes: (estimated) number of pending bytes that triggers a flush
+        :type max_bytes: int
+        :param skip: called with each row that couldn't be written, and the error
+        :type skip: function (string, tuple, MySQLdb.Error) -> None, or None
+        """
+        self.execute = execute
+        self.skip = skip
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.rows = {name: [] for name in STATEMENT_NAMES}
+        self.pending_rows = 0
+        self.pending_bytes = 0
+        self.stats = {}  # table: [rows written, seconds spent writing]
+
+    def add(self, name, row):
+        """
+        Buffer a row, flushing everything if the buffer is full.
+        :param name: the statement the row belongs to
+        :type name: str (one of STATEMENT_NAMES)
+        :param row: the values to insert
+        :type row: tuple
+        :return: None
+        """
+        self.rows[name].append(row)
+        self.pending_rows += 1
+        self.pending_bytes += row_size(row)
+        if self.pending_rows >= self.max_rows or self.pending_bytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all buffered rows.
+        :return: None
+        """
+        for name in STATEMENT_NAMES:
+            rows = self.rows[name]
+            if rows:
+                start = time()
+                try:
+                    self.execute(name, rows)
+                except ROW_ERRORS:
+                    rows = self.execute_each(name, rows)
+                table_stats = self.stats.setdefault(STATEMENT_TABLES[name], [0, 0.0])
+                table_stats[0] += len(rows)
+                table_stats[1] += time() - start
+                self.rows[name] = []
+        self.pending_rows = 0
+        self.pending_bytes = 0
+
+    def execute_each(self, name, rows):
+        """
+        Write a statement's rows one at a time, skipping the ones that fail, along with the rows that depend on them.
+        :param name: the statement
+        :type name: str (one of STATEMENT_NAMES)
+        :param rows: the rows
+        :type rows: list of tuples
+        :return: list of tuples (the rows that were written)
+        """
+        written = []
+        failed = set()
+        for row in rows:
+            try:
+                self.execute(name, [row])
+            except ROW_ERRORS as e:
+                failed.add(row[0])
+                if self.skip is not None:
+                    self.skip(name, row, e)
+            else:
+                written.append(row)
+        if name in STATEMENT_DEPENDENTS and failed:
+            dependent, col = STATEMENT_DEPENDENTS[name]
+            self.rows[dependent] = [row for row in self.rows[dependent] if row[col] not in failed]
+        return written
+
+    def clear(self):
+        """
+        Discard all buffered rows.
+        :return: None
+        """
+        self.rows = {name: [] for name in STATEMENT_NAMES}
+        self.pending_rows = 0
+        self.pending_bytes = 0
+
+    def report(self):
+        """
+        Print the number of rows written to each table and the rate they were written at.
+        :return: None
+        """
+        for table in sorted(self.stats):
+            rows, secs = self.stats[table]
+            print "{table}: {rows} rows in {secs:.2f}s ({rate:.0f} rows/sec)".format(table=table, rows=rows, secs=secs,
+                                                                                     rate=rows / secs if secs else 0)
+
+
+class PKAllocator(object):
+    """
+    Hands out primary keys for values, using the same '<table>_<value>' -> pk mapping in Redis as the original one-value-
+    at-a-time scheme. Recently used mappings are kept in a bounded in-process LRU cache. Misses are looked up with one
+    MGET, and new pks come from a block of ids reserved with a single INCRBY on the table's pk counter, so most values
+    cost no round trips at all. New mappings are written with SETNX: if another process claimed the value first, its pk
+    wins and the locally allocated id is simply skipped, so several loaders can share the same Redis safely. All the
+    Redis calls go through SafeRedis's retrying wrappers.
+    """
+
+    def __init__(self, cache, block_size=1000, max_cached=100000):
+        """
+        :param cache: the Redis connection to use
+        :type cache: tools.SafeRedis
+        :param block_size: how many pks to reserve from Redis at a time
+        :type block_size: int
+        :param max_cached: maximum number of value -> pk mappings to keep in memory
+        :type max_cached: int
+        """
+        self.cache = cache
+        self.block_size = block_size
+        self.max_cached = max_cached
+        self.pks = OrderedDict()
+        self.blocks = {}  # table: [next pk, last reserved pk]
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(table, val):
+        """
+        The Redis key for a value. Only the first 355 characters of the value are used (as in the original scheme), so
+        longer values that start the same share a key, and so a pk.
+        :param table: the table the value belongs to
+        :type table: str
+        :param val: the value
+        :type val: str
+        :return: str
+        """
+        return u'{table}_{val}'.format(table=table, val=val[:355])
+
+    def remember(self, key, pk):
+        """
+        Add a mapping to the local cache, evicting the least recently used one if the cache is full.
+        :param key: the Redis key of the value
+        :type key: str
+        :param pk: the value's primary key
+        :type pk: int
+        :return: None
+        """
+        self.pks[key] = pk
+        if len(self.pks) > self.max_cached:
+            self.pks.popitem(last=False)
+
+    def next_pk(self, table):
+        """
+        Take the next pk from this process's block for table, reserving a new block if that one is used up.
+        :param table: the table
+        :type table: str
+        :return: int
+        """
+        block = self.blocks.get(table)
+        if block is None or block[0] > block[1]:
+            last = self.cache.incrby('pk_{table}'.format(table=table), self.block_size)
+            block = self.blocks[table] = [last - self.block_size + 1, last]
+        pk = block[0]
+        block[0] += 1
+        return pk
+
+    def resolve(self, pairs, get_only=False):
+        """
+        Find or create the pks for a number of values at once.
+        :param pairs: the values to look up
+        :type pairs: iterable of (table, value) tuples
+        :param get_only: disable creation of new pks, raising an error if a value doesn't already have one
+        :type get_only: bool
+        :return: {(table, value): pk} dict
+        """
+        resolved = {}
+        missing = OrderedDict()  # key: [(table, value), ...] (values can share a key, see .key)
+        for pair in pairs:
+            key = self.key(*pair)
+            pk = self.pks.pop(key, None)
+            if pk is not None:
+                self.pks[key] = pk  # move to the most recently used end
+                resolved[pair] = pk
+                self.hits += 1
+            else:
+                missing.setdefault(key, []).append(pair)
+        if not missing:
+            return resolved
+        self.misses += len(missing)
+        found = {}  # key: pk
+        keys = missing.keys()
+        new = []
+        for key, cached_pk in zip(keys, self.cache.mget(keys)):
+            if cached_pk is None:
+                new.append(key)
+            else:
+                found[key] = int(cached_pk)  # redis-py returns strings by default
+        if new:
+            if get_only:
+                table, val = missing[new[0]][0]
+                raise ValueError("No primary key found for value {val} for table {table}".format(val=val, table=table))
+            while new:
+                candidates = [self.next_pk(missing[key][0][0]) for key in new]
+                lost = []
+                for key, pk, claimed in zip(new, candidates, self.cache.setnx_many(zip(new, candidates))):
+                    if claimed:
+                        found[key] = pk
+                    else:
+                        lost.append(key)
+                new = []
+                if lost:  # another process got there first
+                    for key, cached_pk in zip(lost, self.cache.mget(lost)):
+                        if cached_pk is None:  # ...and the key's gone again (expired, deleted), so try again
+                            new.append(key)
+                        else:
+                            found[key] = int(cached_pk)
+        for key, key_pairs in missing.iteritems():
+            self.remember(key, found[key])
+            for pair in key_pairs:
+                resolved[pair] = found[key]
+        return resolved
+
+    def get(self, table, val, get_only=False):
+        """
+        Find or create the pk for a single value.
+        :param table: the table the value belongs to
+        :type table: str
+        :param val: the value
+        :type val: str
+        :param get_only: see .resolve
+        :type get_only: bool
+        :return: int
+        """
+        return self.resolve([(table, val)], get_only)[(table, val)]
+
+
+class ParentTracker(object):
+    """
+    Keeps track of the parent rows (tweets, users and hashtags) the Inserter has already made sure exist, so the
+    'INSERT IGNORE ... (id)' placeholder statements are only sent once for each. Rows ensured in the current transaction
+    are kept separately from a bounded window of recently committed ones, so a rollback only forgets the former.
+    NB: the rows ensured in the current transaction are all kept until it's committed or rolled back, so how big that
+    set gets depends on how often the Inserter commits (see its commit_every and commit_interval.)
+    """
+
+    def __init__(self, max_recent=100000):
+        """
+        :param max_recent: how many committed rows to remember
+        :type max_recent: int
+        """
+        self.max_recent = max_recent
+        self.pending = set()
+        self.recent = OrderedDict()
+        self.saved = {}  # statement name: number of statements skipped
+        self.sent = {}  # statement name: number of statements sent
+
+    def mark(self, table, key):
+        """
+        Record that a row is known to exist (e.g. because the full row was just written.)
+        :param table: the row's table
+        :type table: str
+        :param key: the row's primary key
+        :type key: str or int
+        :return: None
+        """
+        self.pending.add((table, key))
+
+    def ensure(self, name, key):
+        """
+        Check whether a placeholder statement needs to be sent, marking the row as existing if so.
+        :param name: the placeholder statement
+        :type name: str (one of STATEMENT_NAMES)
+        :param key: the row's primary key
+        :type key: str or int
+        :return: bool (True if the statement needs to be sent)
+        """
+        row = (STATEMENT_TABLES[name], key)
+        if row in self.pending or row in self.recent:
+            self.saved[name] = self.saved.get(name, 0) + 1
+            return False
+        self.pending.add(row)
+        self.sent[name] = self.sent.get(name, 0) + 1
+        return True
+
+    def commit(self):
+        """
+        Move the rows ensured in the current transaction into the window of recently committed ones.
+        :return: None
+        """
+        for row in self.pending:
+            self.recent[row] = True
+        while len(self.recent) > self.max_recent:
+            self.recent.popitem(last=False)
+        self.pending = set()
+
+    def rollback(self):
+        """
+        Forget the rows ensured in the current transaction.
+        :return: None
+        """
+        self.pending = set()
+
+    def report(self):
+        """
+        Print how many placeholder statements were sent and saved.
+        :return: None
+        """
+        for name in sorted(set(self.saved) | set(self.sent)):
+            print "{name}: {sent} sent, {saved} saved".format(name=name, sent=self.sent.get(name, 0),
+                                                               saved=self.saved.get(name, 0))
+
+
+# MySQL client errors that mean the server can't be reached (CR_CONN_HOST_ERROR, CR_SERVER_GONE_ERROR, CR_SERVER_LOST)
+CONNECTION_LOST_ERRORS = (2003, 2006, 2013)
+
+
+class ConnectionPool(object):
+    """
+    A small pool of MySQL connections with the same settings. Connections are handed out with .get (or .connection) and
+    returned with .put; broken ones should be thrown away with .discard. The pool notices when it's been inherited by a
+    forked process (e.g. a process_dir_parallel worker) and starts afresh there, so connections are never shared
+    between processes. The connections it inherited are kept (in .abandoned) but never used or closed: closing one, or
+    letting it be garbage collected, would send COM_QUIT down the socket the parent is still using.
+    """
+
+    def __init__(self, db_settings, size=4):
+        """
+        :param db_settings: keyword arguments for MySQLdb.connect
+        :type db_settings: dict
+        :param size: the maximum number of idle connections to keep
+        :type size: int
+        """
+        self.db_settings = db_settings
+        self.size = size
+        self.idle = []
+        self.abandoned = []
+        self.pid = getpid()
+        self.lock = Lock()
+
+    def get(self):
+        """
+        Take an idle connection, or open a new one if there aren't any.
+        :return: MySQLdb connection
+        """
+        with self.lock:
+            if self.pid != getpid():
+                self.abandoned.extend(self.idle)
+                self.idle = []
+                self.pid = getpid()
+            if self.idle:
+                return self.idle.pop()
+        return MySQLdb.connect(**self.db_settings)
+
+    def put(self, conn):
+        """
+        Return a connection to the pool, closing it if the pool is full.
+        :param conn: the connection
+        :type conn: MySQLdb connection
+        :return: None
+        """
+        with self.lock:
+            if self.pid == getpid() and len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        self.discard(conn)
+
+    def discard(self, conn):
+        """
+        Close a connection without returning it to the pool.
+        :param conn: the connection
+        :type conn: MySQLdb connection
+        :return: None
+        """
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a with block.
+        :return: MySQLdb connection
+        """
+        conn = self.get()
+        try:
+            yield conn
+        except MySQLdb.OperationalError:
+            self.discard(conn)
+            raise
+        else:
+            self.put(conn)
+
+    @contextmanager
+    def dedicated(self):
+        """
+        Open a connection of its own (rather than one from the pool) for the duration of a with block, and close it
+        afterwards, so it can't end up being inherited by a forked process.
+        :return: MySQLdb connection
+        """
+        conn = MySQLdb.connect(**self.db_settings)
+        try:
+            yield conn
+        finally:
+            self.discard(conn)
+
+
+_POOLS = {}
+
+
+def get_pool(use_testdb=False):
+    """
+    The shared ConnectionPool for the main or test db.
+    :param use_testdb: whether to use the test db settings
+    :type use_testdb: bool
+    :return: ConnectionPool
+    """
+    if use_testdb not in _POOLS:
+        _POOLS[use_testdb] = ConnectionPool(get_settings(use_testdb)[0])
+    return _POOLS[use_testdb]
+
+
+class SQLTracer(object):
+    """
+    Collects statistics about the statements an Inserter executes: the number of statements and rows, and the time
+    spent, per table and kind of statement (insert, insert ignore, upsert.) Every sample'th statement can also be
+    printed, and a summary can be printed every summary_interval seconds. An Inserter without a tracer doesn't pay for
+    any of this.
+    """
+
+    def __init__(self, sample=1000, echo=False, summary_interval=None):
+        """
+        :param sample: print one statement in this many (if echo is set)
+        :type sample: int
+        :param echo: whether to print the sampled statements and skipped rows
+        :type echo: bool
+        :param summary_interval: print a summary (see .report) every this many seconds
+        :type summary_interval: int, float or None
+        """
+        self.sample = sample
+        self.echo = echo
+        self.summary_interval = summary_interval
+        self.statements = 0
+        self.stats = {}  # (table, kind): [statements, rows, seconds, skipped rows]
+        self.last_summary = time()
+
+    def get_stats(self, name):
+        """
+        The stats for a statement's table and kind.
+        :param name: the statement
+        :type name: str (one of STATEMENT_NAMES)
+        :return: list ([statements, rows, seconds, skipped rows])
+        """
+        key = (STATEMENT_TABLES[name], STATEMENT_KINDS[name])
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = [0, 0, 0.0, 0]
+        return stats
+
+    def record(self, name, rows, secs):
+        """
+        Record an executed statement.
+        :param name: the statement
+        :type name: str (one of STATEMENT_NAMES)
+        :param rows: the rows it was executed for
+        :type rows: list of tuples
+        :param secs: how long it took
+        :type secs: float
+        :return: None
+        """
+        self.statements += 1
+        stats = self.get_stats(name)
+        stats[0] += 1
+        stats[1] += len(rows)
+        stats[2] += secs
+        if self.echo and self.statements % self.sample == 0:
+            print "{sql} {row} ({rows} rows, {ms:.2f}ms)".format(sql=STATEMENT_SQL[name], row=rows[0], rows=len(rows),
+                                                                 ms=secs * 1000)
+        if self.summary_interval and time() - self.last_summary >= self.summary_interval:
+            self.report()
+
+    def skipped(self, name, row, error=None):
+        """
+        Record a row that wasn't inserted because it couldn't be written.
+        :param name: the statement
+        :type name: str (one of STATEMENT_NAMES)
+        :param row: the row
+        :type row: tuple
+        :param error: the error writing it raised
+        :type error: MySQLdb.Error or None
+        :return: None
+        """
+        self.get_stats(name)[3] += 1
+        if self.echo:
+            print "{table} row {row} couldn't be written ({error})...skipping...".format(
+                table=STATEMENT_TABLES[name], row=row, error=error)
+
+    def report(self):
+        """
+        Print the stats collected so far.
+        :return: None
+        """
+        self.last_summary = time()
+        for (table, kind), (statements, rows, secs, skipped) in sorted(self.stats.iteritems()):
+            print "{table} {kind}: {st} statements, {rows} rows, {skipped} skipped, {secs:.2f}s ({ms:.2f}ms avg)".format(
+                table=table, kind=kind, st=statements, rows=rows, skipped=skipped, secs=secs,
+                ms=secs * 1000 / statements if statements else 0)
 
 
 class Inserter(object):
@@ -15,42 +670,83 @@ class Inserter(object):
     Class to handle insertion of twitter data into the database.
     NB: tweet ids and user ids are 18- and 9-digit integers, respectively. These values are represented as strings in the
     data, and treated as such in the code, but are translated into bigints by MySQLdb.
+    NB: every write goes through .write (q.v.) If batch_rows is set, rows are buffered and written in bulk (see
+    BatchBuffer, above), so call .flush before committing.
+    NB: everything written in the current transaction is kept (up to max_replay_rows rows) so that, if the server drops
+    the connection, the Inserter can reconnect and replay it instead of losing it.
     """
 
-    def __init__(self, use_testdb=False, show_sql=True):
+    def __init__(self, use_testdb=False, show_sql=False, batch_rows=None, batch_bytes=1048576, pk_block_size=1000,
+                 pk_cache_size=100000, max_recent_parents=100000, pool=None, commit_every=None, commit_interval=None,
+                 max_replay_rows=1000000, max_reconnects=3, reconnect_sleep=5, tracer=None):
         """
         Initialize the Inserter.
         :param test: whether to use the test db/Redis settings
         :type test: bool
+        :param show_sql: whether to print every statement as it's executed (shorthand for an echoing SQLTracer that
+            samples every statement)
+        :type show_sql: bool
+        :param batch_rows: if set, buffer this many rows before writing them (see BatchBuffer)
+        :type batch_rows: int or None
+        :param batch_bytes: if batching, also write the buffered rows once they take up about this many bytes
+        :type batch_bytes: int
+        :param pk_block_size: how many primary keys to reserve from Redis at a time (see PKAllocator)
+        :type pk_block_size: int
+        :param pk_cache_size: how many value -> primary key mappings to keep in memory (see PKAllocator)
+        :type pk_cache_size: int
+        :param max_recent_parents: how many committed parent rows to remember (see ParentTracker)
+        :type max_recent_parents: int
+        :param pool: the pool to take the connection from. Defaults to the shared pool for the db (see get_pool)
+        :type pool: ConnectionPool or None
+        :param commit_every: commit after this many tweets (when .maybe_commit is called between tweets, as process_fil
+            does, so that it can record how far it's got)
+        :type commit_every: int or None
+        :param commit_interval: commit once this many seconds have passed since the last commit (ditto)
+        :type commit_interval: int, float or None
+        :param max_replay_rows: the most rows to keep for replaying after a reconnect. Transactions bigger than this
+            can't be replayed.
+        :type max_replay_rows: int
+        :param max_reconnects: how many times to try reconnecting after the connection is lost
+        :type max_reconnects: int
+        :param reconnect_sleep: seconds to sleep between reconnection attempts
+        :type reconnect_sleep: int or float
+        :param tracer: collects statistics about (and optionally prints) the statements executed
+        :type tracer: SQLTracer or None
         """
-        if use_testdb:
-            db_settings = {'host': 'localhost',
-                           'db': 'tweets_test',
-                           'user': 'samuelraker',
-                           'passwd': environ.get('TWEETS_TESTDB_PASSWORD')}
-            redis_settings = {'host': 'localhost',
-                              'db': '0'}
-        else:
-            db_settings = {'host': 'localhost',
-                           'db': 'twitter',
-                           'user': 'samuelraker',
-                           'passwd': environ.get('TWEETS_DB_PASSWORD')}
-            redis_settings = {'host': 'localhost',
-                              'db': '2'}
-        self.show_sql = show_sql
-        self.DB = MySQLdb.connect(**db_settings)
+        _, redis_settings = get_settings(use_testdb)
+        if tracer is None and show_sql:
+            tracer = SQLTracer(sample=1, echo=True)
+        self.tracer = tracer
+        self.pool = pool or get_pool(use_testdb)
+        self.DB = self.pool.get()
         self.cursor = self.DB.cursor()
+        if batch_rows:
+            self.batch = BatchBuffer(self.execute, batch_rows, batch_bytes,
+                                     self.tracer.skipped if self.tracer is not None else None)
+        else:
+            self.batch = None
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.uncommitted_tweets = 0
+        self.last_commit = time()
+        self.max_replay_rows = max_replay_rows
+        self.replay = []  # (statement name, rows) pairs written in the current transaction, or None if too many
+        self.replay_rows = 0
+        self.max_reconnects = max_reconnects
+        self.reconnect_sleep = reconnect_sleep
         self.cache = SafeRedis(**redis_settings)
-        for table in ('cluster', 'hashtag', 'tag_word', 'url', 'word'):
+        for table in PK_TABLES:
             key = 'pk_{table}'.format(table=table)
             if self.cache.get(key) is None:
                 self.cache.set(key, 0)
+        self.pks = PKAllocator(self.cache, pk_block_size, pk_cache_size)
+        self.parents = ParentTracker(max_recent_parents)
         self.escape_word = self.DB.escape
 
     def get_or_set_pk(self, table, val, get_only=False):
         """
-        Try to retrieve the primary key of a datum from the Redis cache. If none is found, increment the cached pk
-        counter for the table in question and use that.
+        Try to retrieve the primary key of a datum from the cache (see PKAllocator). If none is found, allocate a new one
+        from the pk counter for the table in question and use that.
         :param table: the db table the entry is going to be added to
         :type table: str (one of 'cluster', 'hashtag', 'hashtag_to_cluster', 'tag_word', 'tag_word_to_hashtag', 'url',
             'url_to_tweet', 'user_to_tweet', 'word', 'word_to_tweet')
@@ -60,16 +756,164 @@ class Inserter(object):
         :type get_only: bool
         :return: int
         """
-        key = '{table}_{val}'.format(table=table, val=val[:355])
-        cached_pk = self.cache.get(key)
-        if cached_pk is not None:
-            return int(cached_pk)  # redis-py returns strings by default
+        return self.pks.get(table, val, get_only)
+
+    def write(self, name, row):
+        """
+        Write a row using one of the parameterized statements in STATEMENTS. If batching, the row is buffered (and
+        errors caused by bad rows are dealt with when it's flushed, see BatchBuffer); otherwise it's executed right
+        away, and any error is raised to the caller.
+        :param name: the statement to use
+        :type name: str (one of STATEMENT_NAMES)
+        :param row: the values to insert (None for NULL)
+        :type row: tuple
+        :return: None
+        """
+        if self.batch is not None:
+            self.batch.add(name, row)
         else:
-            if get_only:
-                raise ValueError("No primary key found for value {val} for table {table}".format(val=val, table=table))
-            new_pk = self.cache.incr('pk_{table}'.format(table=table))  # .incr increments the value by 1 and returns the result as an int
-            self.cache.set(key, new_pk)
-            return new_pk
+            self.execute(name, [row])
+
+    def run(self, name, rows):
+        """
+        Execute a statement for one or more rows on the current connection.
+        :param name: the statement to use
+        :type name: str (one of STATEMENT_NAMES)
+        :param rows: the rows
+        :type rows: list of tuples
+        :return: None
+        """
+        if self.tracer is not None:
+            start = time()
+        if len(rows) == 1:
+            self.cursor.execute(STATEMENT_SQL[name], rows[0])
+        else:
+            self.cursor.executemany(STATEMENT_SQL[name], rows)
+        if self.tracer is not None:
+            self.tracer.record(name, rows, time() - start)
+
+    def execute(self, name, rows):
+        """
+        Execute a statement for one or more rows, reconnecting and replaying the current transaction if the connection
+        has been lost, and remember the rows in case that happens later.
+        :param name: the statement to use
+        :type name: str (one of STATEMENT_NAMES)
+        :param rows: the rows
+        :type rows: list of tuples
+        :return: None
+        """
+        try:
+            self.run(name, rows)
+        except MySQLdb.OperationalError as e:
+            if e.args[0] not in CONNECTION_LOST_ERRORS:
+                raise
+            self.reconnect(e)
+            self.run(name, rows)
+        if self.replay is not None:
+            self.replay_rows += len(rows)
+            if self.replay_rows > self.max_replay_rows:
+                self.replay = None
+            else:
+                self.replay.append((name, rows))
+
+    def reconnect(self, error):
+        """
+        Replace a lost connection with a new one from the pool and replay everything written in the current transaction.
+        :param error: the error that signalled the connection was lost (re-raised if the transaction can't be replayed)
+        :type error: MySQLdb.OperationalError
+        :return: None
+        """
+        if self.replay is None:
+            raise error
+        self.pool.discard(self.DB)
+        for attempt in xrange(self.max_reconnects + 1):
+            if attempt:
+                sleep(self.reconnect_sleep)
+            print "Lost connection to MySQL ({error}), reconnecting and replaying {rows} rows".format(
+                error=error, rows=self.replay_rows)
+            try:
+                self.DB = self.pool.get()
+                self.cursor = self.DB.cursor()
+                self.escape_word = self.DB.escape
+                for name, rows in self.replay:
+                    self.run(name, rows)
+                return
+            except MySQLdb.OperationalError as e:
+                if e.args[0] not in CONNECTION_LOST_ERRORS:
+                    raise
+                error = e
+        raise error
+
+    def flush(self):
+        """
+        Write any buffered rows. Does nothing if the Inserter isn't batching.
+        :return: None
+        """
+        if self.batch is not None:
+            self.batch.flush()
+
+    def commit(self):
+        """
+        Write any buffered rows and commit the current transaction.
+        :return: None
+        """
+        self.flush()
+        try:
+            self.DB.commit()
+        except MySQLdb.OperationalError as e:
+            if e.args[0] not in CONNECTION_LOST_ERRORS:
+                raise
+            self.reconnect(e)
+            self.DB.commit()
+        self.parents.commit()
+        self.replay = []
+        self.replay_rows = 0
+        self.uncommitted_tweets = 0
+        self.last_commit = time()
+
+    def rollback(self):
+        """
+        Discard any buffered rows and roll back the current transaction.
+        :return: None
+        """
+        if self.batch is not None:
+            self.batch.clear()
+        self.DB.rollback()
+        self.parents.rollback()
+        self.replay = []
+        self.replay_rows = 0
+        self.uncommitted_tweets = 0
+
+    def maybe_commit(self):
+        """
+        Commit if commit_every tweets have been processed or commit_interval seconds have passed since the last commit.
+        :return: bool (whether a commit happened)
+        """
+        if (self.commit_every and self.uncommitted_tweets >= self.commit_every) or \
+                (self.commit_interval and time() - self.last_commit >= self.commit_interval):
+            self.commit()
+            return True
+        return False
+
+    def close(self):
+        """
+        Commit and give the connection back to the pool.
+        :return: None
+        """
+        self.commit()
+        self.pool.put(self.DB)
+
+    def ensure(self, name, key):
+        """
+        Write a placeholder row (see STATEMENTS), unless the row is already known to exist (see ParentTracker.)
+        :param name: the placeholder statement
+        :type name: str (one of 'tweet_id', 'twitter_user_id', 'hashtag_id')
+        :param key: the row's primary key
+        :type key: str or int
+        :return: None
+        """
+        if self.parents.ensure(name, key):
+            self.write(name, (key,))
 
     def insert_tweet_data(self, tid, hour, day, is_weekday):
         """
@@ -86,22 +930,13 @@ class Inserter(object):
         :return: None
         """
         if hour == "-1":
-            hour = "NULL"
+            hour = None
         if day == "-1":
-            day = "NULL"
+            day = None
         if is_weekday == "-1":
-            is_weekday = "NULL"
-        try:
-            tweet_insert_command = """
-                    INSERT INTO `tweet` (tweet_id, hour, day, is_weekday)
-                    VALUES({id},{hour},{day},{is_w})
-                    ON DUPLICATE KEY UPDATE tweet_id={id}, hour={hour}, day={day}, is_weekday={is_w}
-                """.format(id=tid, hour=hour, day=day, is_w=is_weekday)
-            if self.show_sql:
-                print tweet_insert_command
-            self.cursor.execute(tweet_insert_command)
-        except MySQLdb.IntegrityError:
-            print "Tweet with id {tid} already exists".format(tid=tid)
+            is_weekday = None
+        self.write('tweet', (tid, hour, day, is_weekday))
+        self.parents.mark('tweet', tid)
 
     def insert_mention(self, tweet_id, user_id):
         """
@@ -113,27 +948,9 @@ class Inserter(object):
         :type user_id: str
         :return: None
         """
-        add_user_command = """
-            INSERT IGNORE INTO `twitter_user` (user_id) VALUES({user_id})
-            """.format(user_id=user_id)
-        if self.show_sql:
-            print add_user_command
-        self.cursor.execute(add_user_command)
-        
-        add_tweet_command = """
-            INSERT IGNORE INTO `tweet` (tweet_id) VALUES({tweet_id})
-            """.format(tweet_id=tweet_id)
-        if self.show_sql:
-            print add_tweet_command
-        self.cursor.execute(add_tweet_command)
-        
-        mention_insert_command = """
-                INSERT INTO `user_to_tweet` (tweet_id, user_id, is_mention)
-                VALUES({tid},{uid},{is_m});""".format(tid=tweet_id, uid=user_id, is_m=1)
-        if self.show_sql:
-            print mention_insert_command
-        self.cursor.execute(mention_insert_command)
-        
+        self.ensure('twitter_user_id', user_id)
+        self.ensure('tweet_id', tweet_id)
+        self.write('user_to_tweet', (user_id, tweet_id, 1))
 
     def insert_hashtag(self, hashtag_str, tweet_id):
         """
@@ -145,31 +962,10 @@ class Inserter(object):
         :return: int (primary key of hashtag)
         """
         hashtag_pk = self.get_or_set_pk('hashtag', hashtag_str)
-        add_tweet_command = """
-            INSERT IGNORE INTO `tweet` (tweet_id) VALUES({tweet_id})
-            """.format(tweet_id=tweet_id)
-        if self.show_sql:
-            print add_tweet_command
-        self.cursor.execute(add_tweet_command)
-        
-        try:
-            hashtag_insert_command = """
-                    INSERT INTO `hashtag` (id, str)
-                    VALUES({id}, '{h_str}');""".format(id=hashtag_pk, h_str=self.escape_word(hashtag_str))
-            if self.show_sql:
-                print hashtag_insert_command
-            self.cursor.execute(hashtag_insert_command)
-            
-        except MySQLdb.IntegrityError:
-            if self.show_sql:
-                print "Hashtag {ht} already in DB...skipping...".format(ht=self.escape_word(hashtag_str))
-        hashtag_to_tweet_insert_command = """
-              INSERT INTO `hashtag_to_tweet` (hashtag_id, tweet_id) VALUES({hid}, {tid})
-            """.format(hid=hashtag_pk, tid=tweet_id)
-        if self.show_sql:
-            print hashtag_to_tweet_insert_command
-        self.cursor.execute(hashtag_to_tweet_insert_command)
-        
+        self.ensure('tweet_id', tweet_id)
+        self.write('hashtag', (hashtag_pk, hashtag_str))
+        self.parents.mark('hashtag', hashtag_pk)
+        self.write('hashtag_to_tweet', (hashtag_pk, tweet_id))
         return hashtag_pk
 
     def insert_tag_word(self, tag_word, hashtag_id):
@@ -182,31 +978,9 @@ class Inserter(object):
         :return: None
         """
         tag_word_pk = self.get_or_set_pk('tag_word', tag_word)
-        add_hashtag_command = """
-            INSERT IGNORE INTO `hashtag` (id) VALUES({hashtag_id})
-            """.format(hashtag_id=hashtag_id)
-        if self.show_sql:
-            print add_hashtag_command
-        self.cursor.execute(add_hashtag_command)
-        
-        try:
-            tag_word_insert_command = """
-                    INSERT INTO `tag_word` (id, str)
-                    VALUES({id}, '{tw_str}');""".format(id=tag_word_pk, tw_str=tag_word)
-            if self.show_sql:
-                print tag_word_insert_command
-            self.cursor.execute(tag_word_insert_command)
-            
-        except MySQLdb.IntegrityError:
-            if self.show_sql:
-                print """Tag word {tw} already in DB...skipping...""".format(tw=tag_word)
-        tag_word_to_hashtag_insert_command = """
-                INSERT INTO `tag_word_to_hashtag` (tag_word_id, hashtag_id)
-                VALUES({wid}, {hid});""".format(wid=tag_word_pk, hid=hashtag_id)
-        if self.show_sql:
-            print tag_word_to_hashtag_insert_command
-        self.cursor.execute(tag_word_to_hashtag_insert_command)
-        
+        self.ensure('hashtag_id', hashtag_id)
+        self.write('tag_word', (tag_word_pk, tag_word))
+        self.write('tag_word_to_hashtag', (tag_word_pk, hashtag_id))
 
     def insert_twitter_user(self, user_id, follow_ratio, followers, following, offset):
         """
@@ -227,24 +1001,15 @@ class Inserter(object):
         """
         try:
             offset = int(offset)
-        except TypeError:
-            offset = "NULL"
-        try:
-            user_insert_command = """
-                    INSERT INTO `twitter_user` (user_id, follow_ratio, followers, following, offset)
-                    VALUES({id}, {ratio}, {ers}, {ing}, {off})
-                    ON DUPLICATE KEY UPDATE user_id={id}, follow_ratio={ratio}, followers={ers}, following={ing},
-                    offset={off};
-                """.format(id=user_id, ratio=follow_ratio if (isinstance(followers, int) and followers >= 0) else "NULL",
-                           ers=followers if (isinstance(followers, int) and followers >= 0) else "NULL",
-                           ing=following if (isinstance(following, int) and following >= 0) else "NULL", off=offset)
-            if self.show_sql:
-                print user_insert_command
-            self.cursor.execute(user_insert_command)
-            
-        except MySQLdb.IntegrityError:
-            if self.show_sql:
-                print "User with id {uid} already exists in DB...skipping...".format(uid=user_id)
+        except (TypeError, ValueError):
+            offset = None
+        has_followers = isinstance(followers, int) and followers >= 0
+        self.write('twitter_user', (user_id,
+                                    follow_ratio if has_followers else None,
+                                    followers if has_followers else None,
+                                    following if (isinstance(following, int) and following >= 0) else None,
+                                    offset))
+        self.parents.mark('twitter_user', user_id)
 
     def insert_url(self, url, domain, tweet_id=None, user_id=None, user_url=False):
         """
@@ -263,37 +1028,11 @@ class Inserter(object):
         :return: None
         """
         url_pk = self.get_or_set_pk('url', url)
-        if "'" in url:
-            url_tpl = '"{url_str}"'
-        else:
-            url_tpl = "'{url_str}'"
         if tweet_id is not None:
-            add_tweet_command = """
-                INSERT IGNORE INTO `tweet` (tweet_id) VALUES({tweet_id})""".format(tweet_id=tweet_id)
-            if self.show_sql:
-                print add_tweet_command
-            self.cursor.execute(add_tweet_command)
-            
+            self.ensure('tweet_id', tweet_id)
         if user_id is not None and user_url:
-            add_user_command = """
-                INSERT IGNORE INTO `twitter_user` (user_id) VALUE({user_id})""".format(user_id=user_id)
-            if self.show_sql:
-                print add_user_command
-            self.cursor.execute(add_user_command)
-            
-        try:
-            url_insert_command = """
-                    INSERT INTO `url` (id, str, domain)
-                    VALUES({url_id},{url_tpl},'{domain}');""".format(url_id=url_pk,
-                                                                       url_tpl=url_tpl.format(url_str=self.escape_word(url)),
-                                                                       domain=self.escape_word(domain))
-            if self.show_sql:
-                print url_insert_command
-            self.cursor.execute(url_insert_command)
-            
-        except MySQLdb.IntegrityError:
-            if self.show_sql:
-                print """URL {url} already exists in DB...skipping...""".format(url=self.escape_word(url))
+            self.ensure('twitter_user_id', user_id)
+        self.write('url', (url_pk, url, domain))
         if user_url:
             self.insert_user_url(user_id, url_pk)
         else:
@@ -311,14 +1050,7 @@ class Inserter(object):
         if not user_id:
             raise ValueError('Must specify user_id')
         else:
-
-            user_url_insert_command = """
-                INSERT INTO `user_to_url` (user_id, url_id)
-                VALUES({user_id},{url_id});""".format(user_id=user_id, url_id=url_pk)
-            if self.show_sql:
-                print user_url_insert_command
-            self.cursor.execute(user_url_insert_command)
-            
+            self.write('user_to_url', (user_id, url_pk))
 
     def insert_tweet_url(self, tweet_id, url_pk):
         """
@@ -330,13 +1062,7 @@ class Inserter(object):
         if not tweet_id:
             raise ValueError('Must specify tweet_id')
         else:
-            tweet_url_insert_command = """
-                INSERT INTO `url_to_tweet` (tweet_id, url_id)
-                VALUES({tweet_id},{url_id});""".format(tweet_id=tweet_id, url_id=url_pk)
-            if self.show_sql:
-                print tweet_url_insert_command
-            self.cursor.execute(tweet_url_insert_command)
-            
+            self.write('url_to_tweet', (tweet_id, url_pk))
 
     def insert_word(self, word_str, tweet_id):
         """
@@ -348,33 +1074,12 @@ class Inserter(object):
         :return: None
         """
         word_pk = self.get_or_set_pk('word', word_str)
-        word_str = word_str.replace("'", "[Q]").replace('"', "[QQ]")
-        if "\\" in word_str:
-            word_str = word_str.replace("\\", "\\\\")
-        add_tweet_command = """
-            INSERT IGNORE INTO `tweet` (tweet_id) VALUES({tweet_id})""".format(tweet_id=tweet_id)
-        if self.show_sql:
-            print add_tweet_command
-        self.cursor.execute(add_tweet_command)
+        self.ensure('tweet_id', tweet_id)
         try:
-            word_insert_command = """
-                    INSERT INTO `word` (id, str)
-                    VALUES({w_pk}, '{w_str}');""".format(w_pk=word_pk, w_str=word_str)
-            if self.show_sql:
-                print word_insert_command
-            self.cursor.execute(word_insert_command)
-        except MySQLdb.IntegrityError:
-            if self.show_sql:
-                print "Word {word} already exists in DB...skipping...".format(word=word_str)
-        except MySQLdb.ProgrammingError:
+            self.write('word', (word_pk, munge_word(word_str)))
+        except MySQLdb.ProgrammingError:  # only raised here when not batching: BatchBuffer drops the link row itself
             return None
-        word_to_tweet_insert_command = """
-                INSERT INTO `word_to_tweet` (word_id, tweet_id) VALUES({wid}, {tid})
-                        """.format(wid=word_pk, tid=tweet_id)
-        if self.show_sql:
-            print word_to_tweet_insert_command
-        self.cursor.execute(word_to_tweet_insert_command)
-        
+        self.write('word_to_tweet', (word_pk, tweet_id))
 
     def process_json(self, js):
         """
@@ -386,15 +1091,23 @@ class Inserter(object):
         """
         tweet_id = js[0]
         user_id = js[1][0]['user']
+        self.prefetch_pks(js[1][0], js[1][1])
         self.process_tweet(tweet_id, js[1][0])
         self.process_user(user_id, js[1][1])
-        user_to_tweet_insert_command = """
-                INSERT INTO `user_to_tweet` (user_id, tweet_id, is_mention)
-                VALUES({uid}, {tid}, {is_m});""".format(uid=user_id, tid=tweet_id, is_m=0)
-        if self.show_sql:
-            print user_to_tweet_insert_command
-        self.cursor.execute(user_to_tweet_insert_command)
-        
+        self.write('user_to_tweet', (user_id, tweet_id, 0))
+        self.uncommitted_tweets += 1
+
+    def prefetch_pks(self, tweet_data, user_data):
+        """
+        Look up (or allocate) the primary keys for all the hashtags, tag words, urls and words in a tweet in one go, so
+        the individual insert_* calls find them in the local cache.
+        :param tweet_data: the data extracted from the tweet
+        :type tweet_data: dict
+        :param user_data: the data extracted from the user profile
+        :type user_data: dict
+        :return: None
+        """
+        self.pks.resolve(pk_pairs(tweet_data, user_data))
 
     def process_tweet(self, tweet_id, tweet_data):
         """
@@ -440,73 +1153,554 @@ class Inserter(object):
                 self.insert_url(user_url, user_domains[idx], user_id=user_id, user_url=True)
 
 
-def process_fil(fil, inserter=None, test=True):
+def process_fil(fil, inserter=None, test=True, start=0, checkpoint=None):
     """
-    Processes a whole file, updating the db with the data it contains
+    Processes a whole file, updating the db with the data it contains. Between tweets, the Inserter commits whenever
+    its commit_every or commit_interval says to (see Inserter.maybe_commit); anything left uncommitted at the end is up
+    to the caller to commit.
     :param fil: the file to process
     :type fil: str (filename)
     :param inserter: Inserter instance to use for processing the file. If None, one will be created.
     :type inserter: Inserter instance or None
     :param test: whether to make the Inserter instance use the test db/cache settings
     :type test: bool
+    :param start: the byte offset to start at (see tools.read_lines), e.g. one recorded in a checkpoint file
+    :type start: int
+    :param checkpoint: file to record the offset reached at every commit in (see read_checkpoint)
+    :type checkpoint: str (filename) or None
     :return: None
     """
     if not inserter:
         inserter = Inserter(test)
-    with open(fil) as f:
-        lines = f.readlines()
-    for line in lines:
+    for offset, js in read_jsonl(fil, start, skip_errors=True):
+        if inserter.maybe_commit() and checkpoint:
+            write_checkpoint(checkpoint, fil, offset)
         try:
-            js = loads(line)
             inserter.process_json(js)
         except ValueError:
-            print 'Cannot decode JSON from {line}'.format(line=line)
+            print 'Cannot process {js}'.format(js=js)
 
 
-def process_dir(directory, use_testdb=False, show_sql=True):
+def process_dir(directory, use_testdb=False, show_sql=False, batch_rows=None, batch_bytes=1048576, commit_every=10000,
+                commit_interval=None, tracer=None):
     """
     Process a whole directory.
     :param directory: the directory to process
     :type directory: str (path to a directory)
     :param test: whether to make the Inserter instance use the test db/cache settings
     :param test: bool
+    :param show_sql: see Inserter
+    :type show_sql: bool
+    :param batch_rows: buffer this many rows before writing them (see Inserter), or None to write them one at a time
+    :type batch_rows: int or None
+    :param batch_bytes: see Inserter
+    :type batch_bytes: int
+    :param commit_every: see Inserter. Don't make it None unless commit_interval is set, or the whole directory is
+        loaded in one transaction (and everything the Inserter tracks for it is held in memory until the end.)
+    :type commit_every: int or None
+    :param commit_interval: see Inserter
+    :type commit_interval: int, float or None
+    :param tracer: see Inserter
+    :type tracer: SQLTracer or None
     :return: None
     """
-    inserter = Inserter(use_testdb, show_sql)
+    inserter = Inserter(use_testdb, show_sql, batch_rows, batch_bytes, commit_every=commit_every,
+                        commit_interval=commit_interval, tracer=tracer)
     try:
         fils = eld(directory)
         for fil in fils:
             process_fil(fil, inserter)
             print "Processed {fil}".format(fil=fil)
     finally:
-        inserter.DB.commit()
+        inserter.close()
+        if inserter.batch is not None:
+            inserter.batch.report()
+        inserter.parents.report()
+        if inserter.tracer is not None:
+            inserter.tracer.report()
 
 
-def reset_db(db='test', **db_settings):
-    if db == 'test':
-        db_settings = {'host': 'localhost', 'db': 'tweets_test', 'user': 'samuelraker',
-                       'passwd': environ.get('TWEETS_TESTDB_PASSWORD')}
-        redis_settings = {'host': 'localhost', 'db': '0'}
-    elif db == 'mbp2':
-        db_settings = {'host': 'localhost',
-                       'db': 'twitter',
-                       'user': 'samuelraker',
-                       'passwd': environ.get('TWEETS_DB_PASSWORD')}
-        redis_settings = {'host': 'localhost', 'db': 2}
-    else:
-        if not db_settings:
-            raise ValueError("Must supply valid db name or settings")
-    cache = SafeRedis(**redis_settings)
-    cache.flushdb()
-    print "Flushed Redis cache"
-    db = MySQLdb.connect(**db_settings)
+def write_checkpoint(checkpoint, fil, offset=-1):
+    """
+    Records how far a load has got through a file.
+    :param checkpoint: the checkpoint file
+    :type checkpoint: str (filename)
+    :param fil: the file being loaded
+    :type fil: str (filename)
+    :param offset: the byte offset everything before which has been committed, or -1 if the whole file has
+    :type offset: int
+    :return: None
+    """
+    with open(checkpoint, 'a') as f:
+        f.write('{fil}\t{offset}\n'.format(fil=fil, offset=offset))
+
+
+def read_checkpoint(checkpoint):
+    """
+    Reads how far a previous (parallel) load got through each file. The latest entry for a file wins.
+    :param checkpoint: the checkpoint file
+    :type checkpoint: str (filename) or None
+    :return: {string: int} dict (filename: byte offset to resume at, or -1 if the file is finished)
+    """
+    progress = {}
+    if not checkpoint or not exists(checkpoint):
+        return progress
+    with open(checkpoint) as f:
+        for line in f:
+            fil, _, offset = line.rstrip('\n').rpartition('\t')
+            progress[fil] = int(offset)
+    return progress
+
+
+_worker_inserter = None  # each process_dir_parallel worker process has its own Inserter
+
+
+def _init_worker(use_testdb, batch_rows, batch_bytes, pk_block_size, commit_every):
+    """
+    Pool initializer for process_dir_parallel: gives the worker process its own Inserter, and so its own MySQL connection
+    and its own block of pks.
+    """
+    global _worker_inserter
+    _worker_inserter = Inserter(use_testdb, False, batch_rows, batch_bytes, pk_block_size, commit_every=commit_every)
+
+
+def _load_fil(args):
+    """
+    Loads and commits a single file in a process_dir_parallel worker.
+    :param args: the file to load, the offset to start at and the checkpoint file
+    :type args: (string, int, string) tuple
+    :return: string (the file's name)
+    """
+    fil, start, checkpoint = args
+    process_fil(fil, _worker_inserter, start=start, checkpoint=checkpoint)
+    _worker_inserter.commit()
+    return fil
+
+
+def process_dir_parallel(directory, processes=None, use_testdb=False, checkpoint=None, commit_every=10000,
+                         batch_rows=1000, batch_bytes=1048576, pk_block_size=1000, drop_indexes=False):
+    """
+    Process a whole directory using several worker processes, each with its own Inserter. Workers record the offset
+    they've reached in the checkpoint file every time they commit, and every file is committed by the worker that loaded
+    it before it's marked as finished, so an interrupted load can be restarted with the same checkpoint: finished files
+    are skipped and partly loaded ones pick up where they left off.
+    :param directory: the directory to process
+    :type directory: str (path to a directory)
+    :param processes: the number of worker processes. Defaults to the number of CPUs.
+    :type processes: int or None
+    :param use_testdb: whether to make the Inserter instances use the test db/cache settings
+    :type use_testdb: bool
+    :param checkpoint: file to record progress in (see write_checkpoint)
+    :type checkpoint: str (filename) or None
+    :param commit_every: see Inserter
+    :type commit_every: int or None
+    :param batch_rows: see Inserter
+    :type batch_rows: int or None
+    :param batch_bytes: see Inserter
+    :type batch_bytes: int
+    :param pk_block_size: see Inserter
+    :type pk_block_size: int
+    :param drop_indexes: whether to drop the secondary indexes on the link tables for the duration of the load (see
+        without_secondary_indexes)
+    :type drop_indexes: bool
+    :return: None
+    """
+    progress = read_checkpoint(checkpoint)
+    fils = [fil for fil in eld(directory) if progress.get(fil) != -1]
+    print "{done} files already processed, {todo} to go".format(done=progress.values().count(-1), todo=len(fils))
+    with without_secondary_indexes(get_pool(use_testdb), LINK_TABLES if drop_indexes else ()):
+        pool = Pool(processes, _init_worker, (use_testdb, batch_rows, batch_bytes, pk_block_size, commit_every))
+        try:
+            for fil in pool.imap_unordered(_load_fil, [(fil, progress.get(fil, 0), checkpoint) for fil in fils]):
+                if checkpoint:
+                    write_checkpoint(checkpoint, fil)
+                print "Processed {fil}".format(fil=fil)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+# (table, columns) pairs for the LOAD DATA fast path (see TSVWriter), in load order
+TSV_TABLES = (
+    ('twitter_user', ('user_id', 'follow_ratio', 'followers', 'following', 'offset')),
+    ('tweet', ('tweet_id', 'hour', 'day', 'is_weekday')),
+    ('hashtag', ('id', 'str')),
+    ('tag_word', ('id', 'str')),
+    ('url', ('id', 'str', 'domain')),
+    ('word', ('id', 'str')),
+    ('hashtag_to_tweet', ('hashtag_id', 'tweet_id')),
+    ('tag_word_to_hashtag', ('tag_word_id', 'hashtag_id')),
+    ('url_to_tweet', ('tweet_id', 'url_id')),
+    ('user_to_url', ('user_id', 'url_id')),
+    ('word_to_tweet', ('word_id', 'tweet_id')),
+    ('user_to_tweet', ('user_id', 'tweet_id', 'is_mention')),
+)
+
+
+def tsv_field(val):
+    """
+    Formats a value as a field for LOAD DATA INFILE with the default FIELDS/LINES options: NULLs become \\N, and
+    backslashes, tabs and newlines are backslash-escaped.
+    :param val: the value
+    :type val: str, unicode, int, float or None
+    :return: str
+    """
+    if val is None:
+        return '\\N'
+    elif isinstance(val, float):
+        return '%.15g' % val
+    elif not isinstance(val, basestring):
+        return str(val)
+    if isinstance(val, unicode):
+        val = val.encode('utf8')
+    return val.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r').replace('\0', '\\0')
+
+
+class TSVWriter(object):
+    """
+    Writes the rows the Inserter would insert for a tweet to one tab-separated file per table instead, for loading with
+    LOAD DATA INFILE (see load_tsv, below). Pks are assigned by a PKAllocator, exactly as for the Inserter. Rows are
+    deduplicated within the run: a tweet that's already been written is skipped entirely, hashtags, tag words, urls and
+    words are only written once per pk, and users are kept in memory until .close so that, as with the Inserter, the
+    last version of a user seen wins.
+    NB: only the last max_seen or so pks of each table are remembered for deduplication (in a tools.RecentSet per
+    table), so memory use stays bounded; a row that's been forgotten just gets written again, and the copy is skipped
+    when it's loaded (see load_tsv). The users, on the other hand, are all held until .close: that's one
+    5-tuple (a few hundred bytes) per distinct user in the run, so split runs over very large directories up.
+    """
+
+    def __init__(self, outdir, pks, max_seen=1000000):
+        """
+        :param outdir: the directory to write the files (<table>.tsv) to
+        :type outdir: str (path to a directory)
+        :param pks: the pk allocator to use
+        :type pks: PKAllocator
+        :param max_seen: roughly how many pks per table to remember for deduplication
+        :type max_seen: int
+        """
+        self.outdir = outdir
+        self.pks = pks
+        self.files = {table: open(join(outdir, '{table}.tsv'.format(table=table)), 'w') for table, _ in TSV_TABLES}
+        self.seen = {table: RecentSet(max_seen) for table in ('tweet', 'hashtag', 'tag_word', 'url', 'word')}
+        self.users = {}
+        self.counts = {table: 0 for table, _ in TSV_TABLES}
+
+    def write(self, table, row):
+        """
+        Write a row to a table's file.
+        :param table: the table
+        :type table: str
+        :param row: the row
+        :type row: tuple
+        :return: None
+        """
+        self.files[table].write('\t'.join(tsv_field(val) for val in row) + '\n')
+        self.counts[table] += 1
+
+    def write_once(self, table, pk, row):
+        """
+        Write a row to a table's file unless a row with the same pk has already been written.
+        :param table: the table
+        :type table: str
+        :param pk: the row's primary key
+        :type pk: int or str
+        :param row: the row
+        :type row: tuple
+        :return: None
+        """
+        if pk not in self.seen[table]:
+            self.seen[table].add(pk)
+            self.write(table, row)
+
+    def process_json(self, js):
+        """
+        Equivalent of Inserter.process_json (q.v.)
+        :param js: JSON representation of a tweet
+        :type js: list
+        :return: None
+        """
+        tweet_id = js[0]
+        tweet_data, user_data = js[1]
+        user_id = tweet_data['user']
+        self.process_user(user_id, user_data)
+        if tweet_id in self.seen['tweet']:
+            return
+        pks = self.pks.resolve(pk_pairs(tweet_data, user_data))
+        self.write_once('tweet', tweet_id, (tweet_id,) + tuple(None if tweet_data[col] == "-1" else tweet_data[col]
+                                                               for col in ('hour', 'day', 'is_weekday')))
+        split_hashtags = tweet_data.get('split_hashtags')
+        for idx, hashtag in enumerate(tweet_data.get('hashtags') or []):
+            hashtag_pk = pks[('hashtag', hashtag)]
+            self.write_once('hashtag', hashtag_pk, (hashtag_pk, hashtag))
+            self.write('hashtag_to_tweet', (hashtag_pk, tweet_id))
+            for tag_word in split_hashtags[idx]:
+                tag_word_pk = pks[('tag_word', tag_word)]
+                self.write_once('tag_word', tag_word_pk, (tag_word_pk, tag_word))
+                self.write('tag_word_to_hashtag', (tag_word_pk, hashtag_pk))
+        urls = tweet_data['urls']
+        if urls:
+            for url, domain in zip(urls, tweet_data['domains']):
+                url_pk = pks[('url', url)]
+                self.write_once('url', url_pk, (url_pk, url, domain))
+                self.write('url_to_tweet', (tweet_id, url_pk))
+        for word in tweet_data['words']:
+            word_pk = pks[('word', word)]
+            self.write_once('word', word_pk, (word_pk, munge_word(word)))
+            self.write('word_to_tweet', (word_pk, tweet_id))
+        user_urls = user_data['urls']
+        if user_urls:
+            for url, domain in zip(user_urls, user_data['domains']):
+                url_pk = pks[('url', url)]
+                self.write_once('url', url_pk, (url_pk, url, domain))
+                self.write('user_to_url', (user_id, url_pk))
+        self.write('user_to_tweet', (user_id, tweet_id, 0))
+
+    def process_user(self, user_id, user_data):
+        """
+        Equivalent of Inserter.process_user/Inserter.insert_twitter_user, except the row is held until .close
+        :param user_id: the user's id
+        :type user_id: str
+        :param user_data: the data extracted from the user profile
+        :type user_data: dict
+        :return: None
+        """
+        followers = user_data['followers']
+        following = user_data['following']
+        has_followers = isinstance(followers, int) and followers >= 0
+        try:
+            offset = int(user_data.get('offset'))
+        except (TypeError, ValueError):
+            offset = None
+        self.users[user_id] = (user_id,
+                               user_data['follow_ratio'] if has_followers else None,
+                               followers if has_followers else None,
+                               following if (isinstance(following, int) and following >= 0) else None,
+                               offset)
+
+    def close(self):
+        """
+        Write the user rows and close all the files.
+        :return: None
+        """
+        for row in self.users.itervalues():
+            self.write('twitter_user', row)
+        self.users = {}
+        for f in self.files.itervalues():
+            f.close()
+
+
+def process_fil_tsv(fil, writer):
+    """
+    LOAD DATA equivalent of process_fil: writes the rows for every tweet in a file to the TSVWriter's files
+    :param fil: the file to process
+    :type fil: str (filename)
+    :param writer: the writer to use
+    :type writer: TSVWriter
+    :return: None
+    """
+    for _, js in read_jsonl(fil, skip_errors=True):
+        writer.process_json(js)
+
+
+def load_tsv(outdir, db):
+    """
+    Loads the files written by a TSVWriter with LOAD DATA LOCAL INFILE, in dependency order, and commits. Rows whose
+    keys already exist are skipped (IGNORE), so this is meant for backfilling. NB: the connection has to be opened with
+    local_infile=1.
+    :param outdir: the directory the TSVWriter wrote to
+    :type outdir: str (path to a directory)
+    :param db: the connection to load through
+    :type db: MySQLdb connection
+    :return: None
+    """
     cursor = db.cursor()
-    print 'Wiping {db_name}'.format(db_name=db)
+    for table, columns in TSV_TABLES:
+        fname = join(outdir, '{table}.tsv'.format(table=table))
+        if exists(fname):
+            cursor.execute("""LOAD DATA LOCAL INFILE %s IGNORE INTO TABLE `{table}` CHARACTER SET utf8 ({columns})""".format(
+                table=table, columns=', '.join(columns)), (fname,))
+            print "Loaded {rows} rows into {table}".format(rows=cursor.rowcount, table=table)
+    db.commit()
+
+
+def process_dir_tsv(directory, outdir, use_testdb=False, load=True, drop_indexes=False):
+    """
+    LOAD DATA equivalent of process_dir: writes one TSV file per table for all the files in a directory and (optionally)
+    loads them.
+    :param directory: the directory to process
+    :type directory: str (path to a directory)
+    :param outdir: the directory to write the TSV files to
+    :type outdir: str (path to a directory)
+    :param use_testdb: whether to use the test db/cache settings
+    :type use_testdb: bool
+    :param load: whether to load the files once they've been written
+    :type load: bool
+    :param drop_indexes: whether to drop the secondary indexes on the link tables while loading (see
+        without_secondary_indexes)
+    :type drop_indexes: bool
+    :return: None
+    """
+    db_settings, redis_settings = get_settings(use_testdb)
+    writer = TSVWriter(outdir, PKAllocator(SafeRedis(**redis_settings)))
+    try:
+        for fil in eld(directory):
+            process_fil_tsv(fil, writer)
+            print "Processed {fil}".format(fil=fil)
+    finally:
+        writer.close()
+    print ", ".join("{table}: {rows}".format(table=table, rows=writer.counts[table]) for table, _ in TSV_TABLES)
+    if load:
+        pool = ConnectionPool(dict(db_settings, local_infile=1))
+        with without_secondary_indexes(pool, LINK_TABLES if drop_indexes else ()):
+            with pool.connection() as db:
+                load_tsv(outdir, db)
+
+
+def secondary_indexes(cursor, table):
+    """
+    Reads the definitions of a table's indexes, other than its primary key.
+    :param cursor: the cursor to use
+    :type cursor: MySQLdb cursor
+    :param table: the table
+    :type table: str
+    :return: {string: (bool, list of strings)} dict (index name: (whether it's unique, column definitions))
+    """
+    cursor.execute("""SHOW INDEX FROM `{table}`""".format(table=table))
+    fields = [col[0] for col in cursor.description]
+    indexes = {}
+    for row in sorted((dict(zip(fields, row)) for row in cursor.fetchall()), key=lambda r: r['Seq_in_index']):
+        if row['Key_name'] == 'PRIMARY':
+            continue
+        column = '`{col}`'.format(col=row['Column_name'])
+        if row['Sub_part']:
+            column += '({part})'.format(part=row['Sub_part'])
+        indexes.setdefault(row['Key_name'], (not row['Non_unique'], []))[1].append(column)
+    return indexes
+
+
+def drop_secondary_indexes(conn, tables=LINK_TABLES):
+    """
+    Drops the secondary indexes of some tables, e.g. before a bulk load. Indexes MySQL needs for a foreign key
+    constraint are left alone.
+    :param conn: the connection to use
+    :type conn: MySQLdb connection
+    :param tables: the tables
+    :type tables: iterable of strings
+    :return: {string: {string: (bool, list of strings)}} dict (table: the indexes that were dropped, as returned by
+        secondary_indexes), to pass to restore_secondary_indexes
+    """
+    cursor = conn.cursor()
+    dropped = {}
+    for table in tables:
+        for name, definition in secondary_indexes(cursor, table).iteritems():
+            try:
+                cursor.execute("""ALTER TABLE `{table}` DROP INDEX `{name}`""".format(table=table, name=name))
+            except MySQLdb.OperationalError as e:
+                if e.args[0] != 1553:  # ER_DROP_INDEX_FK: the index is needed in a foreign key constraint
+                    raise
+                continue
+            dropped.setdefault(table, {})[name] = definition
+            print "Dropped index {name} on {table}".format(name=name, table=table)
+    return dropped
+
+
+def restore_secondary_indexes(conn, dropped):
+    """
+    Recreates indexes dropped by drop_secondary_indexes, with one ALTER TABLE per table.
+    :param conn: the connection to use
+    :type conn: MySQLdb connection
+    :param dropped: the dropped indexes, as returned by drop_secondary_indexes
+    :type dropped: dict
+    :return: None
+    """
+    cursor = conn.cursor()
+    for table, indexes in dropped.iteritems():
+        cursor.execute("""ALTER TABLE `{table}` {adds}""".format(table=table, adds=', '.join(
+            "ADD {unique}INDEX `{name}` ({columns})".format(unique='UNIQUE ' if unique else '', name=name,
+                                                            columns=', '.join(columns))
+            for name, (unique, columns) in indexes.iteritems())))
+        print "Restored {num} indexes on {table}".format(num=len(indexes), table=table)
+
+
+@contextmanager
+def without_secondary_indexes(pool, tables=LINK_TABLES):
+    """
+    Drops the secondary indexes of some tables for the duration of a with block, and recreates them afterwards. Each
+    uses a dedicated connection (see ConnectionPool.dedicated) that's closed straight away, so none is left lying around
+    in the pool when process_dir_parallel forks its workers.
+    :param pool: the pool whose settings to connect with
+    :type pool: ConnectionPool
+    :param tables: the tables. If empty, nothing is done.
+    :type tables: iterable of strings
+    :return: dict (see drop_secondary_indexes)
+    """
+    if not tables:
+        yield {}
+        return
+    with pool.dedicated() as conn:
+        dropped = drop_secondary_indexes(conn, tables)
     try:
-        for table in (
-                'cluster', 'hashtag', 'hashtag_to_cluster', 'hashtag_to_tweet', 'tag_word', 'tag_word_to_hashtag', 'url',
-                'url_to_tweet', 'user_to_tweet', 'user_to_url', 'word', 'word_to_tweet', 'twitter_user', 'tweet'):
-            cursor.execute("""DELETE FROM `{table}`;""".format(table=table))
-            print "Wiped {table}".format(table=table)
+        yield dropped
     finally:
-        db.commit()
\ No newline at end of file
+        with pool.dedicated() as conn:
+            restore_secondary_indexes(conn, dropped)
+
+
+def reset_pk_cache(cache, tables=PK_TABLES):
+    """
+    Deletes the cached value -> pk mappings for some tables and resets their pk counters, with a single Lua script call
+    (see RESET_PKS_SCRIPT) rather than flushing the whole Redis db.
+    :param cache: the Redis connection
+    :type cache: tools.SafeRedis
+    :param tables: the tables
+    :type tables: iterable of strings
+    :return: int (number of mappings deleted)
+    """
+    return cache.eval(RESET_PKS_SCRIPT, 0, *tables)
+
+
+def reset_db(db='test', pool=None, truncate=False, **db_settings):
+    """
+    Empties the db and the Redis pk cache.
+    :param db: 'test' for the test db, 'mbp2' for the main one, or anything else to use db_settings (in which case the
+        Redis cache is left alone)
+    :type db: str
+    :param pool: the pool to take the connection from. Defaults to the shared pool for the db (see get_pool)
+    :type pool: ConnectionPool or None
+    :param truncate: whether to TRUNCATE the tables (with foreign key checks off) rather than DELETE FROM them. Much
+        faster on big tables, and doesn't fill up the binlog, but can't be rolled back.
+    :type truncate: bool
+    :param db_settings: keyword arguments for MySQLdb.connect
+    :return: None
+    """
+    if db in ('test', 'mbp2'):
+        use_testdb = db == 'test'
+        redis_settings = get_settings(use_testdb)[1]
+        pool = pool or get_pool(use_testdb)
+    else:
+        if not db_settings:
+            raise ValueError("Must supply valid db name or settings")
+        redis_settings = None
+        pool = pool or ConnectionPool(db_settings)
+    if redis_settings is not None:
+        cache = SafeRedis(**redis_settings)
+        print "Reset Redis pk cache ({num} keys deleted)".format(num=reset_pk_cache(cache))
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        print 'Wiping {db_name}'.format(db_name=db)
+        if truncate:
+            cursor.execute("""SET FOREIGN_KEY_CHECKS = 0""")
+        try:
+            for table in reversed(TABLES):  # children before parents
+                if truncate:
+                    cursor.execute("""TRUNCATE TABLE `{table}`""".format(table=table))
+                else:
+                    cursor.execute("""DELETE FROM `{table}`;""".format(table=table))
+                print "Wiped {table}".format(table=table)
+        finally:
+            if truncate:
+                cursor.execute("""SET FOREIGN_KEY_CHECKS = 1""")
+            conn.commit()
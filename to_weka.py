@@ -2,9 +2,9 @@
 __author__ = 'Sam Raker'
 
 import gzip
-import json
 from os import path
 
+import fastjson
 from tools import eld
 
 VECTORS = ['domains', 'hashtags', 'mentions', 'split_hashtags', 'urls', 'words']
@@ -64,7 +64,7 @@ def process_set(vect_list, ref_set):
 def process_master_vector(master_vector_file):
     s = ''
     with gzip.open(master_vector_file) as f:
-        d = json.load(f)
+        d = fastjson.load(f)
     for vect in VECTORS:
         with open(path.join('sets', '{vect}_set.txt'.format(vect=vect))) as f:
             ref_list = f.readlines()
@@ -75,7 +75,7 @@ def process_master_vector(master_vector_file):
 def process_master_value(master_value_file):
     s = ''
     with gzip.open(master_value_file) as f:
-        d = json.load(f)
+        d = fastjson.load(f)
     for value in VALUES:
         s += '{val},'.format(val=d.get(value, '?'))
     return s.replace('-1', '?')
@@ -1,14 +1,18 @@
 #coding=utf8
 __author__ = 'Sam Raker'
 
+import gzip
 from itertools import chain, imap, ifilter
-from json import dumps, loads
 from os import listdir
-from os.path import join
-from time import sleep
+from os.path import exists, join
+import re
+from sys import maxunicode
+from time import sleep, time
 
 import redis
 
+from fastjson import dumps, loads
+
 
 class SafeRedis(redis.StrictRedis):
     """
@@ -63,10 +67,10 @@ class SafeRedis(redis.StrictRedis):
                                                                                                 self.db)
             sleep(self.sleep_time)
             if self.recur_infinitely:
-                self.set(name, value, *args, **kwargs)
+                return self.set(name, value, *args, **kwargs)
             elif self.attempts < self.max_attempts:
                 self.attempts += 1
-                self.set(name, value, *args, **kwargs)
+                return self.set(name, value, *args, **kwargs)
             else:
                 raise e
 
@@ -85,13 +89,69 @@ class SafeRedis(redis.StrictRedis):
                                                                                                 self.db)
             sleep(self.sleep_time)
             if self.recur_infinitely:
-                self.get(name)
+                return self.get(name)
             elif self.attempts < self.max_attempts:
                 self.attempts += 1
-                self.get(name)
+                return self.get(name)
             else:
                 raise e
 
+    def _retry(self, func, *args, **kwargs):
+        """
+        Calls func, retrying it based on the class's reconnection settings (see __init__) if the connection fails.
+        :param func: the function to call
+        :type func: function
+        :param args: arguments for func
+        :param kwargs: ""
+        :return: whatever func returns
+        """
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except redis.ConnectionError:
+                if not self.recur_infinitely and self.attempts >= self.max_attempts:
+                    raise
+                self.attempts += 1
+                if self.verbose:
+                    print "Problem connecting to Redis DB at {}:{}/{}...sleeping & retrying".format(self.host,
+                                                                                                    self.port,
+                                                                                                    self.db)
+                sleep(self.sleep_time)
+
+    def mget(self, keys, *args):
+        """
+        Same as redis.StrictRedis().mget, except will retry connection based on class's reconnection settings
+        (see __init__ for more information)
+        :param keys: same as redis.StrictRedis().mget
+        :param args: ""
+        """
+        return self._retry(super(SafeRedis, self).mget, keys, *args)
+
+    def incrby(self, name, amount=1):
+        """
+        Same as redis.StrictRedis().incrby, except will retry connection based on class's reconnection settings
+        (see __init__ for more information)
+        :param name: same as redis.StrictRedis().incrby
+        :param amount: ""
+        """
+        return self._retry(super(SafeRedis, self).incrby, name, amount)
+
+    def setnx_many(self, pairs):
+        """
+        SETNX a number of keys in one round trip (using a non-transactional pipeline), retrying the whole lot based on
+        the class's reconnection settings (see __init__) if the connection fails. Retrying is safe, since a key that was
+        set by the failed attempt just comes back as not set the second time.
+        :param pairs: the keys and values to set
+        :type pairs: list of (key, value) tuples
+        :return: list of bools (whether each key was set)
+        """
+        def setnx_all():
+            pipe = self.pipeline(transaction=False)
+            for key, val in pairs:
+                pipe.setnx(key, val)
+            return pipe.execute()
+        return self._retry(setnx_all)
+
 
 def eld(directory):
     """
@@ -103,13 +163,414 @@ def eld(directory):
     return [join(directory, fname) for fname in listdir(directory)]
 
 
+def open_any(fname):
+    """
+    Opens a file for reading, transparently decompressing it if it's gzipped (whatever its extension.)
+    :param fname: the file to open
+    :type fname: string (filename)
+    :return: file or gzip.GzipFile
+    """
+    with open(fname, 'rb') as f:
+        is_gzipped = f.read(2) == '\x1f\x8b'
+    if is_gzipped:
+        return gzip.open(fname, 'rb')
+    return open(fname, 'rb')
+
+
+class RotatingWriter(object):
+    """
+    Writes lines to a series of files named prefix_0.json, prefix_1.json, etc. (with .gz on the end if they're
+    gzipped), moving on to the next file once the current one has had max_bytes written to it (before compression) or
+    has been open for max_secs. Numbering starts after the last file that already exists, so nothing is overwritten.
+    """
+
+    def __init__(self, prefix, max_bytes=100 * 1024 * 1024, max_secs=None, compress=False, buffering=1024 * 1024):
+        """
+        :param prefix: the path to name the files after
+        :type prefix: str
+        :param max_bytes: the most to write to one file, or None for no limit
+        :type max_bytes: int or None
+        :param max_secs: the longest to write to one file for, or None for no limit
+        :type max_secs: int or None
+        :param compress: whether to gzip the files
+        :type compress: bool
+        :param buffering: the size of the write buffer, in bytes
+        :type buffering: int
+        """
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_secs = max_secs
+        self.compress = compress
+        self.buffering = buffering
+        self.counter = 0
+        while exists(self.fname(self.counter)):
+            self.counter += 1
+        self.f = None
+        self.raw = None
+        self.opened = None
+        self.written = 0
+        self.lines = 0
+        self.files = []
+
+    def fname(self, counter):
+        return "{0}_{1}.json{2}".format(self.prefix, counter, '.gz' if self.compress else '')
+
+    def open(self):
+        """
+        Closes the current file, if any, and opens the next one.
+        :return: None
+        """
+        self.close()
+        fname = self.fname(self.counter)
+        self.counter += 1
+        self.raw = open(fname, 'wb', self.buffering)
+        self.f = gzip.GzipFile(fname, 'wb', fileobj=self.raw) if self.compress else self.raw
+        self.opened = time()
+        self.written = 0
+        self.files.append(fname)
+
+    def write(self, line):
+        """
+        Writes a line (and a newline) to the current file, moving on to the next one first if it's time to.
+        :param line: the line to write
+        :type line: str
+        :return: None
+        """
+        if (self.f is None or (self.max_bytes is not None and self.written >= self.max_bytes) or
+                (self.max_secs is not None and time() - self.opened >= self.max_secs)):
+            self.open()
+        self.f.write(line)
+        self.f.write('\n')
+        self.written += len(line) + 1
+        self.lines += 1
+
+    def flush(self):
+        if self.f is not None:
+            self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            if self.f is not self.raw:
+                self.raw.close()
+            self.f = self.raw = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AppendWriter(object):
+    """
+    Writes lines to the end of a single file, like RotatingWriter (q.v.) but without ever moving on to another one.
+    """
+
+    def __init__(self, fname, buffering=1024 * 1024):
+        """
+        :param fname: the file to write to
+        :type fname: str
+        :param buffering: the size of the write buffer, in bytes
+        :type buffering: int
+        """
+        self.fname = fname
+        self.buffering = buffering
+        self.f = None
+        self.lines = 0
+        self.files = [fname]
+
+    def write(self, line):
+        """
+        Writes a line (and a newline) to the end of the file, opening it first if need be.
+        :param line: the line to write
+        :type line: str
+        :return: None
+        """
+        if self.f is None:
+            self.f = open(self.fname, 'ab', self.buffering)
+        self.f.write(line)
+        self.f.write('\n')
+        self.lines += 1
+
+    def flush(self):
+        if self.f is not None:
+            self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_lines(fname, start=0):
+    """
+    Lazily reads the lines of a (plain or gzipped) file, without ever holding more than one line in memory.
+    :param fname: the file to read
+    :type fname: string (filename)
+    :param start: the byte offset to start reading at, e.g. one previously yielded by this function. For gzipped files
+        this is an offset into the decompressed data.
+    :type start: int
+    :return: iterator of (int, string) tuples (the byte offset the line starts at, the line)
+    """
+    with open_any(fname) as f:
+        if start:
+            f.seek(start)
+        offset = start
+        for line in f:
+            yield offset, line
+            offset += len(line)
+
+
+def read_lines_reversed(fname, block_size=65536):
+    """
+    Lazily reads the lines of a (plain or gzipped) file, last line first. Plain files are read backwards a block at a
+    time; gzipped files can't be, so their lines are all read into memory first.
+    :param fname: the file to read
+    :type fname: string (filename)
+    :param block_size: how many bytes of a plain file to read at a time
+    :type block_size: int
+    :return: iterator of (int, string) tuples (the byte offset the line starts at, the line)
+    """
+    with open_any(fname) as f:
+        if isinstance(f, gzip.GzipFile):
+            lines = list(read_lines(fname))
+            for offset, line in reversed(lines):
+                yield offset, line
+            return
+        f.seek(0, 2)
+        pos = f.tell()
+        buf = ''  # everything from pos up to the start of the last line yielded
+        while pos > 0:
+            size = min(block_size, pos)
+            pos -= size
+            f.seek(pos)
+            buf = f.read(size) + buf
+            stop = len(buf)
+            idx = buf.rfind('\n', 0, stop - 1)
+            while idx != -1:  # every line but the first in buf is complete
+                yield pos + idx + 1, buf[idx + 1:stop]
+                stop = idx + 1
+                idx = buf.rfind('\n', 0, stop - 1)
+            buf = buf[:stop]
+        if buf:
+            yield 0, buf
+
+
+def read_jsonl(fname, start=0, verbose=True, fields=None, skip_errors=False):
+    """
+    Lazily reads a (plain or gzipped) file containing one JSON object per line.
+    :param fname: the file to read
+    :type fname: string (filename)
+    :param start: see read_lines
+    :type start: int
+    :param verbose: whether to print the lines that are skipped (see skip_errors)
+    :type verbose: bool
+    :param fields: if given, only these top-level keys of each object are kept (see fastjson.loads)
+    :type fields: collection of strs or None
+    :param skip_errors: skip blank lines and lines that can't be decoded, instead of raising a ValueError
+    :type skip_errors: bool
+    :return: iterator of (int, object) tuples (the byte offset the line starts at, the decoded JSON)
+    """
+    for offset, line in read_lines(fname, start):
+        try:
+            js = loads(line, fields)
+        except ValueError:
+            if not skip_errors:
+                raise
+            if verbose and line.strip():
+                print 'Cannot decode JSON from {line}'.format(line=line)
+            continue
+        yield offset, js
+
+
+class CharFilter(object):
+    """
+    Checks whether every character in a string falls within a set of allowed codepoint ranges. The ranges are compiled
+    into a single regular expression character class (matching any character that isn't allowed) when the filter is
+    made, so checking a string is one search rather than a comparison per character. Byte strings are checked byte by
+    byte, against the ranges' byte values (0-255), and unicode strings character by character.
+    """
+
+    def __init__(self, ranges):
+        """
+        :param ranges: the allowed codepoints, as inclusive (lowest, highest) pairs
+        :type ranges: iterable of (int, int) tuples
+        """
+        self.ranges = []
+        for low, high in sorted(ranges):
+            if self.ranges and low <= self.ranges[-1][1] + 1:
+                self.ranges[-1][1] = max(high, self.ranges[-1][1])
+            else:
+                self.ranges.append([low, high])
+        self.disallowed_chars = re.compile(self.char_class(maxunicode), re.UNICODE)
+        self.disallowed_bytes = re.compile(self.char_class(255).encode('latin-1'))
+
+    def char_class(self, highest):
+        """
+        A negated character class matching the codepoints (up to highest) outside self.ranges.
+        :param highest: the highest codepoint to include
+        :type highest: int
+        :return: unicode
+        """
+        return u'[^{}]'.format(u''.join(u'{}-{}'.format(re.escape(unichr(low)), re.escape(unichr(min(high, highest))))
+                                        for low, high in self.ranges if low <= highest))
+
+    def allowed(self, c):
+        """
+        Checks a single character (or byte.)
+        :param c: the character to check
+        :type c: str or unicode
+        :return: bool
+        """
+        val = ord(c)
+        return any(low <= val <= high for low, high in self.ranges)
+
+    def __call__(self, s):
+        """
+        Checks every character in a string.
+        :param s: the string to check
+        :type s: str or unicode
+        :return: bool
+        """
+        if isinstance(s, unicode):
+            return self.disallowed_chars.search(s) is None
+        return self.disallowed_bytes.search(s) is None
+
+
+UNICHECK_RANGES = ((0, 128), (8192, 8303), (8352, 8399), (8448, 9215), (11263, maxunicode), (65533, 65533),
+                   (126876, 127321), (127744, 128591), (128640, 128895))
+UNIFILTER = CharFilter(UNICHECK_RANGES)
+
+
 def unifilter(s):
     """
-    Calls unicheck on all characters in a string
+    Checks that all the bytes of a string's UTF-8 encoding pass unicheck, using UNIFILTER.
     :param s: the string to check
     :return: bool
     """
-    return all([unicheck(c) for c in s.encode('utf8')])
+    return UNIFILTER(s.encode('utf8'))
+
+
+class Censor(object):
+    """
+    Finds any of a list of terms (e.g. a blocklist) in strings, case-insensitively. The terms are compiled into a
+    single regular expression, factored like a trie (so terms sharing a prefix share the work of matching it) when the
+    Censor is made, and each string is only lower-cased once, so checking a string doesn't get much slower as the list
+    grows. Terms match anywhere, including inside longer words. .terms is a read-only tuple; use .add to add more terms,
+    which rebuilds the regular expression.
+    """
+
+    def __init__(self, terms):
+        """
+        :param terms: the terms to look for
+        :type terms: iterable of strings
+        """
+        self.terms = ()
+        self.pattern = None
+        self.add(*terms)
+
+    def add(self, *terms):
+        """
+        Adds terms to look for, and rebuilds the regular expression.
+        :param terms: the terms
+        :type terms: strings
+        :return: None
+        """
+        self.terms = tuple(sorted(set(self.terms).union(term.lower() for term in terms if term)))
+        trie = {}
+        for term in self.terms:
+            node = trie
+            for c in term:
+                node = node.setdefault(c, {})
+            node[''] = {}
+        self.pattern = re.compile(self.trie_pattern(trie) or u'(?!)', re.UNICODE)
+
+    @classmethod
+    def from_file(cls, fname):
+        """
+        Makes a Censor from a (plain or gzipped) file with one term per line. Blank lines are skipped.
+        :param fname: the file
+        :type fname: string (filename)
+        :return: Censor
+        """
+        return cls(line.strip().decode('utf8') for _, line in read_lines(fname))
+
+    @classmethod
+    def trie_pattern(cls, node):
+        """
+        A regular expression matching every path from a trie node to the end of a term.
+        :param node: the trie node (a dict of characters to nodes, with '' marking the end of a term)
+        :type node: dict
+        :return: unicode
+        """
+        alternatives = [re.escape(c) + cls.trie_pattern(child) for c, child in sorted(node.iteritems()) if c]
+        if not alternatives:
+            return u''
+        if len(alternatives) == 1 and '' not in node:
+            return alternatives[0]
+        return u'(?:{}){}'.format(u'|'.join(alternatives), '?' if '' in node else '')
+
+    def find(self, s):
+        """
+        :param s: the string to search
+        :type s: str or unicode
+        :return: the first term found in s, or None
+        """
+        match = self.pattern.search(s.lower())
+        return match.group() if match else None
+
+    def __call__(self, s):
+        """
+        Checks that a string contains none of the terms.
+        :param s: the string to check
+        :type s: str or unicode
+        :return: bool
+        """
+        return self.pattern.search(s.lower()) is None
+
+
+class RecentSet(object):
+    """
+    A set that only remembers the last max_size or so items added to it, so its memory use stays bounded: items are
+    kept in two generations of at most max_size / 2 each, and when the newer one fills up the older one is thrown away.
+    to_db.TSVWriter keeps one per table to deduplicate rows. An item that's been forgotten just isn't in the set any more. In CPython
+    on a 64-bit machine each int takes about 60 bytes, so the default of a million is about 60MB at most.
+    """
+
+    def __init__(self, max_size=1000000):
+        """
+        :param max_size: roughly how many items to remember
+        :type max_size: int
+        """
+        self.max_size = max_size
+        self.current = set()
+        self.previous = set()
+
+    def __contains__(self, item):
+        return item in self.current or item in self.previous
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+    def add(self, item):
+        """
+        Adds an item (if it isn't already in the set), forgetting the older generation first if the newer one is full.
+        :param item: the item
+        :type item: hashable
+        :return: None
+        """
+        if item in self:
+            return
+        if len(self.current) >= self.max_size // 2:
+            self.current, self.previous = set(), self.current
+        self.current.add(item)
 
 
 def unicheck(c):
@@ -145,13 +606,12 @@ def unicheck(c):
 
 def open_wrapper(fil):
     """
-    Allows f.readlines to be integrated with, e.g., itertools.imap.
+    Allows a file's lines to be integrated with, e.g., itertools.imap. See read_lines, above.
     :param fil: the file to read the lines of
     :type fil: string (filename)
-    :return: list of strings (file contents)
+    :return: iterator of strings (file contents)
     """
-    with open(fil) as f:
-        return f.readlines()
+    return (line for _, line in read_lines(fil))
 
 
 def filter_words(js):
@@ -175,9 +635,9 @@ def clean(infiles, outfile):
     :return: None (writes to outfile)
     """
     i = 0
-    l = chain.from_iterable(imap(open_wrapper, infiles))
-    for parsed in imap(dumps, ifilter(filter_words, imap(loads, l))):
-        i += 1
-        with open(outfile, "a") as f:
+    l = chain.from_iterable(imap(read_jsonl, infiles))
+    with open(outfile, "a") as f:
+        for parsed in imap(dumps, ifilter(filter_words, (js for _, js in l))):
+            i += 1
             f.write(parsed+"\n")
     print i
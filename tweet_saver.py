@@ -1,39 +1,515 @@
 ##coding=utf8
 __author__ = 'Sam Raker'
 
-from json import dumps
-from time import sleep
+from email.utils import mktime_tz, parsedate_tz
+from httplib import HTTPException
+from os.path import splitext
+from Queue import Empty, Full, Queue
+import socket
+import sys
+from threading import Event, Thread
+from time import time
 
+import requests
+from requests.packages.urllib3.exceptions import HTTPError as URLLib3Error
+
+from fastjson import loads
+from tools import AppendWriter, RotatingWriter
 from twitterizer import Scrape
 
+# responses that mean something's wrong with the request itself, so reconnecting won't help
+FATAL_STATUSES = frozenset([401, 403, 404, 406, 413, 416])
+STREAM_ERRORS = (requests.exceptions.RequestException, URLLib3Error, HTTPException, socket.error)
+
 s = Scrape()
 
 
-def tweet_saver(outfile, current, total):
-    counter = current
-    tweets = s.get_tweets(limit=None, as_gen=False)
-    while counter < total:
+def tweet_time(js):
+    """
+    When a tweet was posted.
+    :param js: the tweet
+    :type js: dict
+    :return: float (seconds since the epoch) or None
+    """
+    if 'timestamp_ms' in js:
+        return int(js['timestamp_ms']) / 1000.0
+    created_at = parsedate_tz(js.get('created_at') or '')
+    return mktime_tz(created_at) if created_at else None
+
+
+class StreamReader(object):
+    """
+    Reads lines from the streaming API until it's told to stop, reconnecting whenever the connection drops, errors or
+    stalls (goes stall_timeout seconds without sending anything, not even the keep-alive newlines the API sends every
+    30 seconds.) Reconnection attempts back off as https://dev.twitter.com/docs/streaming-apis/connecting says to:
+    linearly by 0.25s up to 16s after network errors, exponentially from 5s up to 320s after HTTP errors, and
+    exponentially from a minute after being rate limited. The backoff resets once data arrives again. Errors that
+    can't be fixed by reconnecting (like authorization failures) are raised. Another thread can stop it with
+    .disconnect (q.v.)
+    """
+
+    def __init__(self, scrape=None, stall_timeout=90, verbose=True):
+        """
+        :param scrape: the stream to read from (a new Scrape of the sample stream, if None)
+        :type scrape: twitterizer.Scrape or None
+        :param stall_timeout: how long to wait for data before reconnecting, in seconds
+        :type stall_timeout: int
+        :param verbose: whether to print the reasons for reconnecting
+        :type verbose: bool
+        """
+        self.scrape = scrape or Scrape()
+        self.stall_timeout = stall_timeout
+        self.verbose = verbose
+        self.errors = {'network': 0, 'http': 0, 'rate limit': 0}  # consecutive failures of each kind
+        self.connections = 0
+        self.waited = 0.0
+        self.stopping = Event()
+        self.response = None  # the current connection, if any
+
+    def backoff(self, kind):
+        """
+        How long to wait before reconnecting after another failure of the given kind.
+        :param kind: 'network', 'http' or 'rate limit'
+        :type kind: str
+        :return: float (seconds)
+        """
+        self.errors[kind] += 1
+        n = self.errors[kind]
+        if kind == 'network':
+            return min(0.25 * n, 16)
+        if kind == 'http':
+            return min(5 * 2 ** (n - 1), 320)
+        return 60 * 2 ** (n - 1)
+
+    def pause(self, secs):
+        """
+        Waits to reconnect, for secs seconds or until .disconnect is called.
+        :param secs: how long to wait, in seconds
+        :type secs: float
+        :return: None
+        """
+        self.stopping.wait(secs)
+
+    def wait(self, kind, reason):
+        secs = self.backoff(kind)
+        if self.verbose:
+            print "Disconnected ({}), reconnecting in {:.2f}s".format(reason, secs)
+        self.waited += secs
+        self.pause(secs)
+
+    def disconnect(self):
+        """
+        Stops .lines (e.g. from another thread): closes the current connection, so a read blocked on it returns at once,
+        and stops any wait to reconnect. Only the socket is shut down here; .lines closes the response itself.
+        :return: None
+        """
+        self.stopping.set()
+        req = self.response
+        if req is None:
+            return
         try:
-            with open(outfile, "a") as f:
-                f.write(dumps(tweets.next())+"\n")
-                counter += 1
-                if counter % 10 == 0:
-                    print counter
+            sock = socket.fromfd(req.raw.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+        except (IOError, ValueError, AttributeError, socket.error):  # it's already closed
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        finally:
+            sock.close()  # only closes the duplicate file descriptor fromfd made
+
+    def lines(self):
+        """
+        Lines from the stream, including the blank keep-alive ones, across as many connections as it takes, until
+        .disconnect is called. Closing the generator closes the current connection.
+        :return: iterator of strs
+        """
+        while not self.stopping.is_set():
+            try:
+                req = self.scrape.stream(self.stall_timeout)
+            except requests.exceptions.HTTPError as e:
+                status = e.response.status_code
+                if status in FATAL_STATUSES:
+                    raise
+                self.wait('rate limit' if status in (420, 429) else 'http', 'HTTP {}'.format(status))
+                continue
+            except STREAM_ERRORS as e:
+                self.wait('network', '{}: {}'.format(type(e).__name__, e))
+                continue
+            self.connections += 1
+            self.response = req
+            try:
+                if self.stopping.is_set():  # .disconnect was called while connecting
+                    return
+                first = True
+                for line in req.iter_lines():
+                    if first:
+                        self.errors = dict.fromkeys(self.errors, 0)
+                        first = False
+                    yield line
+                reason = 'stream closed'
+            except STREAM_ERRORS as e:
+                reason = '{}: {}'.format(type(e).__name__, e)
+            finally:
+                self.response = None
+                req.close()
+            if not self.stopping.is_set():
+                self.wait('network', reason)
+
+
+class StreamSaver(StreamReader):
+    """
+    Saves tweets from the streaming API (reconnecting as described under StreamReader) until it's told to stop.
+    """
+
+    def __init__(self, writer, scrape=None, suite=True, tests=None, stall_timeout=90, report_every=60, verbose=True):
+        """
+        :param writer: where to write the tweets
+        :type writer: tools.AppendWriter or tools.RotatingWriter
+        :param scrape: the stream to read from (a new Scrape of the sample stream, if None)
+        :type scrape: twitterizer.Scrape or None
+        :param suite: See documentation under twitterizer.Twitterizer
+        :type suite: bool
+        :param tests: additional tests to filter tweets with (see documentation under twitterizer.Twitterizer)
+        :type tests: list of functions or None
+        :param stall_timeout: how long to wait for data before reconnecting, in seconds
+        :type stall_timeout: int
+        :param report_every: how often to print metrics, in seconds (if verbose)
+        :type report_every: int
+        :param verbose: whether to print metrics, and the reasons for reconnecting
+        :type verbose: bool
+        """
+        super(StreamSaver, self).__init__(scrape, stall_timeout, verbose)
+        self.writer = writer
+        self.pipeline = self.scrape.get_pipeline(suite, tests)
+        self.report_every = report_every
+        self.started = None
+        self.last_report = None
+        self.saved = 0
+        self.filtered = 0
+        self.undecodable = 0
+        self.missed = 0  # tweets the stream says it couldn't deliver (from its latest limit notice)
+        self.lag = None  # seconds between the latest tweet being posted and being saved
+
+    def save(self, line):
+        """
+        Saves a line from the stream, if it's a tweet that passes the filter tests.
+        :param line: the line
+        :type line: str
+        :return: bool (whether it was saved)
+        """
+        if not line:
+            return False
+        try:
+            js = loads(line)
         except ValueError:
-            print counter
-            tweets = s.get_tweets(limit=None, as_gen=False)
-            continue
-        except StopIteration:
-            print counter
-            sleep(60)
-            tweets = s.get_tweets(limit=None, as_gen=False)
-            continue
-        except AttributeError:
-            print counter
-            sleep(60)
-            tweets = s.get_tweets(limit=None, as_gen=False)
-            continue
+            self.undecodable += 1
+            return False
+        if 'limit' in js:
+            self.missed = js['limit'].get('track', self.missed)
+            return False
+        if not self.pipeline(js):
+            self.filtered += 1
+            return False
+        self.writer.write(line)
+        self.saved += 1
+        posted = tweet_time(js)
+        if posted is not None:
+            self.lag = time() - posted
+        return True
+
+    def run(self, total=None):
+        """
+        Saves tweets until total have been saved (or forever), or until interrupted (with Ctrl-C, or .disconnect.)
+        :param total: how many tweets to save, or None to keep going
+        :type total: int or None
+        :return: int (the number of tweets saved)
+        """
+        self.started = self.last_report = time()
+        lines = self.lines()  # doesn't connect until the first line is asked for
+        try:
+            while total is None or self.saved < total:
+                line = next(lines, None)
+                if line is None:  # disconnected
+                    break
+                self.save(line)
+                if self.verbose and time() - self.last_report >= self.report_every:
+                    self.report()
         except KeyboardInterrupt:
-            break
+            pass
+        finally:
+            lines.close()
+            self.writer.close()
+            if self.verbose:
+                self.report()
+        return self.saved
+
+    def report(self):
+        """
+        Print throughput, lag and connection metrics.
+        :return: None
+        """
+        self.writer.flush()
+        now = time()
+        print "{saved} tweets saved ({rate:.1f}/s), {filtered} filtered out, {undecodable} undecodable, " \
+              "{missed} missed".format(saved=self.saved, rate=self.saved / max(now - self.started, 1e-9),
+                                       filtered=self.filtered, undecodable=self.undecodable, missed=self.missed)
+        print "{connections} connections, {waited:.1f}s spent waiting to reconnect, lag {lag}".format(
+            connections=self.connections, waited=self.waited,
+            lag='unknown' if self.lag is None else '{:.1f}s'.format(self.lag))
+        self.last_report = now
+
+
+class StreamPipeline(StreamReader):
+    """
+    Reads tweets from the streaming API (reconnecting as described under StreamReader) and hands them to a sink, with
+    the work split into stages so that the connection is never kept waiting by the slower ones:
+        1) a reader thread, which only puts the raw lines on a queue
+        2) a pool of worker threads, which decode and filter the lines, optionally parse the tweets (with parse, e.g.
+        parsed.ParsedTweet), and put the results on a second queue
+        3) a sink thread, which calls sink on each result
+    Both queues are bounded. If the workers fall behind and the first queue fills up, the reader follows policy:
+    'block' waits for room (so the stream may eventually disconnect it), 'drop' throws the line away and 'spill' writes
+    it to spill (a tools.RotatingWriter) to be processed later. If the sink falls behind, the workers wait for it, so
+    the reader's policy applies then too. Any error in a stage stops the pipeline, and is raised by run. When the
+    pipeline stops, the connection is closed (see StreamReader.disconnect), and run waits for every stage, including
+    the reader, which closes the spill file, to finish.
+    Note that the workers are threads, so the parsing they do in parallel is mostly waiting on the network (e.g.
+    unshortening URLs); for CPU-heavy parsing of saved tweets, see parsed.ParsedTweet.from_lines.
+    """
+
+    def __init__(self, sink, scrape=None, suite=True, tests=None, parse=None, workers=4, queue_size=10000,
+                 policy='block', spill=None, stall_timeout=90, report_every=60, verbose=True):
+        """
+        :param sink: called with each tweet that passes the filter tests
+        :type sink: function
+        :param scrape: the stream to read from (a new Scrape of the sample stream, if None)
+        :type scrape: twitterizer.Scrape or None
+        :param suite: See documentation under twitterizer.Twitterizer
+        :type suite: bool
+        :param tests: additional tests to filter tweets with (see documentation under twitterizer.Twitterizer)
+        :type tests: list of functions or None
+        :param parse: called on each tweet (a dict) that passes the filter tests, to make what's given to sink (or
+        None to give sink the dicts)
+        :type parse: function or None
+        :param workers: the number of worker threads
+        :type workers: int
+        :param queue_size: the most items each queue can hold
+        :type queue_size: int
+        :param policy: what the reader does when the first queue is full ('block', 'drop' or 'spill')
+        :type policy: str
+        :param spill: where to write lines when the first queue is full (if policy is 'spill')
+        :type spill: tools.RotatingWriter or None
+        :param stall_timeout: how long to wait for data before reconnecting, in seconds
+        :type stall_timeout: int
+        :param report_every: how often to print metrics, in seconds (if verbose)
+        :type report_every: int
+        :param verbose: whether to print metrics, and the reasons for reconnecting
+        :type verbose: bool
+        """
+        if policy not in ('block', 'drop', 'spill'):
+            raise ValueError("policy must be 'block', 'drop' or 'spill', not {!r}".format(policy))
+        if policy == 'spill' and spill is None:
+            raise ValueError("policy 'spill' needs somewhere to spill to")
+        super(StreamPipeline, self).__init__(scrape, stall_timeout, verbose)
+        self.sink = sink
+        self.pipeline = self.scrape.get_pipeline(suite, tests)
+        self.parse = parse
+        self.workers = workers
+        self.policy = policy
+        self.spill = spill
+        self.report_every = report_every
+        self.lines_queue = Queue(queue_size)
+        self.tweets_queue = Queue(queue_size)
+        self.error = None
+        self.started = None
+        self.read = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.delivered = 0
+        self.peaks = {'lines': 0, 'tweets': 0}  # the deepest each queue has been
+        self.worker_stats = [[0, 0, 0] for _ in xrange(workers)]  # [undecodable, filtered, passed], for each worker
+        self.missed = 0  # tweets the stream says it couldn't deliver (from its latest limit notice)
+
+    def fail(self):
+        """
+        Records the exception being handled, and stops the pipeline.
+        :return: None
+        """
+        if self.error is None:
+            self.error = sys.exc_info()
+        self.stopping.set()
+
+    def put(self, queue, name, item):
+        """
+        Puts an item on a queue, waiting for room unless the pipeline is stopping.
+        :return: bool (whether the item was put on the queue)
+        """
+        while not self.stopping.is_set():
+            try:
+                queue.put(item, timeout=0.5)
+            except Full:
+                continue
+            depth = queue.qsize()
+            if depth > self.peaks[name]:
+                self.peaks[name] = depth
+            return True
+        return False
+
+    def read_stream(self):
+        lines = self.lines()
+        try:
+            for line in lines:
+                if self.stopping.is_set():
+                    break
+                if not line:
+                    continue
+                self.read += 1
+                if self.policy == 'block':
+                    self.put(self.lines_queue, 'lines', line)
+                    continue
+                try:
+                    self.lines_queue.put_nowait(line)
+                except Full:
+                    if self.policy == 'drop':
+                        self.dropped += 1
+                    else:
+                        self.spill.write(line)
+                        self.spilled += 1
+                else:
+                    depth = self.lines_queue.qsize()
+                    if depth > self.peaks['lines']:
+                        self.peaks['lines'] = depth
+        except Exception:
+            self.fail()
+        finally:
+            lines.close()
+            if self.spill is not None:
+                self.spill.close()
+            for _ in xrange(self.workers):
+                self.put(self.lines_queue, 'lines', None)
+
+    def work(self, stats):
+        try:
+            while not self.stopping.is_set():
+                try:
+                    line = self.lines_queue.get(timeout=0.5)
+                except Empty:
+                    continue
+                if line is None:
+                    return
+                try:
+                    js = loads(line)
+                except ValueError:
+                    stats[0] += 1
+                    continue
+                if 'limit' in js:
+                    self.missed = js['limit'].get('track', self.missed)
+                elif not self.pipeline(js):
+                    stats[1] += 1
+                else:
+                    stats[2] += 1
+                    self.put(self.tweets_queue, 'tweets', self.parse(js) if self.parse is not None else js)
+        except Exception:
+            self.fail()
+
+    def drain(self, total):
+        try:
+            while not self.stopping.is_set():
+                try:
+                    tweet = self.tweets_queue.get(timeout=0.5)
+                except Empty:
+                    continue
+                if tweet is None:
+                    return
+                self.sink(tweet)
+                self.delivered += 1
+                if total is not None and self.delivered >= total:
+                    self.stopping.set()
+                    return
+        except Exception:
+            self.fail()
+
+    def run(self, total=None):
+        """
+        Runs the pipeline until total tweets have been given to the sink (or forever), or until interrupted (with
+        Ctrl-C.)
+        :param total: how many tweets to give to the sink, or None to keep going
+        :type total: int or None
+        :return: int (the number of tweets given to the sink)
+        """
+        if total is not None and self.delivered >= total:
+            return self.delivered
+        self.started = time()
+        reader = Thread(target=self.read_stream, name='reader')
+        workers = [Thread(target=self.work, args=(stats,), name='worker {}'.format(i))
+                   for i, stats in enumerate(self.worker_stats)]
+        sink = Thread(target=self.drain, args=(total,), name='sink')
+        for thread in [reader, sink] + workers:
+            thread.daemon = True
+            thread.start()
+        try:
+            last_report = time()
+            finishing = False
+            while sink.is_alive():
+                sink.join(0.5)
+                if not finishing and not reader.is_alive() and not any(worker.is_alive() for worker in workers):
+                    finishing = True
+                    self.put(self.tweets_queue, 'tweets', None)
+                if self.verbose and time() - last_report >= self.report_every:
+                    self.report()
+                    last_report = time()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.disconnect()
+            for thread in [reader] + workers + [sink]:
+                thread.join()
+            if self.verbose:
+                self.report()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.delivered
+
+    def report(self):
+        """
+        Print each stage's throughput, and the depths of the queues between them.
+        :return: None
+        """
+        secs = max(time() - self.started, 1e-9)
+        undecodable, filtered, passed = (sum(counts) for counts in zip(*self.worker_stats))
+        print "reader: {read} lines ({rate:.1f}/s), policy {policy}: {dropped} dropped, {spilled} spilled; " \
+              "{connections} connections, {waited:.1f}s spent waiting to reconnect".format(
+                  read=self.read, rate=self.read / secs, policy=self.policy, dropped=self.dropped,
+                  spilled=self.spilled, connections=self.connections, waited=self.waited)
+        print "lines queue: {depth} waiting (at most {peak} of {size})".format(
+            depth=self.lines_queue.qsize(), peak=self.peaks['lines'], size=self.lines_queue.maxsize)
+        print "workers: {passed} passed, {filtered} filtered out, {undecodable} undecodable, {missed} missed".format(
+            passed=passed, filtered=filtered, undecodable=undecodable, missed=self.missed)
+        print "tweets queue: {depth} waiting (at most {peak} of {size})".format(
+            depth=self.tweets_queue.qsize(), peak=self.peaks['tweets'], size=self.tweets_queue.maxsize)
+        print "sink: {delivered} tweets ({rate:.1f}/s)".format(delivered=self.delivered, rate=self.delivered / secs)
+
+
+def tweet_saver(outfile, current, total, rotate=False):
+    """
+    Saves tweets from the sample stream to the end of outfile, or, if rotate, to outfile_0.json, outfile_1.json, etc.
+    (see tools.RotatingWriter.)
+    :param outfile: the file name to write to (minus its .json extension, if any, if rotate)
+    :type outfile: str
+    :param current: how many tweets have already been saved
+    :type current: int
+    :param total: how many tweets to have saved in all
+    :type total: int
+    :param rotate: whether to split the tweets across numbered files instead of writing them all to outfile
+    :type rotate: bool
+    :return: None
+    """
+    if rotate:
+        prefix, ext = splitext(outfile)
+        writer = RotatingWriter(prefix if ext == '.json' else outfile)
     else:
-        print "{0} tweets saved to {1}".format(current, outfile)
+        writer = AppendWriter(outfile)
+    with writer:
+        saved = StreamSaver(writer, s).run(total - current)
+    print "{0} tweets saved to {1}".format(current + saved, ', '.join(writer.files))
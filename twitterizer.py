@@ -1,22 +1,128 @@
 #coding=utf8
 __author__ = 'Sam Raker'
 
+from collections import OrderedDict
 from functools import partial
 from itertools import ifilter, imap, islice
-from json import loads
+from Queue import Empty, Full, Queue
 import re
-from time import sleep
+import sys
+from threading import Event, Thread, local
+from time import time
 
 import requests
 from requests_oauthlib import OAuth1
 
 from parsed import ParsedTweet
 from auth import _AUTH
+from fastjson import loads
+from ratelimit import default_limiter
+from tools import Censor, RecentSet, unicheck, unifilter
+
+SEARCH_URL = "https://api.twitter.com/1.1/search/tweets.json"
+STREAM_URL = "https://stream.twitter.com/1.1/statuses/sample.json"
 
 if not _AUTH:
     print "authorization error! Please check your settings or set your authorization manually."
 
 
+def test_name(test):
+    """
+    :param test: a filter test
+    :type test: function, method or functools.partial
+    :return: str
+    """
+    return getattr(test, '__name__', None) or test_name(test.func)
+
+
+class FilterPipeline(object):
+    """
+    Checks tweets against a list of tests, stopping at the first one that fails. Each test's calls, passes and (for
+    every sample'th tweet) running time are counted, and every reorder_every tweets the tests are reordered so that
+    the ones that reject the most tweets per second of running time go first. None of the tests should depend on
+    another having run first. The counts are kept without locking, so if a pipeline is shared between threads they're
+    approximate, but the results aren't affected.
+    """
+
+    def __init__(self, tests, sample=16, reorder_every=1000):
+        """
+        :param tests: the tests (see the note on test functions under Twitterizer), cheapest first if known
+        :type tests: iterable of functions
+        :param sample: time the tests on one in this many tweets
+        :type sample: int
+        :param reorder_every: reorder the tests after this many tweets (or never, if None)
+        :type reorder_every: int or None
+        """
+        self.tests = list(tests)
+        self.sample = sample
+        self.reorder_every = reorder_every
+        self.stats = dict((test, [0, 0, 0, 0.0]) for test in self.tests)  # test: [calls, passes, timed calls, secs]
+        self.steps = [(test, self.stats[test]) for test in self.tests]
+        self.seen = 0
+
+    def expected_cost(self, test):
+        """
+        The average running time of a test per tweet it rejects (infinite if it hasn't been timed or rejected
+        anything yet.)
+        :param test: the test
+        :type test: function
+        :return: float
+        """
+        calls, passes, timed, secs = self.stats[test]
+        if not timed or passes == calls:
+            return float('inf')
+        return (secs / timed) / (float(calls - passes) / calls)
+
+    def reorder(self):
+        """
+        Puts the tests in order of expected_cost (q.v.), keeping the current order for ties.
+        :return: None
+        """
+        self.tests = sorted(self.tests, key=self.expected_cost)
+        self.steps = [(test, self.stats[test]) for test in self.tests]
+
+    def __call__(self, tweet):
+        """
+        :param tweet: the tweet to check
+        :type tweet: dict
+        :return: bool (whether tweet passed every test)
+        """
+        if not tweet:
+            return False
+        self.seen += 1
+        if self.reorder_every and not self.seen % self.reorder_every:
+            self.reorder()
+        if self.seen % self.sample:
+            for test, stat in self.steps:
+                stat[0] += 1
+                if not test(tweet):
+                    return False
+                stat[1] += 1
+            return True
+        for test, stat in self.steps:
+            start = time()
+            passed = test(tweet)
+            stat[3] += time() - start
+            stat[2] += 1
+            stat[0] += 1
+            if not passed:
+                return False
+            stat[1] += 1
+        return True
+
+    def report(self):
+        """
+        Print each test's pass/fail counts and average running time, in the current order.
+        :return: None
+        """
+        print "{} tweets checked".format(self.seen)
+        for test in self.tests:
+            calls, passes, timed, secs = self.stats[test]
+            print "{name}: {calls} calls, {passes} passed, {fails} failed, {us:.1f}us each".format(
+                name=test_name(test), calls=calls, passes=passes, fails=calls - passes,
+                us=secs * 1000000 / timed if timed else 0)
+
+
 class Twitterizer(object):
     """
     Base class for Search and Scrape. Implements OAuth authorization, a generator that
@@ -42,47 +148,49 @@ class Twitterizer(object):
         :type _auth: function
         """
         self.__auth__ = _auth or _AUTH or OAuth1("", "", "", "")
-        self.tweets = {}
-        self.saved_search_meta = {}
-        self.to_censor = ["nigga", "nigger", "shit", "damn", "fuck", "cock", "twat", "slut", "pussy"]
+        self.tweets = RecentSet(1000000)  # ids (as ints) of the last million or so tweets found, see Search
+        self.saved_search_meta = {}  # query: metadata about its searches, see Search.results
+        self.censor = Censor(["nigga", "nigger", "shit", "damn", "fuck", "cock", "twat", "slut", "pussy"])
         self.unames_pat = re.compile(r'@[\w\d]+')
+        self.pipelines = OrderedDict()  # suite or (suite, tests): FilterPipeline
+        self.max_pipelines = 100
+        self.unames_tests = OrderedDict()  # q: ._unames_test for q, see .unames_test
 
-    def unifilter(self, s):
-        return all([self.unicheck(c) for c in s.encode("utf8")])
+    @property
+    def to_censor(self):
+        """
+        The terms .curse_out looks for, as a tuple. To change them, assign a new list (or
+        self.censor = tools.Censor.from_file(...)), or add to them with self.censor.add(term, ...); either rebuilds the
+        matcher.
+        """
+        return self.censor.terms
 
-    def unicheck(self, c):
-        val = ord(c)
-        if val <= 128:
-            return True
-        elif 8192 <= val <= 8303:
-            return True
-        elif 8352 <= val <= 8399:
-            return True
-        elif 8448 <= val <= 9215:
-            return True
-        elif val >= 9312 and val >= 11263:
-            return True
-        elif 126876 <= val <= 127321:
-            return True
-        elif 127744 <= val <= 128591:
-            return True
-        elif 128640 <= val <= 128895:
-            return True
-        elif val == 65533:
-            return True
-        else:
-            return False
+    @to_censor.setter
+    def to_censor(self, terms):
+        self.censor = Censor(terms)
 
     def curse_out(self, s):
         """
-        Filters out tweets with bad words (as listed in .to_censor) in them.
-        :param s: the text to censor
-        :return: boolean
+        Checks that a string contains none of the terms in .to_censor.
+        :param s: the string to check
+        :type s: string
+        :return: bool
         """
-        for x in self.to_censor:
-            if x in s.lower():
-                return False  # fails the test
-        return True
+        return self.censor(s)
+
+    def cursed(self, s):
+        """
+        :param s: the string to check
+        :type s: string
+        :return: the first term in .to_censor found in s, or None
+        """
+        return self.censor.find(s)
+
+    def unifilter(self, s):
+        return unifilter(s)
+
+    def unicheck(self, c):
+        return unicheck(c)
 
     def _exist_test(self, tweet):
         """
@@ -145,7 +253,7 @@ class Twitterizer(object):
         :param tweet: the tweet to check
         :type tweet: dictionary
         """
-        if 'text' in tweet.keys():
+        if 'text' in tweet:
             return True
         else:
             return False
@@ -173,31 +281,61 @@ class Twitterizer(object):
         :type q: string
         :return: boolean
         """
-        tweet_text = tweet['text']
-        text = re.sub(self.unames_pat, '', tweet_text)
+        try:
+            text = re.sub(self.unames_pat, '', tweet['text'])
+        except KeyError:
+            return False
         if q in text:
             return True
         else:
             return False
 
+    def unames_test(self, q):
+        """
+        ._unames_test (q.v.) for a search query, made the first time it's asked for and reused after that, so that
+        pipelines using it (see .get_pipeline) are reused by later searches for the same query.
+        :param q: the search query
+        :type q: string
+        :return: functools.partial
+        """
+        test = self.unames_tests.get(q)
+        if test is None:
+            test = self.unames_tests[q] = partial(self._unames_test, q=q)
+            if len(self.unames_tests) > self.max_pipelines:
+                self.unames_tests.popitem(last=False)
+        return test
+
+    def get_pipeline(self, suite=True, tests=None):
+        """
+        The FilterPipeline (q.v.) for a set of tests, made the first time it's asked for and reused after that (so its
+        stats and ordering carry over.)
+        :param suite: whether to include the standard test suite (_text_test, _hash_test, _filter_test, _censor_test)
+        :type suite: bool
+        :param tests: any additional tests to use
+        :type tests: list of test functions (see note on test functions above) or None
+        :return: FilterPipeline
+        """
+        key = (suite, tuple(tests)) if tests else suite
+        pipeline = self.pipelines.get(key)
+        if pipeline is None:
+            suite_tests = [self._text_test, self._hash_test, self._filter_test, self._censor_test] if suite else []
+            pipeline = self.pipelines[key] = FilterPipeline(suite_tests + list(tests or ()))
+            if len(self.pipelines) > self.max_pipelines:
+                self.pipelines.popitem(last=False)
+        return pipeline
+
     def filter_tweet(self, tweet, suite=True, tests=None):
         """
         Filters a tweet using the underscored helper methods above and separates the tweet into (text,metadata) tuples
         :param tweet: the tweet to filter
         :type tweet: dict
-        :param suite: whether to include the standard test suite (_censor_test, _filter_test, _hash_test, _text_test)
+        :param suite: whether to include the standard test suite (_text_test, _hash_test, _filter_test, _censor_test)
         :type suite: bool
         :param tests: any additional tests to use
         :type tests: list of test functions (see note on test functions above) or None
         :param test_kwargs: keyword arguments to pass to the tests
         """
-        if tweet:
-            tests = tests or []
-            if suite:
-                tests += [self._censor_test, self._filter_test, self._hash_test, self._text_test, ]
-            if all([test(tweet) for test in tests]):
-                return True
-        return False
+        return self.get_pipeline(suite, tests)(tweet)
 
     def parse_generator(self, tweets):
         """
@@ -213,15 +351,204 @@ class Search(Twitterizer):
     """
     Child class of Twitterizer that interacts with the Search API
     For more information, see documentation for Twitterizer
+    Requests are made through a RateLimiter (see ratelimit.RateLimiter; by default the shared, paced one), so they
+    go out as fast as the rate limit allows rather than at fixed intervals, and several searches (in different threads,
+    or through .search_all) can run at once without exceeding it.
     """
-    def __init__(self, _auth=None):
+    def __init__(self, _auth=None, url=SEARCH_URL, limiter=None):
         """
         :param _auth: your Twitter authorization. See also documentation under Twitterizer and
         auth.set_auth
         :type _auth: requests_oauthlib.OAuth1 object
+        :param url: the search endpoint
+        :type url: str
+        :param limiter: the rate limiter to make requests through
+        :type limiter: ratelimit.RateLimiter or None
         """
         super(Search, self).__init__(_auth)
-        self.url = "https://api.twitter.com/1.1/search/tweets.json"
+        self.url = url
+        self.limiter = limiter or default_limiter()
+        self.local = local()
+
+    def session(self):
+        """
+        The calling thread's session (requests.Session isn't safe to share between the threads of .search_all.)
+        :return: requests.Session
+        """
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    def pages(self, q, count=100, since_id=None, **params):
+        """
+        Pages of search results, newest first, following max_id back until there are no more (see
+        https://dev.twitter.com/docs/working-with-timelines for more information.)
+        :param q: the term to search for
+        :type q: str
+        :param count: the number of tweets to ask for per page (at most 100)
+        :type count: int
+        :param since_id: only look for tweets newer than this one
+        :type since_id: str or None
+        :param params: any other parameters to pass to the API (see
+        https://dev.twitter.com/docs/api/1.1/get/search/tweets)
+        :return: iterator of lists of dicts
+        """
+        payload = dict(params, q=q, count=min(count, 100))
+        if since_id is not None:
+            payload['since_id'] = since_id
+        while True:
+            req = self.limiter.get(self.url, session=self.session(), auth=self.__auth__, params=payload)
+            req.raise_for_status()
+            tweets = req.json().get("statuses") or []
+            if not tweets:
+                return
+            yield tweets
+            max_id = min(long(tweet["id_str"]) for tweet in tweets) - 1
+            if max_id <= 0:
+                return
+            payload['max_id'] = max_id
+
+    def results(self, q, suite=True, tests=None, ignore_unames=True, minim=None, incremental=False, **params):
+        """
+        The tweets found by a search that pass the filter tests, as they're fetched. The newest tweet id seen is kept
+        in .saved_search_meta[q]['since_id'].
+        :param q: the term to search for
+        :type q: str
+        :param suite: whether to include the "standard suite" of filter tests (see .filter_tweet)
+        :type suite: bool
+        :param tests: tests to implement
+        :type tests: list of functions
+        :param ignore_unames: whether to implement ._unames_test (q.v.)
+        :type ignore_unames: bool
+        :param minim: stop after the page that brings the number of tweets past this (or None to keep going until
+        there are no more results)
+        :type minim: int or None
+        :param incremental: whether to only look for tweets newer than the ones found by the last search for q
+        :type incremental: bool
+        :param params: passed on to .pages (q.v.)
+        :return: iterator of dicts
+        """
+        tests = list(tests or [])
+        if ignore_unames:
+            tests.append(self.unames_test(q))
+        pipeline = self.get_pipeline(suite, tests)
+        meta = self.saved_search_meta.setdefault(q, {})
+        if incremental and 'since_id' in meta:
+            params['since_id'] = meta['since_id']
+        found = 0
+        for tweets in self.pages(q, **params):
+            newest = max(long(tweet["id_str"]) for tweet in tweets)
+            if newest > meta.get('since_id', 0):
+                meta['since_id'] = newest
+            for tweet in tweets:
+                if pipeline(tweet):
+                    found += 1
+                    yield tweet
+            if minim is not None and found >= minim:
+                return
+
+    def search_all(self, queries, workers=4, queue_size=1000, **kwargs):
+        """
+        Runs several searches at once (all through .limiter), merging their results as they come in.
+        :param queries: the terms to search for
+        :type queries: iterable of strs
+        :param workers: how many searches to run at once
+        :type workers: int
+        :param queue_size: the most results to hold on to before the searches wait for them to be used
+        :type queue_size: int
+        :param kwargs: passed on to .results (q.v.)
+        :return: iterator of (str, dict) tuples (the query, the tweet)
+        """
+        todo = Queue()
+        for q in queries:
+            todo.put(q)
+        found = Queue(queue_size)
+        stopping = Event()
+
+        def put(item):
+            while not stopping.is_set():
+                try:
+                    found.put(item, timeout=0.5)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def work():
+            try:
+                while not stopping.is_set():
+                    try:
+                        q = todo.get_nowait()
+                    except Empty:
+                        break
+                    for tweet in self.results(q, **kwargs):
+                        if not put((q, tweet)):
+                            break
+            except Exception:
+                put(sys.exc_info())
+            finally:
+                put(None)
+
+        threads = [Thread(target=work, name='search {}'.format(i)) for i in xrange(min(workers, todo.qsize()))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            running = len(threads)
+            while running:
+                try:
+                    item = found.get(timeout=0.5)
+                except Empty:
+                    continue
+                if item is None:
+                    running -= 1
+                elif len(item) == 3:
+                    raise item[0], item[1], item[2]
+                else:
+                    yield item
+        finally:
+            stopping.set()
+
+    def search_batch(self, queries, sink, workers=4, verbose=True, **kwargs):
+        """
+        Runs many searches at once (see .search_all) and gives each tweet they find to sink, once: tweets already
+        found, by this batch or an earlier one, are skipped. Only the ids of the last million or so tweets found are
+        remembered (in .tweets, a tools.RecentSet; assign a new one to change how many), so a tweet that's been
+        forgotten would be given to sink again. How many tweets each query found, and how many of those were new, is
+        kept in .saved_search_meta[q]['found'] and ['new'].
+        :param queries: the terms to search for
+        :type queries: iterable of strs
+        :param sink: called with each new tweet (a dict) as it's found
+        :type sink: function
+        :param workers: how many searches to run at once
+        :type workers: int
+        :param verbose: whether to print how many tweets were found
+        :type verbose: bool
+        :param kwargs: passed on to .results (q.v.; e.g. incremental=True to only look for tweets newer than the last
+        batch's)
+        :return: int (the number of new tweets)
+        """
+        queries = list(queries)
+        for q in queries:
+            meta = self.saved_search_meta.setdefault(q, {})
+            meta['found'] = meta['new'] = 0
+        seen = self.tweets
+        new = found = 0
+        for q, tweet in self.search_all(queries, workers, **kwargs):
+            meta = self.saved_search_meta[q]
+            meta['found'] += 1
+            found += 1
+            tweet_id = int(tweet["id_str"])
+            if tweet_id in seen:
+                continue
+            seen.add(tweet_id)
+            meta['new'] += 1
+            new += 1
+            sink(tweet)
+        if verbose:
+            print "{found} results for {queries} queries, {new} new".format(found=found, queries=len(queries), new=new)
+        return new
 
     def search(self, q, suite=True, tests=None, ignore_unames=True, minim=20, as_parsed=True,
                verbose=True):
@@ -245,47 +572,10 @@ class Search(Twitterizer):
         :param verbose: whether to print the number of results
         :type verbose: bool
         :return: list of dicts or .generator
-        NB: kwargs passed to this function will be passed to both the filter tests and to
-        the Twitter API call. See https://dev.twitter.com/docs/api/1.1/get/search/tweets
-        for more information
+        NB: to use results as they're fetched, rather than once they've all been fetched, see .results
         """
-        tests = tests or []
-        if ignore_unames:
-            unames_test = partial(self._unames_test, q=q)
-            tests.append(unames_test)
-
-        filter_partial = partial(self.filter_tweet, suite=suite, tests=tests)
-
-        def fil(raw_tweets):
-            """
-            Filters the tweets
-            :param raw_tweets: the tweets to filter
-            :type raw_tweets: list of JSON strings as returned by the Twitter API
-            :return: (list of JSON strings, int, int) tuple
-            """
-            max_id = min([long(tweet["id_str"]) for tweet in raw_tweets]) - 1
-            since_id = max([long(tweet["id_str"]) for tweet in raw_tweets])
-            returned = list(ifilter(filter_partial, raw_tweets))
-            return returned, max_id, since_id
-
-        count = min([minim, 100])
-        payload = {"q": q, "count": count}
-        req = requests.get(self.url, auth=self.__auth__, params=payload)
-        req.raise_for_status()
-        search = req.json()
-        tweets = search["statuses"]
-        results, max_id, since_id = fil(tweets)
-        while len(results) < minim and max_id > 0:
-            sleep(120)
-            payload.update({"max_id": max_id, "since_id": since_id})
-            req = requests.get(url=self.url, auth=self.__auth__, params=payload)
-            req.raise_for_status()
-            search = req.json()
-            tweets = search["statuses"]
-            filtered = fil(tweets)
-            results += filtered[0]
-            max_id = filtered[1]
-            since_id = filtered[2]
+        results = list(self.results(q, suite=suite, tests=tests, ignore_unames=ignore_unames, minim=minim,
+                                    count=min(minim, 100)))
         if verbose:
             print "{0} results".format(len(results))
         if as_parsed:
@@ -298,20 +588,43 @@ class Scrape(Twitterizer):
     """
     Child class of Twitterizer that interacts with the Streaming API. Note that unlike
     the Search class, this class lacks any storage functionality, and so the data scraped
-    from the Streaming API must be used immediately. This class allows for multiple
+    from the Streaming API must be used immediately (see tweet_saver.StreamSaver for a
+    long-running consumer that saves it.) This class allows for multiple
     streams and multiple samples
     """
-    def __init__(self, _auth=None):
+    def __init__(self, _auth=None, url=STREAM_URL):
         """
         :param _auth: your twitter authentication. See the documentation under Twitterizer and
         auth.set_auth
         :type _auth: requests_oauthlib.OAuth1 object
+        :param url: the stream to read from
+        :type url: str
         """
         super(Scrape, self).__init__(_auth)
+        self.url = url
+
+    def stream(self, stall_timeout=90, connect_timeout=10):
+        """
+        Connects to the stream. Raises requests.HTTPError if the stream responds with an error, and once connected,
+        reading from the response raises socket.timeout (or requests' wrapper for it) if nothing, not even a
+        keep-alive newline, arrives for stall_timeout seconds.
+        :param stall_timeout: how long to wait for data before giving up on the connection, in seconds
+        :type stall_timeout: int
+        :param connect_timeout: how long to wait to connect, in seconds
+        :type connect_timeout: int
+        :return: requests.Response
+        """
+        req = requests.get(url=self.url, auth=self.__auth__, stream=True, timeout=(connect_timeout, stall_timeout))
+        try:
+            req.raise_for_status()
+        except requests.exceptions.HTTPError:
+            req.close()
+            raise
+        return req
 
     def get_tweets(self, limit=20, suite=True, tests=None, as_gen=True):
         """
-        Retrieve tweets from a sample.
+        Retrieve tweets from a sample. Connection errors are raised (as requests.exceptions.RequestExceptions.)
         :param limit: the maximum number of tweets to return at once
         :type limit: integer
         :param suite: See documentation under Twitterizer, above
@@ -323,15 +636,10 @@ class Scrape(Twitterizer):
         :type as_gen: boolean
         :return: list of unparsed tweets, or .parse_generator
         """
-        filter_partial = partial(self.filter_tweet, suite=suite, tests=tests)
-        req = requests.get(url="https://stream.twitter.com/1.1/statuses/sample.json", auth=self.__auth__, stream=True)
-        try:
-            req.raise_for_status()
-            iter_ = req.iter_lines()
-            tw = ifilter(filter_partial, imap(loads, iter_))
-            if as_gen:
-                return self.parse_generator(islice(tw, limit))
-            else:
-                return islice(tw, limit)
-        except requests.exceptions.RequestException as e:
-            print e
+        pipeline = self.get_pipeline(suite, tests)
+        req = self.stream()
+        tw = ifilter(pipeline, imap(loads, ifilter(None, req.iter_lines())))  # skipping keep-alive newlines
+        if as_gen:
+            return self.parse_generator(islice(tw, limit))
+        else:
+            return islice(tw, limit)
@@ -0,0 +1,500 @@
+#coding=utf8
+__author__ = 'Sam Raker'
+
+from collections import OrderedDict
+from itertools import chain, imap, izip_longest
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from os import environ, getpid
+from os.path import expanduser
+import sqlite3
+from threading import BoundedSemaphore, Lock, local
+from time import time
+from urlparse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+URL_CACHE_PATH = environ.get('URL_CACHE_PATH', expanduser('~/url_cache.sqlite'))
+
+
+def to_unicode(url):
+    if isinstance(url, str):
+        return url.decode('utf8', 'replace')
+    return url
+
+
+def host(url):
+    return urlparse(url).netloc.lower()
+
+
+class URLCache(object):
+    """
+    A cache of resolved URLs, shared by everything that unshortens them. Lookups go through an in-process LRU cache,
+    then a local sqlite database, then (optionally) Redis; each entry expires after ttl seconds. URLs that couldn't be
+    resolved are cached (as themselves) for the shorter negative_ttl, as are hosts that couldn't be reached at all, so
+    a dead shortener costs one timeout rather than one per URL.
+    Redis entries are stored under the URL itself, as fix_urls always has, so existing caches stay usable.
+    """
+
+    def __init__(self, path=URL_CACHE_PATH, redis=None, ttl=30 * 86400, negative_ttl=86400, max_cached=100000):
+        """
+        :param path: the sqlite database to store resolved URLs in, or None to keep them in memory (and Redis) only
+        :type path: str or None
+        :param redis: a Redis connection to share resolved URLs through
+        :type redis: tools.SafeRedis or None
+        :param ttl: how long to cache resolved URLs for, in seconds
+        :type ttl: int
+        :param negative_ttl: how long to cache URLs that couldn't be resolved and hosts that couldn't be reached for,
+            in seconds
+        :type negative_ttl: int
+        :param max_cached: maximum number of resolved URLs to keep in memory
+        :type max_cached: int
+        """
+        self.path = path
+        self.redis = redis
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_cached = max_cached
+        self.recent = OrderedDict()  # url: (resolved url, expiry time)
+        self.dead_hosts = {}  # host: expiry time
+        self.lock = Lock()
+        self.db = None
+        self.pid = None
+        self.hits = {'memory': 0, 'disk': 0, 'redis': 0, 'dead host': 0}
+        self.misses = 0
+
+    def connect(self):
+        """
+        The sqlite connection, (re)opened as needed (e.g. after a fork.)
+        :return: sqlite3.Connection or None
+        """
+        if self.path is None:
+            return None
+        if self.db is None or self.pid != getpid():
+            self.db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self.pid = getpid()
+            self.db.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, resolved TEXT, expires REAL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS dead_hosts (host TEXT PRIMARY KEY, expires REAL)")
+            self.db.commit()
+            self.dead_hosts.update(self.db.execute("SELECT host, expires FROM dead_hosts WHERE expires > ?",
+                                                   (time(),)))
+        return self.db
+
+    def remember(self, url, resolved, expires):
+        """
+        Add a resolved URL to the in-process cache, evicting the least recently used one if the cache is full.
+        :return: None
+        """
+        self.recent.pop(url, None)
+        self.recent[url] = (resolved, expires)
+        if len(self.recent) > self.max_cached:
+            self.recent.popitem(last=False)
+
+    def get_many(self, urls):
+        """
+        Looks up a batch of URLs. The lock isn't held while Redis is queried, so a slow Redis doesn't hold up the other
+        threads' lookups.
+        :param urls: the URLs to look up
+        :type urls: iterable of strs
+        :return: dict ({url: resolved url} for the URLs found)
+        """
+        now = time()
+        found = {}
+        missing = []
+        with self.lock:
+            for url in set(imap(to_unicode, urls)):
+                entry = self.recent.pop(url, None)
+                if entry is not None and entry[1] > now:
+                    self.recent[url] = entry
+                    found[url] = entry[0]
+                    self.hits['memory'] += 1
+                else:
+                    missing.append(url)
+            db = self.connect()
+            if db is not None and missing:
+                for i in xrange(0, len(missing), 500):
+                    chunk = missing[i:i + 500]
+                    rows = db.execute("SELECT url, resolved, expires FROM urls WHERE expires > ? AND url IN ({})".format(
+                        ', '.join('?' * len(chunk))), [now] + chunk)
+                    for url, resolved, expires in rows:
+                        found[url] = resolved
+                        self.remember(url, resolved, expires)
+                        self.hits['disk'] += 1
+                missing = [url for url in missing if url not in found]
+        added = self.get_redis(missing, now) if self.redis is not None and missing else []
+        with self.lock:
+            if added:
+                for url, resolved, _ in added:
+                    found[url] = resolved
+                self.hits['redis'] += len(added)
+                self.store(added)
+                missing = [url for url in missing if url not in found]
+            for url in missing:
+                expires = self.dead_hosts.get(host(url))
+                if expires is not None and expires > now:
+                    found[url] = url
+                    self.hits['dead host'] += 1
+                else:
+                    self.misses += 1
+        return found
+
+    def get_redis(self, urls, now):
+        """
+        Looks up URLs in Redis, along with how long they have left to live there.
+        :param urls: the URLs to look up
+        :type urls: list of strs
+        :param now: the current time
+        :type now: float
+        :return: list of (url, resolved url, expiry time) tuples for the URLs found
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for url in urls:
+            pipe.get(url)
+            pipe.ttl(url)
+        results = pipe.execute()
+        found = []
+        for url, resolved, ttl in zip(urls, results[::2], results[1::2]):
+            if resolved is not None:
+                # entries fix_urls stored before there was a URLCache have no ttl (-1)
+                expires = now + (ttl if ttl is not None and ttl >= 0 else self.ttl)
+                found.append((url, to_unicode(resolved), expires))
+        return found
+
+    def get(self, url):
+        """
+        Looks up a single URL.
+        :param url: the URL to look up
+        :type url: str
+        :return: str or None
+        """
+        return self.get_many([url]).get(to_unicode(url))
+
+    def store(self, entries):
+        """
+        Stores resolved URLs in memory and on disk (lock already held.)
+        :param entries: (url, resolved url, expiry time) tuples
+        :type entries: list of tuples
+        :return: None
+        """
+        if not entries:
+            return
+        for url, resolved, expires in entries:
+            self.remember(url, resolved, expires)
+        db = self.connect()
+        if db is not None:
+            db.executemany("INSERT OR REPLACE INTO urls (url, resolved, expires) VALUES (?, ?, ?)", entries)
+            db.commit()
+
+    def store_redis(self, entries):
+        """
+        Stores resolved URLs in Redis, if there is one (without the lock.)
+        :param entries: (url, resolved url, expiry time) tuples
+        :type entries: list of tuples
+        :return: None
+        """
+        if not entries or self.redis is None:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        now = time()
+        for url, resolved, expires in entries:
+            pipe.set(url, resolved, ex=max(int(round(expires - now)), 1))
+        pipe.execute()
+
+    def put_many(self, resolved, ttl=None):
+        """
+        Caches a batch of resolved URLs.
+        :param resolved: the resolved URLs
+        :type resolved: dict ({url: resolved url})
+        :param ttl: how long to cache them for (defaults to self.ttl)
+        :type ttl: int or None
+        :return: None
+        """
+        expires = time() + (self.ttl if ttl is None else ttl)
+        entries = [(to_unicode(url), to_unicode(end), expires) for url, end in resolved.iteritems()]
+        with self.lock:
+            self.store(entries)
+        self.store_redis(entries)
+
+    def put(self, url, resolved, ttl=None):
+        """
+        Caches a resolved URL.
+        :param url: the original URL
+        :type url: str
+        :param resolved: the URL it resolves to
+        :type resolved: str
+        :param ttl: how long to cache it for (defaults to self.ttl)
+        :type ttl: int or None
+        :return: None
+        """
+        self.put_many({url: resolved}, ttl)
+
+    def put_failed(self, urls):
+        """
+        Caches URLs that couldn't be resolved (as themselves), for negative_ttl seconds.
+        :param urls: the URLs
+        :type urls: iterable of strs
+        :return: None
+        """
+        self.put_many({url: url for url in urls}, self.negative_ttl)
+
+    def mark_dead(self, hosts):
+        """
+        Records hosts that couldn't be reached, so their URLs aren't tried again for negative_ttl seconds.
+        :param hosts: the hosts
+        :type hosts: iterable of strs
+        :return: None
+        """
+        expires = time() + self.negative_ttl
+        with self.lock:
+            entries = [(h, expires) for h in set(hosts)]
+            self.dead_hosts.update(entries)
+            db = self.connect()
+            if db is not None and entries:
+                db.executemany("INSERT OR REPLACE INTO dead_hosts (host, expires) VALUES (?, ?)", entries)
+                db.commit()
+
+    def report(self):
+        """
+        Print the cache's hit rate.
+        :return: None
+        """
+        hits = sum(self.hits.itervalues())
+        total = hits + self.misses
+        print "URL cache: {hits} hits ({tiers}), {misses} misses ({rate:.1f}% hit rate)".format(
+            hits=hits, misses=self.misses, rate=100.0 * hits / total if total else 0,
+            tiers=', '.join('{} {}'.format(n, tier) for tier, n in sorted(self.hits.iteritems())))
+
+    def close(self):
+        with self.lock:
+            if self.db is not None and self.pid == getpid():
+                self.db.close()
+            self.db = None
+
+
+class URLResolver(object):
+    """
+    Resolves shortened (bit.ly, t.co, etc.) URLs concurrently. URLs are resolved by a pool of threads, each with its
+    own requests.Session so connections to the shorteners are kept alive between requests, and no more than per_host
+    requests are made to any one host at a time. Each URL is tried with a HEAD request first, falling back to a
+    (streamed, so the body is never downloaded) GET if the server doesn't like HEAD requests.
+    A resolver inherited by a forked process (e.g. a ParsedTweet.from_lines worker) notices and starts afresh there:
+    the parent's threads don't exist in the child, so the thread pool, sessions and locks it inherited are useless.
+    """
+
+    def __init__(self, workers=16, per_host=4, timeout=10, deadline=None, max_redirects=10, verbose=True, cache=None):
+        """
+        :param workers: the number of threads to resolve URLs with
+        :type workers: int
+        :param per_host: the maximum number of concurrent requests to any one host
+        :type per_host: int
+        :param timeout: the connect/read timeout for each request, in seconds
+        :type timeout: int or float
+        :param deadline: the maximum number of seconds a call to .resolve_all can take; URLs that haven't been resolved
+            by then are returned as-is
+        :type deadline: int, float or None
+        :param max_redirects: the maximum number of redirects to follow for each URL
+        :type max_redirects: int
+        :param verbose: whether to print the errors encountered resolving URLs
+        :type verbose: bool
+        :param cache: the cache to look URLs up in before resolving them (and store them in after)
+        :type cache: URLCache or None
+        """
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_redirects = max_redirects
+        self.verbose = verbose
+        self.cache = cache
+        self.local = local()
+        self.host_locks = {}
+        self.lock = Lock()
+        self.pool = None
+        self.abandoned = []  # pools inherited from the parent process, kept so they're never finalized (see check_pid)
+        self.pid = getpid()
+
+    def check_pid(self):
+        """
+        Start afresh if the resolver has been inherited by a forked process: new locks (the parent's may have been held
+        by one of its threads), new sessions (so no sockets are shared with the parent) and no thread pool. The
+        inherited pool is kept rather than closed, since closing it would wait forever for threads that aren't there.
+        :return: None
+        """
+        if self.pid != getpid():
+            self.pid = getpid()
+            self.lock = Lock()
+            self.local = local()
+            self.host_locks = {}
+            if self.pool is not None:
+                self.abandoned.append(self.pool)
+            self.pool = None
+
+    def session(self):
+        """
+        The calling thread's session.
+        :return: requests.Session
+        """
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+            session.max_redirects = self.max_redirects
+            adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.per_host)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        return session
+
+    def host_lock(self, url):
+        """
+        The semaphore limiting the number of concurrent requests to a URL's host.
+        :param url: the URL
+        :type url: str
+        :return: threading.BoundedSemaphore
+        """
+        url_host = host(url)
+        with self.lock:
+            sem = self.host_locks.get(url_host)
+            if sem is None:
+                sem = self.host_locks[url_host] = BoundedSemaphore(self.per_host)
+        return sem
+
+    def fetch(self, url):
+        """
+        Resolves a single URL over the network.
+        :param url: the URL to resolve
+        :type url: str
+        :return: (str, str or None) tuple (the URL at the end of the redirect chain, or the original URL if it couldn't
+            be resolved, and why it couldn't: None if it could, 'failed' if the URL is bad, 'dead' if its host couldn't
+            be reached)
+        """
+        session = self.session()
+        try:
+            with self.host_lock(url):
+                r = session.head(url, allow_redirects=True, timeout=self.timeout)
+                r.close()
+                if r.status_code >= 400:  # some servers refuse HEAD requests (405) or mishandle them
+                    r = session.get(url, allow_redirects=True, timeout=self.timeout, stream=True)
+                    r.close()
+            return r.url, None
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if self.verbose:
+                print e
+            return url, 'dead'
+        except (requests.RequestException, ValueError) as e:
+            if self.verbose:
+                print e
+            return url, 'failed'
+
+    def resolve(self, url):
+        """
+        Resolves a single URL.
+        :param url: the URL to resolve
+        :type url: str
+        :return: str (the URL at the end of the redirect chain, or the original URL if it couldn't be resolved)
+        """
+        return self.resolve_all([url])[to_unicode(url)]
+
+    def get_pool(self):
+        self.check_pid()
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+        return self.pool
+
+    def resolve_all(self, urls, deadline=None):
+        """
+        Resolves a batch of URLs in one pass. Each distinct URL is only resolved once (and not at all if it's in the
+        cache), and requests are interleaved by host so a batch full of one shortener's URLs doesn't keep the other
+        hosts waiting.
+        :param urls: the URLs to resolve
+        :type urls: iterable of strs
+        :param deadline: overrides the resolver's deadline (see __init__)
+        :type deadline: int, float or None
+        :return: dict ({url: resolved url})
+        """
+        urls = list(imap(to_unicode, urls))
+        resolved = self.cache.get_many(urls) if self.cache is not None else {}
+        by_host = {}
+        for url in urls:
+            if url not in resolved:
+                by_host.setdefault(host(url), set()).add(url)
+        if not by_host:
+            return resolved
+        ordered = [url for url in chain.from_iterable(izip_longest(*by_host.values())) if url is not None]
+        pool = self.get_pool()
+        pending = [(url, pool.apply_async(self.fetch, (url,))) for url in ordered]
+        deadline = deadline if deadline is not None else self.deadline
+        end = time() + deadline if deadline is not None else None
+        fetched = {}
+        failed = []
+        dead = []
+        for url, result in pending:
+            try:
+                if end is None:
+                    resolved[url], error = result.get()
+                else:
+                    resolved[url], error = result.get(max(end - time(), 0))
+            except TimeoutError:
+                if self.verbose:
+                    print "Timed out resolving {}".format(url)
+                resolved[url] = url
+                continue
+            if error is None:
+                fetched[url] = resolved[url]
+            else:
+                failed.append(url)
+                if error == 'dead':
+                    dead.append(host(url))
+        if self.cache is not None:
+            self.cache.put_many(fetched)
+            self.cache.put_failed(failed)
+            self.cache.mark_dead(dead)
+        return resolved
+
+    def unshorten(self, urls):
+        """
+        Resolves a list of URLs.
+        :param urls: the URLs to resolve
+        :type urls: list of strs
+        :return: list of strs, in the same order as urls
+        """
+        if not urls:
+            return []
+        resolved = self.resolve_all(urls)
+        return [resolved[to_unicode(url)] for url in urls]
+
+    def close(self):
+        """
+        Shuts down the resolver's threads.
+        :return: None
+        """
+        self.check_pid()
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if self.cache is not None:
+            self.cache.report()
+
+
+_RESOLVER = None
+_RESOLVER_PID = None
+_RESOLVER_LOCK = Lock()
+_ABANDONED_RESOLVERS = []  # resolvers inherited from a parent process (see URLResolver.check_pid)
+
+
+def default_resolver():
+    """
+    The URLResolver shared by everything that doesn't bring its own, caching resolved URLs in URL_CACHE_PATH. Each
+    process gets its own, so a forked worker never uses the one it inherited from its parent.
+    :return: URLResolver
+    """
+    global _RESOLVER, _RESOLVER_PID
+    with _RESOLVER_LOCK:
+        if _RESOLVER is None or _RESOLVER_PID != getpid():
+            if _RESOLVER is not None:
+                _ABANDONED_RESOLVERS.append(_RESOLVER)
+            _RESOLVER = URLResolver(cache=URLCache())
+            _RESOLVER_PID = getpid()
+    return _RESOLVER
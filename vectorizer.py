@@ -4,7 +4,6 @@ __author__ = 'Sam Raker'
 from functools import partial
 import gzip
 from itertools import chain
-from json import dump, dumps, loads
 import operator
 from os import mkdir
 from os.path import exists, join, split
@@ -12,7 +11,8 @@ import re
 
 import numpy
 
-from tools import eld
+from fastjson import dump, dumps, loads
+from tools import eld, read_jsonl
 
 
 def file_to_tuple(infile):
@@ -116,17 +116,15 @@ def group_by_tags(js_file, tuple_dict, outdir=None):
     """
     print "group_by_tags ({0})".format(js_file)
     vals = ["domains", "hashtags", "mentions", "split_hashtags", "urls", "words"]
-    with open(js_file) as f:
-        i = 0
-        for line in f:
-            i += 1
-            print i
-            js = loads(line)
-            vectors = [extracted_to_vector(js, tuple_dict[vals[x]], vals[x]) for x in xrange(len(vals))]
-            for hashtag in js[1][0]["hashtags"]:
-                outfile = join(outdir, "{0}.json.gz".format(hashtag.lower()))
-                with gzip.open(outfile, "ab") as fil:
-                    fil.write(dumps(vectors)+"\n")
+    i = 0
+    for _, js in read_jsonl(js_file):
+        i += 1
+        print i
+        vectors = [extracted_to_vector(js, tuple_dict[vals[x]], vals[x]) for x in xrange(len(vals))]
+        for hashtag in js[1][0]["hashtags"]:
+            outfile = join(outdir, "{0}.json.gz".format(hashtag.lower()))
+            with gzip.open(outfile, "ab") as fil:
+                fil.write(dumps(vectors)+"\n")
 
 
 def group_non_vectors(js_file, outdir):
@@ -142,17 +140,15 @@ def group_non_vectors(js_file, outdir):
     print "group_non_vectors ({0})".format(js_file)
     vals = ["day", "is_weekday"]
     user_vals = ["follow_ratio", "following", "followers", "offset"]
-    with open(js_file) as f:
-        i = 0
-        for line in f:
-            i += 1
-            print i
-            js = loads(line)
-            d = {val: js[1][0].get(val) for val in vals}
-            d.update({val: js[1][1].get(val) for val in user_vals})
-            for hashtag in js[1][0]["hashtags"]:
-                outfile = join(outdir, "{0}.json.gz".format(hashtag.lower()))
-                write_wrapper(d, outfile)
+    i = 0
+    for _, js in read_jsonl(js_file):
+        i += 1
+        print i
+        d = {val: js[1][0].get(val) for val in vals}
+        d.update({val: js[1][1].get(val) for val in user_vals})
+        for hashtag in js[1][0]["hashtags"]:
+            outfile = join(outdir, "{0}.json.gz".format(hashtag.lower()))
+            write_wrapper(d, outfile)
 
 
 def vector_map(v1, v2):
@@ -227,17 +223,13 @@ def get_master_vectors(infile, outfile):
     """
     vals = ["domains", "hashtags", "mentions", "split_hashtags", "urls", "words"]
     out_dict = {"domains": [], "hashtags": [], "mentions": [], "split_hashtags": [], "urls": [], "words": []}
-    with gzip.open(infile) as f:
-        while True:
-            try:
-                line = loads(f.next())
-                for x in xrange(len(line)):
-                        out_dict[vals[x]] += line[x]
-            except (TypeError, ValueError) as e:
-                print vals[x], line[x]
-                raise e
-            except StopIteration:
-                break
+    for _, line in read_jsonl(infile):
+        try:
+            for x in xrange(len(line)):
+                    out_dict[vals[x]] += line[x]
+        except (TypeError, ValueError) as e:
+            print vals[x], line[x]
+            raise e
     for key in out_dict:
         out_dict[key] = list(set(out_dict[key]))
     with gzip.open(outfile, "w") as f:
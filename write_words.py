@@ -2,9 +2,8 @@
 __author__ = 'Sam Raker'
 
 from itertools import chain, ifilter
-from json import loads
 
-from tools import eld, unifilter
+from tools import eld, read_jsonl, read_lines, unifilter
 
 
 def extractor(val, infile, outfile, user=False):
@@ -18,11 +17,9 @@ def extractor(val, infile, outfile, user=False):
     :type outfile: string (file name)
     :return: None (writes to outfile)
     """
-    outstr = ""
-    outlist = []
-    with open(infile) as f:
-        for line in f:
-            parsed = loads(line)
+    with open(outfile, "a") as f:
+        sep = ""
+        for _, parsed in read_jsonl(infile):
             if user:
                 output = parsed[1][1].get(val)
             else:
@@ -32,10 +29,9 @@ def extractor(val, infile, outfile, user=False):
                     output = chain.from_iterable(output)
             except IndexError:
                 pass
-            outlist += output
-    outstr += "\n".join(ifilter(unifilter, outlist))
-    with open(outfile, "a") as f:
-        f.write(outstr)
+            for item in ifilter(unifilter, output):
+                f.write(sep + item)
+                sep = "\n"
 
 
 def extract_folder(val, folder, outfile, user=False):
@@ -65,7 +61,6 @@ def reconstructor(infiles, outfile):
     """
     s = set()
     for infile in infiles:
-        with open(infile) as f:
-            s = s.union([x.rstrip() for x in f.readlines()])
+        s.update(x.rstrip() for _, x in read_lines(infile))
     with open(outfile, "w") as f:
         f.write("\n".join(list(s)))